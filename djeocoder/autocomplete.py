@@ -0,0 +1,238 @@
+"""
+Completions for partly typed streets, addresses and intersections, for a
+dispatcher's search box, from the blocks and intersections in memory rather
+than a geocode per keystroke:
+
+    index = AutocompleteIndex.from_files('blocks.txt.gz', 'intersections.txt.gz')
+    index.complete('tobin')          # Tobin Rd., Tobin Ct., Tobin Rd. & Kerna Rd., ...
+    index.complete('24 tob')         # 24 Tobin Rd., on the block whose range has 24
+    index.complete('kerna rd & t')   # Kerna Rd. & Tobin Rd. (as Tobin Rd. & Kerna Rd.)
+
+Input is normalized with parser.parsing.normalize, so case and punctuation
+don't matter. The names are kept in one sorted list of normalized keys,
+searched with bisect; intersections are filed under both orders of their
+streets. Streets rank above intersections and busier streets (more blocks)
+above quieter ones, and a key that's exactly what was typed comes first.
+Since short prefixes match thousands of names, the ranked matches for
+every prefix matching more than RANKED_MATCHES keys are worked out up
+front, leaving at most that many to sort per keystroke.
+"""
+import bisect
+import itertools
+import re
+
+from geometry import interpolation_fraction
+from memory import IndexedBlock, IndexedIntersection, StreetBlocks
+from parser.parsing import normalize
+from results import BlockResult, contains_number
+from textfiles import BlockFileLoader, IntersectionFileLoader
+import snapshot
+
+STREET, INTERSECTION = 'street', 'intersection'
+
+# Prefixes with more matches than this get them ranked ahead of time.
+RANKED_MATCHES = 100
+
+number_re = re.compile(r'^(\d+)(?: (.*))?$')
+
+# How an intersection might be typed, normalized; it's searched for with &.
+separator_re = re.compile(r' (?:AND|AT|@|/) ')
+
+class Entry(object):
+    """
+    A street (with its blocks) or an intersection that can be completed to.
+    """
+    __slots__ = ('kind', 'text', 'rank', 'blocks', 'low', 'high', 'intersection')
+
+    def __init__(self, kind, text, count, blocks=None, intersection=None):
+        self.kind = kind
+        self.text = text
+        # Higher is better.
+        self.rank = (kind == STREET, count, -len(text))
+        self.blocks = blocks
+        # The lowest and highest numbers on the street's blocks, to pass
+        # over it without a search when an address's number is outside them.
+        self.low, self.high = 1, 0
+        if blocks and blocks.numbered:
+            self.low = blocks.from_nums[0]
+            self.high = max(b.to_num for b in blocks.numbered)
+        self.intersection = intersection
+
+class Completion(object):
+    """
+    One suggestion: text to show, its kind (STREET or INTERSECTION), its
+    location if it's a point (an intersection, or an address on one block)
+    and, for an address, the BlockResults of the blocks that have its number.
+    """
+    def __init__(self, text, kind, location=None, blocks=()):
+        self.text = text
+        self.kind = kind
+        self.location = location
+        self.blocks = list(blocks)
+
+    def __repr__(self):
+        return 'Completion(%r, %r)' % (self.text, self.kind)
+
+class AutocompleteIndex:
+    """
+    Built from an iterable of block rows and one of intersection rows (e.g.
+    the loaders' scan()s).
+    """
+    def __init__(self, block_rows, intersection_rows):
+        streets = {}
+        counts = {}
+        for row in block_rows:
+            name = row['street_pretty_name']
+            if not name:
+                continue
+            block = IndexedBlock(row)
+            streets.setdefault(name, []).append(block)
+            counts[block.street] = counts.get(block.street, 0) + 1
+
+        keyed = []
+        for name, blocks in streets.iteritems():
+            entry = Entry(STREET, name, len(blocks), blocks=StreetBlocks(blocks))
+            key = normalize(name)
+            keyed.append((key, entry))
+            # Find N Beacon St. from "beac" too.
+            if blocks[0].predir and key.startswith(blocks[0].predir + ' '):
+                keyed.append((key[len(blocks[0].predir) + 1:], entry))
+        for row in intersection_rows:
+            intersection = IndexedIntersection(row)
+            if not intersection.pretty_name:
+                continue
+            count = counts.get(intersection.side_a[0], 0) + counts.get(intersection.side_b[0], 0)
+            entry = Entry(INTERSECTION, intersection.pretty_name, count, intersection=intersection)
+            key = normalize(intersection.pretty_name)
+            keyed.append((key, entry))
+            sides = key.split(' & ')
+            if len(sides) == 2:
+                keyed.append(('%s & %s' % (sides[1], sides[0]), entry))
+
+        keyed.sort(key=lambda item: item[0])
+        self.keys = [key for key, entry in keyed]
+        self.entries = [entry for key, entry in keyed]
+
+        # prefix -> its matching entries, best first, each once, for the
+        # prefixes with lots of them. The keys are sorted, so a prefix's
+        # keys are the slice [lo:hi], and its longer prefixes split it up.
+        # Streets rank above intersections, so a prefix's streets are the
+        # start of its list, which is kept too for addresses.
+        self.ranked = {}
+        self.ranked_streets = {}
+        common = [('', 0, len(self.keys))]
+        while common:
+            prefix, lo, hi = common.pop()
+            if prefix:
+                entries = self.ranked[prefix] = ranked(self.entries[lo:hi])
+                self.ranked_streets[prefix] = list(itertools.takewhile(
+                    lambda entry: entry.kind == STREET, entries))
+            length = len(prefix) + 1
+            while lo < hi:
+                if len(self.keys[lo]) < length:
+                    lo += 1
+                    continue
+                longer = self.keys[lo][:length]
+                end = bisect.bisect_left(self.keys, longer + '\xff', lo, hi)
+                if end - lo > RANKED_MATCHES:
+                    common.append((longer, lo, end))
+                lo = end
+
+    @classmethod
+    def from_loaders(cls, block_loader, intersection_loader):
+        return cls(block_loader.scan(), intersection_loader.scan())
+
+    @classmethod
+    def from_files(cls, blocks_file, intersections_file):
+        return cls.from_loaders(snapshot.load(blocks_file, BlockFileLoader),
+                                snapshot.load(intersections_file, IntersectionFileLoader))
+
+    def matches(self, prefix, streets=False):
+        """
+        Returns the entries with a key starting with prefix (a normalized
+        byte string), best first: exact matches, then by rank. With
+        streets, only the streets are returned.
+        """
+        lo = bisect.bisect_left(self.keys, prefix)
+        exact = []
+        i = lo
+        while i < len(self.keys) and self.keys[i] == prefix:
+            exact.append(self.entries[i])
+            i += 1
+        if streets:
+            exact = [entry for entry in exact if entry.kind == STREET]
+        if prefix in self.ranked:
+            rest = (streets and self.ranked_streets or self.ranked)[prefix]
+        else:
+            hi = bisect.bisect_left(self.keys, prefix + '\xff', lo)
+            rest = ranked(self.entries[i:hi])
+            if streets:
+                rest = [entry for entry in rest if entry.kind == STREET]
+        if not exact:
+            return rest
+        return ranked(exact) + [entry for entry in rest if entry not in exact]
+
+    def complete(self, text, k=10):
+        """
+        Returns up to k Completions for text. If it starts with a house
+        number, only streets with a block whose range has that number are
+        suggested, as addresses.
+        """
+        query = separator_re.sub(' & ', normalize(text))
+        # The keys are bytes, as read from the data files.
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        number = None
+        match = number_re.match(query)
+        if match:
+            number, query = int(match.group(1)), match.group(2) or ''
+        if not query:
+            return []
+
+        completions = []
+        for entry in self.matches(query, streets=number is not None):
+            if number is None:
+                location = entry.intersection and entry.intersection.coordinates()
+                completions.append(Completion(entry.text, entry.kind, location))
+            elif entry.low <= number <= entry.high:
+                blocks = blocks_containing(entry.blocks, number)
+                if not blocks:
+                    continue
+                location = len(blocks) == 1 and blocks[0].location or None
+                completions.append(Completion('%d %s' % (number, entry.text), entry.kind, location, blocks))
+            if len(completions) >= k:
+                break
+        return completions
+
+def ranked(entries):
+    """
+    Returns entries, without repeats, best first.
+    """
+    seen = set()
+    unique = []
+    for entry in entries:
+        if id(entry) not in seen:
+            seen.add(id(entry))
+            unique.append(entry)
+    unique.sort(key=lambda entry: entry.rank, reverse=True)
+    return unique
+
+def blocks_containing(street_blocks, number):
+    """
+    Returns BlockResults, located at number, for the blocks of a
+    StreetBlocks whose range (on the number's side) has number.
+    """
+    results = []
+    for b in street_blocks.containing(number):
+        containment = contains_number(number, b.from_num, b.to_num, b.left_from_num, b.left_to_num, b.right_from_num, b.right_to_num)
+        if containment[0]:
+            point = b.interpolate(interpolation_fraction(number, containment[1], containment[2]))
+            results.append(BlockResult(b.as_tuple(), point))
+    return results
+
+if __name__ == "__main__":
+    import sys
+    index = AutocompleteIndex.from_files(*sys.argv[1:3])
+    for line in iter(sys.stdin.readline, ''):
+        for completion in index.complete(line.strip()):
+            print completion.text
@@ -0,0 +1,582 @@
+"""
+Benchmarks for the geocoder, run offline against the bundled Boston data,
+with the in-memory searchers standing in for PostGIS:
+
+    python benchmark.py run --json results.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py memory
+    python benchmark.py startup
+    python benchmark.py load [--processes N]
+    python benchmark.py classify
+
+'run' measures parse throughput, address and intersection lookup latency,
+reverse geocoding, spatial search and autocomplete latency, cold-start
+time and peak memory, and writes them as JSON with the commit they were
+measured at. The locations (and points, and the prefixes autocomplete is
+timed on) come from a corpus generated from the data files with a fixed
+seed, so the same commit always gets the same input; --corpus adds files
+of locations, either one per line or the cf_addrs module that
+parser/make_cf_tests.py prints.
+
+'compare' prints how each measurement changed between two runs, and exits
+with status 1 if any got worse by more than --threshold.
+
+'load' compares how many rows per second the data files load at, a line
+at a time as PipeFileLoader used to, a chunk at a time as it does now,
+and streamed.
+
+'classify' compares classifying and standardizing the corpus's tokens the
+way the parser does now, with a dict lookup for the vocabulary types, with
+doing it the way it used to, matching a regex of every suffix and
+directional.
+
+Memory and startup measurements run in a fresh process each, so results
+don't depend on what was loaded before.
+"""
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import time
+
+import autocomplete
+import snapshot
+import spatial
+import textfiles
+from djeocoder import LocalGeocoder, GeocoderException
+from memory import MemoryBlockSearcher, MemoryIntersectionSearcher
+from parser import parsing
+from parser.suffixes import suffixes
+from textfiles import BlockFileLoader, IntersectionFileLoader
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+BLOCKS_FILE = os.path.join(DATA_DIR, 'blocks.txt.gz')
+INTERSECTIONS_FILE = os.path.join(DATA_DIR, 'intersections.txt.gz')
+
+def max_rss():
+    """
+    Returns the peak resident set size of this process, in bytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+def _measure_child(conn, load, args):
+    before = max_rss()
+    loaded = load(*args)
+    conn.send(max_rss() - before)
+    conn.close()
+
+def measure_memory(load, *args):
+    """
+    Returns how many bytes the peak RSS of a fresh process grows by while
+    calling load(*args) and holding on to the result.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_measure_child, args=(child, load, args))
+    process.start()
+    used = parent.recv()
+    process.join()
+    return used
+
+def legacy_load(filename):
+    # How PipeFileLoader used to hold a file: a list of stripped strings per row.
+    inf = gzip.open(filename, 'r')
+    rows = [[x.strip() for x in line.split('|')] for line in inf]
+    inf.close()
+    return rows
+
+def memory_benchmark():
+    results = {}
+    for name, loader, filename in (('blocks', BlockFileLoader, BLOCKS_FILE), ('intersections', IntersectionFileLoader, INTERSECTIONS_FILE)):
+        results[name] = {
+            'legacy_bytes': measure_memory(legacy_load, filename),
+            'columnar_bytes': measure_memory(loader, filename),
+        }
+    return results
+
+def print_memory(results):
+    print '%-15s %12s %12s %8s' % ('file', 'legacy MB', 'columnar MB', 'ratio')
+    for name in sorted(results):
+        r = results[name]
+        print '%-15s %12.1f %12.1f %8.2f' % (name, r['legacy_bytes'] / 1048576.0, r['columnar_bytes'] / 1048576.0,
+                                             float(r['columnar_bytes']) / max(r['legacy_bytes'], 1))
+
+def _time_child(conn, load, args):
+    start = time.time()
+    loaded = load(*args)
+    conn.send(time.time() - start)
+    conn.close()
+
+def measure_time(load, *args):
+    """
+    Returns how many seconds calling load(*args) takes in a fresh process.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_time_child, args=(child, load, args))
+    process.start()
+    elapsed = parent.recv()
+    process.join()
+    return elapsed
+
+def text_searcher(searcher_class, loader_class, filename):
+    return searcher_class(loader_class(filename).scan())
+
+def startup_benchmark():
+    """
+    Times building each in-memory searcher from the text file and from its
+    snapshot, compiling the snapshot first if needed.
+    """
+    results = {}
+    for name, searcher, loader, filename in (('blocks', MemoryBlockSearcher, BlockFileLoader, BLOCKS_FILE),
+                                             ('intersections', MemoryIntersectionSearcher, IntersectionFileLoader, INTERSECTIONS_FILE)):
+        if not snapshot.is_fresh(snapshot.snapshot_filename(filename), filename):
+            snapshot.compile_snapshot(filename, loader)
+        results[name] = {
+            'text_seconds': measure_time(text_searcher, searcher, loader, filename),
+            'snapshot_seconds': measure_time(searcher.from_file, filename),
+        }
+    return results
+
+def print_startup(results):
+    print '%-15s %12s %12s %8s' % ('file', 'text s', 'snapshot s', 'ratio')
+    for name in sorted(results):
+        r = results[name]
+        print '%-15s %12.3f %12.3f %8.2f' % (name, r['text_seconds'], r['snapshot_seconds'],
+                                             r['snapshot_seconds'] / max(r['text_seconds'], 1e-9))
+
+def readline_load(loader_class, filename):
+    # How PipeFileLoader used to read a file: a line at a time, stripping
+    # and converting each field as the row was appended.
+    loader = loader_class.__new__(loader_class)
+    loader.column_names = list(loader_class.column_names)
+    loader.columns = {}
+    loader.data = []
+    loader.size = 0
+    inf = textfiles.open_text(filename)
+    for line in textfiles.line_generator(inf):
+        loader.append([x.strip() for x in line.split('|')])
+    inf.close()
+    loader.make_getters()
+    return loader
+
+def stream_load(loader_class, filename):
+    return sum(1 for row in loader_class.stream(filename))
+
+def rows_per_sec(load, rows, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        load()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return rows / max(best, 1e-9)
+
+def load_benchmark(processes=None):
+    """
+    Measures how many rows per second each file loads at: a line at a time
+    as PipeFileLoader used to, a chunk at a time as it does now (and in
+    processes worker processes, if given), and streamed with stream().
+    """
+    results = {}
+    for name, loader, filename in (('blocks', BlockFileLoader, BLOCKS_FILE), ('intersections', IntersectionFileLoader, INTERSECTIONS_FILE)):
+        rows = len(loader(filename))
+        results[name] = {
+            'readline': rows_per_sec(lambda: readline_load(loader, filename), rows),
+            'chunked': rows_per_sec(lambda: loader(filename), rows),
+            'stream': rows_per_sec(lambda: stream_load(loader, filename), rows),
+        }
+        if processes:
+            results[name]['processes'] = rows_per_sec(lambda: loader(filename, processes), rows)
+    return results
+
+def print_load(results):
+    kinds = ['readline', 'chunked', 'processes', 'stream']
+    kinds = [k for k in kinds if all(k in r for r in results.values())]
+    print '%-15s' % 'rows/s' + ''.join('%12s' % k for k in kinds)
+    for name in sorted(results):
+        print '%-15s' % name + ''.join('%12.0f' % results[name][k] for k in kinds)
+
+##################
+# CLASSIFICATION #
+##################
+
+def regex_classifiers():
+    """
+    Returns the (match, bits) pairs that classify_token() used to test
+    every token against, before the suffixes and directionals were looked
+    up in parsing.VOCABULARY_BITS.
+    """
+    directional_re = re.compile(parsing.abbrev_regex(parsing.DIRECTIONALS))
+    regexes = dict(parsing.TOKEN_REGEXES, pre_dir=directional_re, post_dir=directional_re,
+                   suffix=re.compile(parsing.abbrev_regex(suffixes)))
+    classifiers = []
+    for token_type in parsing.TOKEN_TYPES:
+        regex, bits = regexes[token_type], parsing.TOKEN_BITS[token_type]
+        for i, (other_regex, mask) in enumerate(classifiers):
+            if other_regex is regex:
+                classifiers[i] = (regex, mask | bits)
+                break
+        else:
+            classifiers.append((regex, bits))
+    return [(regex.match, bits) for regex, bits in classifiers]
+
+def regex_classify_token(token, classifiers):
+    mask = 0
+    for match, bits in classifiers:
+        if match(token):
+            mask |= bits
+    return mask
+
+class UpperTwiceStandardizer(parsing.Standardizer):
+    def __call__(self, s):
+        # Standardizer.__call__() as it was.
+        if s.upper() in self.replacement:
+            return self.replacement[s.upper()]
+        else:
+            return s
+
+def tokens_per_sec(function, tokens, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for token in tokens:
+            function(token)
+        elapsed = time.time() - start
+        best = best is None and elapsed or min(best, elapsed)
+    return len(tokens) / best
+
+def classify_benchmark(locations):
+    """
+    Measures how many tokens of locations per second are classified, and
+    how many of the suffixes among them are standardized, now and as they
+    used to be.
+    """
+    tokens = []
+    for location in locations:
+        tokens.extend(parsing.punc_split(parsing.normalize(location)))
+    classifiers = regex_classifiers()
+    standardizer = parsing.STANDARDIZERS['suffix']
+    before = UpperTwiceStandardizer(suffixes)
+    suffix_tokens = [token for token in tokens if token in standardizer]
+    for token in tokens:
+        if regex_classify_token(token, classifiers) != parsing.classify_token(token):
+            raise AssertionError('%r is classified differently' % token)
+    return {
+        'classify_regex': tokens_per_sec(lambda token: regex_classify_token(token, classifiers), tokens),
+        'classify_lookup': tokens_per_sec(parsing.classify_token, tokens),
+        'standardize_before': tokens_per_sec(lambda token: before(token), suffix_tokens),
+        'standardize': tokens_per_sec(lambda token: standardizer(token), suffix_tokens),
+    }
+
+def print_classify(results):
+    for name in ('classify_regex', 'classify_lookup', 'standardize_before', 'standardize'):
+        print '%-20s %12.0f tokens/s' % (name, results[name])
+
+##########
+# CORPUS #
+##########
+
+def misspell(word, rng):
+    # Swaps two neighbouring letters, the commonest typo.
+    if len(word) < 5:
+        return word
+    i = rng.randrange(1, len(word) - 2)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+def make_corpus(size=2000, seed=0, misspelled=0.08):
+    """
+    Returns {'addresses': [...], 'intersections': [...]}, size location
+    strings each, drawn from the bundled data with a fixed seed. A fraction
+    of the streets (misspelled) have a typo.
+    """
+    rng = random.Random(seed)
+    blocks = [row for row in BlockFileLoader(BLOCKS_FILE).scan()
+              if row['from_num'] and row['to_num'] and row['street_pretty_name']]
+    addresses = []
+    for row in rng.sample(blocks, min(size, len(blocks))):
+        low, high = sorted((row['from_num'], row['to_num']))
+        street = row['street_pretty_name']
+        if rng.random() < misspelled:
+            street = misspell(street, rng)
+        address = '%d %s' % (rng.randint(low, high), street)
+        if rng.random() < 0.5:
+            address += ', %s, %s' % (row['left_city'].title(), row['left_state'])
+        addresses.append(address)
+
+    rows = [row['pretty_name'] for row in IntersectionFileLoader(INTERSECTIONS_FILE).scan() if row['pretty_name']]
+    intersections = []
+    for name in rng.sample(rows, min(size, len(rows))):
+        if rng.random() < misspelled:
+            name = misspell(name, rng)
+        intersections.append(name)
+    return {'addresses': addresses, 'intersections': intersections}
+
+def make_points(index, size=2000, seed=0):
+    """
+    Returns size (lon, lat) points with a fixed seed: half of them near
+    blocks, as from a GPS, and half anywhere around the city.
+    """
+    rng = random.Random(seed)
+    points = []
+    for i in xrange(size):
+        if i % 2:
+            points.append((rng.uniform(-71.2, -70.95), rng.uniform(42.2, 42.42)))
+        else:
+            lon, lat = rng.choice(index.blocks).interpolate(rng.random())
+            points.append((lon + rng.uniform(-0.0005, 0.0005), lat + rng.uniform(-0.0005, 0.0005)))
+    return points
+
+def make_keystrokes(locations, size=2000, seed=0):
+    """
+    Returns size partly typed locations with a fixed seed, as a search box
+    would see them: a prefix of a location, up to any city.
+    """
+    rng = random.Random(seed)
+    keystrokes = []
+    for i in xrange(size):
+        location = rng.choice(locations).split(',')[0]
+        keystrokes.append(location[:rng.randint(1, len(location))])
+    return keystrokes
+
+def load_corpus(filename):
+    """
+    Returns the location strings in filename: either the cf_addrs module
+    that parser/make_cf_tests.py prints, or one location per line.
+    """
+    text = open(filename).read()
+    if text.lstrip().startswith('cf_addrs'):
+        namespace = {}
+        exec text in namespace
+        return sorted(namespace['cf_addrs'])
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+#############
+# MEASURING #
+#############
+
+def latency(samples):
+    """
+    Summarizes a list of durations in seconds as microseconds.
+    """
+    samples = sorted(samples)
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(p / 100.0 * len(samples)))] * 1e6
+    return {'mean': sum(samples) / len(samples) * 1e6, 'p50': percentile(50), 'p90': percentile(90),
+            'p99': percentile(99), 'max': samples[-1] * 1e6}
+
+def call_latency(function, calls):
+    """
+    Calls function with each tuple of arguments in calls, returning the
+    latency summary.
+    """
+    samples = []
+    for args in calls:
+        start = time.time()
+        function(*args)
+        samples.append(time.time() - start)
+    return latency(samples)
+
+def parse_benchmark(locations, repeat=3):
+    """
+    Returns the best of repeat runs of parse() over locations, in
+    locations per second, with the parse cache off.
+    """
+    parsing.disable_cache()
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for location in locations:
+            try:
+                parsing.parse(location)
+            except parsing.ParsingError:
+                pass
+        elapsed = time.time() - start
+        best = best is None and elapsed or min(best, elapsed)
+    return len(locations) / best
+
+def lookup_benchmark(geocoder, locations):
+    """
+    Geocodes each location, returning its latency summary and the
+    fraction that were found.
+    """
+    samples = []
+    found = 0
+    for location in locations:
+        start = time.time()
+        try:
+            geocoder.geocode(location)
+            found += 1
+        except (GeocoderException, parsing.ParsingError):
+            pass
+        samples.append(time.time() - start)
+    return latency(samples), float(found) / len(locations)
+
+def geocoder_from_files():
+    return LocalGeocoder.from_files(BLOCKS_FILE, INTERSECTIONS_FILE)
+
+def git_commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=DATA_DIR, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+# How far around each point the spatial searches look: meters for
+# within_radius(), degrees either way for within_bbox().
+SEARCH_RADIUS = 250
+SEARCH_BOX = 0.002
+
+# Which way each kind of measurement should move.
+HIGHER_IS_BETTER = ('per_sec', 'found')
+
+def run_benchmarks(size=2000, seed=0, corpora=(), only=None):
+    """
+    Runs the benchmarks (all of them, or those named in only) and returns
+    {'meta': {...}, 'metrics': {name: value}}.
+    """
+    def wanted(name):
+        return only is None or name in only
+    corpus = make_corpus(size, seed)
+    extra = []
+    for filename in corpora:
+        extra.extend(load_corpus(filename))
+    metrics = {}
+
+    if wanted('parse'):
+        metrics['parse_per_sec'] = parse_benchmark(corpus['addresses'] + corpus['intersections'] + extra)
+        if extra:
+            metrics['parse_corpus_per_sec'] = parse_benchmark(extra)
+    if wanted('classify'):
+        results = classify_benchmark(corpus['addresses'] + corpus['intersections'] + extra)
+        metrics['classify_tokens_per_sec'] = results['classify_lookup']
+        metrics['standardize_tokens_per_sec'] = results['standardize']
+    if wanted('blocks') or wanted('intersections'):
+        geocoder = geocoder_from_files()
+        # Warm up, so the first lookups don't pay for imports and caches.
+        lookup_benchmark(geocoder, corpus['addresses'][:50] + corpus['intersections'][:50])
+        for name in ('blocks', 'intersections'):
+            if wanted(name):
+                locations = name == 'blocks' and corpus['addresses'] or corpus['intersections']
+                stats, found = lookup_benchmark(geocoder, locations)
+                for k, v in stats.items():
+                    metrics['%s_%s_us' % (name, k)] = v
+                metrics['%s_found' % name] = found
+    if wanted('reverse') or wanted('spatial'):
+        index = spatial.SpatialIndex.from_files(BLOCKS_FILE, INTERSECTIONS_FILE)
+        points = make_points(index, size, seed)
+        if wanted('reverse'):
+            for k, v in call_latency(spatial.ReverseGeocoder(index).reverse_geocode, points).items():
+                metrics['reverse_%s_us' % k] = v
+        if wanted('spatial'):
+            searcher = spatial.SpatialSearcher(index)
+            # The searches are generators, so time finding everything.
+            radius = lambda lon, lat: list(searcher.within_radius(lon, lat, SEARCH_RADIUS))
+            bbox = lambda lon, lat: list(searcher.within_bbox(lon - SEARCH_BOX, lat - SEARCH_BOX, lon + SEARCH_BOX, lat + SEARCH_BOX))
+            for name, search in (('radius', radius), ('bbox', bbox)):
+                for k, v in call_latency(search, points).items():
+                    metrics['spatial_%s_%s_us' % (name, k)] = v
+    if wanted('autocomplete'):
+        index = autocomplete.AutocompleteIndex.from_files(BLOCKS_FILE, INTERSECTIONS_FILE)
+        keystrokes = make_keystrokes(corpus['addresses'] + corpus['intersections'], size, seed)
+        for k, v in call_latency(index.complete, [(text,) for text in keystrokes]).items():
+            metrics['autocomplete_%s_us' % k] = v
+    if wanted('startup'):
+        for name, r in startup_benchmark().items():
+            metrics['startup_%s_text_s' % name] = r['text_seconds']
+            metrics['startup_%s_snapshot_s' % name] = r['snapshot_seconds']
+    if wanted('memory'):
+        metrics['peak_memory_geocoder_bytes'] = measure_memory(geocoder_from_files)
+    if wanted('load'):
+        for name, r in load_benchmark().items():
+            for kind, value in r.items():
+                metrics['load_%s_%s_rows_per_sec' % (name, kind)] = value
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'corpus': {'size': size, 'seed': seed, 'files': list(corpora)},
+        },
+        'metrics': metrics,
+    }
+
+def compare(old, new, threshold=0.1):
+    """
+    Returns (name, old value, new value, relative change, regressed) for
+    every metric in both runs.
+    """
+    rows = []
+    for name in sorted(set(old['metrics']) & set(new['metrics'])):
+        a, b = old['metrics'][name], new['metrics'][name]
+        change = a and (b - a) / float(a) or 0.0
+        if name.endswith(HIGHER_IS_BETTER):
+            regressed = change < -threshold
+        else:
+            regressed = change > threshold
+        rows.append((name, a, b, change, regressed))
+    return rows
+
+def print_metrics(results):
+    print 'commit %s, python %s' % (results['meta']['commit'], results['meta']['python'])
+    for name, value in sorted(results['metrics'].items()):
+        print '%-36s %14.3f' % (name, value)
+
+def print_comparison(rows):
+    print '%-36s %14s %14s %8s' % ('metric', 'before', 'after', 'change')
+    for name, a, b, change, regressed in rows:
+        print '%-36s %14.3f %14.3f %+7.1f%%%s' % (name, a, b, change * 100, regressed and '  WORSE' or '')
+
+def main(argv):
+    if argv[:1] == ['memory']:
+        print_memory(memory_benchmark())
+    elif argv[:1] == ['startup']:
+        print_startup(startup_benchmark())
+    elif argv[:1] == ['load']:
+        parser = argparse.ArgumentParser(prog='benchmark.py load')
+        parser.add_argument('--processes', type=int, help='also load with this many worker processes')
+        options = parser.parse_args(argv[1:])
+        print_load(load_benchmark(options.processes))
+    elif argv[:1] == ['classify']:
+        print_classify(classify_benchmark(sum(make_corpus().values(), [])))
+    elif argv[:1] == ['run']:
+        parser = argparse.ArgumentParser(prog='benchmark.py run')
+        parser.add_argument('--json', help='file to write the results to')
+        parser.add_argument('--corpus', action='append', default=[], help='extra file of locations to parse')
+        parser.add_argument('--size', type=int, default=2000, help='locations of each kind to generate (default: 2000)')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--only', help='comma-separated benchmarks: parse, classify, blocks, intersections, reverse, spatial, autocomplete, startup, memory, load')
+        options = parser.parse_args(argv[1:])
+        results = run_benchmarks(options.size, options.seed, options.corpus, options.only and options.only.split(','))
+        if options.json:
+            outf = open(options.json, 'w')
+            json.dump(results, outf, indent=2, sort_keys=True)
+            outf.close()
+        print_metrics(results)
+    elif argv[:1] == ['compare']:
+        parser = argparse.ArgumentParser(prog='benchmark.py compare')
+        parser.add_argument('before')
+        parser.add_argument('after')
+        parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression (default: 0.1)')
+        options = parser.parse_args(argv[1:])
+        rows = compare(json.load(open(options.before)), json.load(open(options.after)), options.threshold)
+        print_comparison(rows)
+        if [row for row in rows if row[-1]]:
+            sys.exit(1)
+    else:
+        print __doc__
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,283 @@
+"""
+A cache of geocoding results in a local SQLite file, standing in for
+Openblock's GeocoderCache model.
+
+Entries are keyed on the normalized location string, and which of the
+address, block and intersection geocoders it goes to. They hold the
+result or the failure (e.g. DoesNotExist), so that locations which can't
+be geocoded aren't searched for again either, as JSON rather than pickles,
+since loading a pickle from a shared file could run anything. They expire
+after ttl seconds (negative_ttl for failures).
+
+    geocoder = LocalGeocoder(cxn, cache=GeocodeCache('geocodes.db'))
+
+To fill a cache ahead of time from a CSV or JSON-lines file of locations,
+or to drop expired entries:
+
+    python cache.py geocodes.db warm --column address in.csv
+    python cache.py geocodes.db purge
+    python cache.py geocodes.db stats
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from djeocoder import GeocoderException, InvalidBlockButValidStreet, DoesNotExist, AmbiguousResult, PostgisResult
+from djeocoder import block_re, intersection_re
+from parser.parsing import normalize, ParsingError
+from results import IntersectionResult
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Thirty days.
+DEFAULT_TTL = 30 * 24 * 60 * 60
+
+# SQLite's default limit on parameters per statement is 999.
+QUERY_CHUNK = 500
+
+# The failures that are cached, by name.
+ERRORS = dict((cls.__name__, cls) for cls in
+              (GeocoderException, InvalidBlockButValidStreet, DoesNotExist, AmbiguousResult, ParsingError))
+
+def cache_key(location):
+    """
+    Returns the key for location: the geocoder LocalGeocoder would use for
+    it and the normalized string. An intersection's sides are normalized
+    separately, as normalizing drops some of the words that separate them.
+
+    >>> cache_key('  24 tobin rd. ')
+    u'address:24 TOBIN RD'
+    >>> cache_key('Tobin Rd @ Kerna Rd')
+    u'intersection:TOBIN RD & KERNA RD'
+    >>> cache_key('Tobin Rd Kerna Rd')
+    u'address:TOBIN RD KERNA RD'
+    """
+    if intersection_re.search(location):
+        key = 'intersection:' + ' & '.join(normalize(side) for side in intersection_re.split(location))
+    elif block_re.search(location):
+        key = 'block:' + normalize(location)
+    else:
+        key = 'address:' + normalize(location)
+    if isinstance(key, str):
+        key = key.decode('utf-8', 'replace')
+    return key
+
+def encode_result(result):
+    """
+    Returns a PostgisResult's fields, as JSON can hold them.
+    """
+    if result is None:
+        return None
+    fields = dict(result.__dict__)
+    intersection = fields.get('intersection')
+    if intersection is not None:
+        fields['intersection'] = [intersection.id, intersection.pretty_name, intersection.location,
+                                  intersection.zip, intersection.city, intersection.state]
+    return fields
+
+def decode_result(fields):
+    if fields is None:
+        return None
+    if fields.get('point') is not None:
+        fields['point'] = tuple(fields['point'])
+    if fields.get('intersection') is not None:
+        intersection = fields['intersection']
+        intersection[2] = tuple(intersection[2])
+        fields['intersection'] = IntersectionResult(intersection)
+    return PostgisResult(**dict((str(k), v) for k, v in fields.items()))
+
+def encode_error(error):
+    if error is None:
+        return None
+    fields = {'type': error.__class__.__name__, 'message': str(error).decode('utf-8', 'replace')}
+    if isinstance(error, AmbiguousResult):
+        fields['choices'] = [encode_result(choice) for choice in error.choices]
+    return fields
+
+def decode_error(fields):
+    """
+    Rebuilds the exception encode_error() took apart (as a
+    GeocoderException, if it's of a kind that isn't cached).
+    """
+    if fields is None:
+        return None
+    cls = ERRORS.get(fields['type'], GeocoderException)
+    error = cls.__new__(cls)
+    error.args = (fields['message'].encode('utf-8'),)
+    if 'choices' in fields:
+        error.choices = [decode_result(choice) for choice in fields['choices']]
+    return error
+
+class GeocodeCache:
+    """
+    Stores (result, error) pairs for location strings, where error is the
+    exception that geocoding raised (and result is None) or None.
+    """
+    def __init__(self, filename, ttl=DEFAULT_TTL, negative_ttl=None):
+        self.filename = filename
+        self.ttl = ttl
+        if negative_ttl is None:
+            negative_ttl = ttl
+        self.negative_ttl = negative_ttl
+        # Worker processes and threads can share a file; SQLite does the locking
+        # between processes, and self.lock between threads.
+        self.conn = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn.execute('''create table if not exists geocodes (
+            location text primary key,
+            address text,
+            longitude real,
+            latitude real,
+            error_type text,
+            error_message text,
+            value text not null,
+            expires real not null)''')
+        self.conn.commit()
+
+    def get(self, location):
+        """
+        Returns the cached (result, error) for location, or None if there
+        isn't an unexpired one.
+        """
+        return self.get_many([location]).get(location)
+
+    def get_many(self, locations):
+        """
+        Returns a dict of location -> (result, error) for those of the
+        locations that have unexpired entries.
+        """
+        keys = {}
+        for location in locations:
+            keys.setdefault(cache_key(location), []).append(location)
+        found = {}
+        now = time.time()
+        unique = keys.keys()
+        with self.lock:
+            for start in xrange(0, len(unique), QUERY_CHUNK):
+                chunk = unique[start:start + QUERY_CHUNK]
+                rows = self.conn.execute('select location, value from geocodes where expires > ? and location in (%s)'
+                                         % ','.join('?' * len(chunk)), [now] + chunk)
+                for key, value in rows:
+                    value = json.loads(value)
+                    entry = decode_result(value['result']), decode_error(value['error'])
+                    for location in keys[key]:
+                        found[location] = entry
+        hits = sum(1 for location in locations if location in found)
+        self.hits += hits
+        self.misses += len(locations) - hits
+        return found
+
+    def put(self, location, result, error=None):
+        self.put_many([(location, result, error)])
+
+    def put_many(self, entries):
+        """
+        Stores an iterable of (location, result, error) triples.
+        """
+        now = time.time()
+        rows = []
+        for location, result, error in entries:
+            point = getattr(result, 'point', None)
+            if isinstance(point, tuple):
+                longitude, latitude = point
+            else:
+                longitude = latitude = None
+            rows.append((
+                cache_key(location),
+                getattr(result, 'address', None),
+                longitude, latitude,
+                error is not None and error.__class__.__name__ or None,
+                error is not None and str(error).decode('utf-8', 'replace') or None,
+                json.dumps({'result': encode_result(result), 'error': encode_error(error)}),
+                now + (self.ttl if error is None else self.negative_ttl),
+            ))
+        with self.lock:
+            self.conn.executemany('insert or replace into geocodes values (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.conn.commit()
+
+    def purge(self):
+        """
+        Deletes the expired entries, returning how many there were.
+        """
+        with self.lock:
+            deleted = self.conn.execute('delete from geocodes where expires <= ?', (time.time(),)).rowcount
+            self.conn.commit()
+        return deleted
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('delete from geocodes')
+            self.conn.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('select count(*) from geocodes where expires > ?', (time.time(),)).fetchone()[0]
+
+    def stats(self):
+        with self.lock:
+            rows = self.conn.execute('select error_type, count(*) from geocodes where expires > ? group by error_type',
+                                     (time.time(),)).fetchall()
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': dict((error_type or 'OK', count) for error_type, count in rows)}
+
+    def close(self):
+        self.conn.close()
+
+def warm(geocoder, inf, format='csv', column='location', chunk_size=1000):
+    """
+    Geocodes every location read from inf through geocoder (which should
+    have a cache), returning how many were read.
+    """
+    import stream
+    reader = stream.FORMATS[format](inf, column)
+    count = 0
+    for offset, chunk in stream.geocode_stream(geocoder, reader.records(), chunk_size):
+        count = offset
+    return count
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Manage a geocode result cache.')
+    parser.add_argument('cache', help='SQLite cache file')
+    parser.add_argument('command', choices=['warm', 'purge', 'stats'])
+    parser.add_argument('input', nargs='?', help='for warm: input file (default: stdin)')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help='input format (default: from the file extension, else csv)')
+    parser.add_argument('--column', default='location', help='field holding the location string (default: location)')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--ttl', type=float, default=DEFAULT_TTL, help='seconds before entries expire (default: 30 days)')
+    parser.add_argument('--negative-ttl', type=float, help='seconds before failures expire (default: --ttl)')
+    parser.add_argument('--dsn', help='PostGIS connection string; without it, searches the files below in memory')
+    parser.add_argument('--blocks', default=os.path.join(DATA_DIR, 'blocks.txt.gz'))
+    parser.add_argument('--intersections', default=os.path.join(DATA_DIR, 'intersections.txt.gz'))
+    options = parser.parse_args(argv)
+
+    cache = GeocodeCache(options.cache, options.ttl, options.negative_ttl)
+    try:
+        if options.command == 'purge':
+            print 'Deleted %d expired entries' % cache.purge()
+        elif options.command == 'stats':
+            for name, count in sorted(cache.stats()['entries'].items()):
+                print '%-30s %d' % (name, count)
+        else:
+            from djeocoder import LocalGeocoder
+            if options.dsn:
+                import psycopg2
+                geocoder = LocalGeocoder(psycopg2.connect(options.dsn), cache=cache)
+            else:
+                geocoder = LocalGeocoder.from_files(options.blocks, options.intersections, cache=cache)
+            format = options.format
+            if format is None:
+                format = options.input and options.input.endswith(('.jsonl', '.json')) and 'jsonl' or 'csv'
+            inf = options.input and open(options.input, 'rb') or sys.stdin
+            count = warm(geocoder, inf, format, options.column, options.chunk_size)
+            print 'Read %d locations, %d already cached' % (count, cache.hits)
+    finally:
+        cache.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
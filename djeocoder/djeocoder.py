@@ -4,14 +4,29 @@ from parser.parsing import normalize, parse, ParsingError
 import re
 
 # from streets import Block, StreetMisspelling, Intersection
-# from geocoder_models import GeocoderCache
 
-from postgis import PostgisBlockSearcher, PostgisIntersectionSearcher, SpellingCorrector
+import instrument
+from memory import MemoryBlockSearcher, MemoryIntersectionSearcher
+from postgis import PostgisBlockSearcher, PostgisIntersectionSearcher
+from spatial import ReverseGeocoder, SpatialIndex
+from spelling import SpellingCorrector, StreetCorrector
 
 class GeocoderException(Exception):
     def __init__(self, msg):
         Exception.__init__(self, msg)
 
+    def __reduce__(self):
+        # The subclasses' __init__ arguments aren't their args, so the default
+        # pickling can't rebuild them (e.g. when passing results between
+        # processes in parallel.py).
+        return (_rebuild_exception, (self.__class__, self.args, self.__dict__))
+
+def _rebuild_exception(cls, args, state):
+    e = cls.__new__(cls)
+    e.args = args
+    e.__dict__.update(state)
+    return e
+
 class InvalidBlockButValidStreet(GeocoderException):
     def __init__(self, number, street_name, block_list):
         GeocoderException.__init__(self, '%s on street %s ? : %s' % (number, street_name, str(block_list)))
@@ -20,60 +35,259 @@ class DoesNotExist(GeocoderException):
     def __init__(self, msg):
         GeocoderException.__init__(self, msg)
 
+class AmbiguousResult(GeocoderException):
+    def __init__(self, choices, msg=None):
+        self.choices = choices
+        if msg is None:
+            msg = "Geocoder db returned %s results" % len(choices)
+        GeocoderException.__init__(self, msg)
+
+def parse_location(location):
+    """
+    parse(), with normalizing and parsing timed separately.
+    """
+    with instrument.timer('normalize'):
+        normalized = normalize(location)
+    with instrument.timer('parse'):
+        locations = parse(location, normalized)
+    instrument.count('candidate_parses', len(locations))
+    return locations
+
 block_re = re.compile(r'^(\d+)[-\s]+(?:blk|block)\s+(?:of\s+)?(.*)$', re.IGNORECASE)
 intersection_re = re.compile(r'(?<=.) (?:and|\&|at|near|@|around|towards?|off|/|(?:just )?(?:north|south|east|west) of|(?:just )?past) (?=.)', re.IGNORECASE)
 
 class LocalGeocoder:
-    def __init__(self, cxn):
+    """
+    Picks the right geocoder for a location string: intersection, block or
+    address.
+
+    By default the geocoders search the PostGIS tables through cxn, but any
+    searchers with the same search() method (e.g. the ones in memory.py) can
+    be passed in instead.
+
+    Misspelled streets are corrected by spelling, which by default is a
+    spelling.StreetCorrector over the block searcher's street names.
+
+    If cache (a cache.GeocodeCache, which replaces Openblock's GeocoderCache
+    model) is given, results and failures are looked up there first and
+    stored there after.
+    """
+    def __init__(self, cxn, block_searcher=None, intersection_searcher=None, spelling=None, cache=None):
         self.cxn = cxn
-    def geocode(self, location):
+        self.cache = cache
+        self.block_searcher = block_searcher or PostgisBlockSearcher(cxn)
+        self.intersection_searcher = intersection_searcher or PostgisIntersectionSearcher(cxn)
+        # Whether spelling is ours, to rebuild when the streets change.
+        self.own_spelling = spelling is None
+        if spelling is None:
+            if hasattr(self.block_searcher, 'street_names'):
+                spelling = StreetCorrector.from_searcher(self.block_searcher)
+            else:
+                spelling = SpellingCorrector()
+        self.spelling = spelling
+        self.reverse_geocoder = None
+
+    @classmethod
+    def from_files(cls, blocks_file, intersections_file, **kwargs):
+        """
+        Returns a LocalGeocoder that needs no database, searching in-memory
+        indexes of the pipe-delimited blocks and intersections dumps.
+        """
+        return cls(None, MemoryBlockSearcher.from_file(blocks_file), MemoryIntersectionSearcher.from_file(intersections_file), **kwargs)
+
+    def geocoder_for(self, location, block_searcher=None, intersection_searcher=None):
+        block_searcher = block_searcher or self.block_searcher
+        intersection_searcher = intersection_searcher or self.intersection_searcher
         if intersection_re.search(location):
             #raise GeocoderException('Intersection geocoding not implemented')
-            geocoder = PostgisIntersectionGeocoder(self.cxn)
+            return PostgisIntersectionGeocoder(self.cxn, intersection_searcher, self.spelling)
 
         elif block_re.search(location):
             #raise GeocoderException('Block geocoding not implemented')
-            geocoder = PostgisBlockGeocoder(self.cxn)
+            return PostgisBlockGeocoder(self.cxn, block_searcher, self.spelling)
 
         else:
-            geocoder = PostgisAddressGeocoder(self.cxn)
+            return PostgisAddressGeocoder(self.cxn, block_searcher, self.spelling)
 
-        return geocoder.geocode(location)
+    def geocode(self, location):
+        with instrument.timer('geocode'):
+            return self._geocode(location)
+
+    def _geocode(self, location):
+        if self.cache is None:
+            return self.geocoder_for(location).geocode(location)
+        with instrument.timer('cache'):
+            cached = self.cache.get(location)
+        if cached is None:
+            instrument.count('cache_misses')
+            try:
+                result = self.geocoder_for(location).geocode(location)
+            except (GeocoderException, ParsingError), e:
+                self.cache.put(location, None, e)
+                raise
+            self.cache.put(location, result)
+            return result
+        instrument.count('cache_hits')
+        result, error = cached
+        if error is not None:
+            raise error
+        return result
+
+    def apply_deltas(self, blocks_file=None, intersections_file=None):
+        """
+        Applies delta files (see textfiles.read_deltas()) to the in-memory
+        searchers, without reloading them. Afterwards the default spelling
+        corrector is rebuilt with the new street names, the cache is
+        cleared and the spatial index for reverse_geocode() is rebuilt the
+        next time it's needed. Geocodes already under way finish against
+        the old data.
+
+        Both files are read and checked before either searcher changes, so
+        if one of them is bad (raising textfiles.DeltaError), neither is
+        applied.
+        """
+        with self.block_searcher.lock:
+            with self.intersection_searcher.lock:
+                blocks = blocks_file and self.block_searcher.updated_file(blocks_file)
+                intersections = intersections_file and self.intersection_searcher.updated_file(intersections_file)
+                try:
+                    if blocks:
+                        self.block_searcher.swap(blocks)
+                        if self.own_spelling and hasattr(self.block_searcher, 'street_names'):
+                            self.spelling = StreetCorrector.from_searcher(self.block_searcher)
+                    if intersections:
+                        self.intersection_searcher.swap(intersections)
+                finally:
+                    if self.cache is not None:
+                        self.cache.clear()
+                    self.reverse_geocoder = None
+
+    def reverse_geocode(self, lon, lat, max_distance=None):
+        """
+        Returns (block, intersection), the nearest BlockResult (with its
+        interpolated house number) and IntersectionResult to a point; see
+        spatial.ReverseGeocoder. The spatial index is built from the
+        in-memory searchers the first time it's needed.
+        """
+        if self.reverse_geocoder is None:
+            if not (isinstance(self.block_searcher, MemoryBlockSearcher) and
+                    isinstance(self.intersection_searcher, MemoryIntersectionSearcher)):
+                raise GeocoderException('Reverse geocoding needs the in-memory searchers (see from_files())')
+            self.reverse_geocoder = ReverseGeocoder(SpatialIndex.from_searchers(self.block_searcher, self.intersection_searcher))
+        return self.reverse_geocoder.reverse_geocode(lon, lat, max_distance)
+
+    def geocode_many(self, locations, batch_size=1000):
+        """
+        Geocodes an iterable of location strings, yielding a
+        (location, result, error) triple for each, in input order. error is
+        the GeocoderException or ParsingError that geocode() would have
+        raised, in which case result is None.
+
+        When the searchers are the PostGIS ones, each batch of batch_size
+        locations fetches its blocks and its intersections with one query
+        each, and the lookups themselves are done in memory. With a cache,
+        only the locations it doesn't have are searched for.
+        """
+        batch = []
+        for location in locations:
+            batch.append(location)
+            if len(batch) >= batch_size:
+                for item in self._geocode_batch(batch):
+                    yield item
+                batch = []
+        for item in self._geocode_batch(batch):
+            yield item
+
+    def _geocode_batch(self, locations):
+        if self.cache is None:
+            return self._search_batch(locations)
+        with instrument.timer('cache'):
+            cached = self.cache.get_many(locations)
+        misses = [location for location in locations if location not in cached]
+        instrument.count('cache_hits', len(locations) - len(misses))
+        instrument.count('cache_misses', len(misses))
+        searched = list(self._search_batch(misses))
+        self.cache.put_many(searched)
+        for location, result, error in searched:
+            cached[location] = (result, error)
+        return ((location,) + cached[location] for location in locations)
+
+    def _search_batch(self, locations):
+        block_searcher = intersection_searcher = None
+        if hasattr(self.block_searcher, 'search_streets'):
+            with instrument.timer('prefetch'):
+                block_streets, intersection_streets = self.streets_for(locations)
+                block_searcher = MemoryBlockSearcher(self.block_searcher.search_streets(block_streets))
+                intersection_searcher = MemoryIntersectionSearcher(self.intersection_searcher.search_streets(intersection_streets))
+
+        for location in locations:
+            try:
+                geocoder = self.geocoder_for(location, block_searcher, intersection_searcher)
+                with instrument.timer('geocode'):
+                    result = geocoder.geocode(location)
+            except (GeocoderException, ParsingError), e:
+                yield location, None, e
+            else:
+                yield location, result, None
+
+    def streets_for(self, locations):
+        """
+        Returns the set of streets that geocoding the locations could search
+        for blocks on, and the set it could search for intersections on,
+        including their spelling corrections.
+        """
+        return streets_for(locations, self.spelling)
+
+def streets_for(locations, spelling):
+    block_streets = set()
+    intersection_streets = set()
+    for location in locations:
+        if intersection_re.search(location):
+            sides = intersection_re.split(location)
+            streets = intersection_streets
+        else:
+            m = block_re.search(location)
+            sides = [m and ' '.join(m.groups()) or location]
+            streets = block_streets
+        for side in sides:
+            try:
+                for loc in parse_location(side):
+                    if loc['street']:
+                        streets.add(loc['street'])
+                        streets.add(spelling.correct(loc['street']).correct)
+            except ParsingError:
+                pass
+    return block_streets, intersection_streets
 
 class PostgisAddressGeocoder:
     """
     A replacement for AddressGeocoder from Openblock
     """
-    def __init__(self, cxn):
+    def __init__(self, cxn, block_searcher=None, spelling=None):
         self.connection = cxn
-        self.spelling = SpellingCorrector()
+        self.spelling = spelling or SpellingCorrector()
+        self.block_searcher = block_searcher or PostgisBlockSearcher(cxn)
 
     def geocode(self, location_string):
         # Parse the address.
         try:
-            locations = parse(location_string)
+            locations = parse_location(location_string)
         except ParsingError, e:
             raise
 
         all_results = []
         for loc in locations:
             loc_results = self._db_lookup(loc)
-            print 'Initial loc_results: %s -> %s' % (str(loc), str(loc_results))
 
             # If none were found, maybe the street was misspelled. Check that.
             if (not loc_results) and loc['street']:
-                try:
-                    # Originally, StreetMisspelling.objects would hit the database for a list of corrected
-                    # street names.  Now, we route this through an interface instead.  
-                    # 
-                    # misspelling = StreetMisspelling.objects.get(incorrect=loc['street'])
-                    #   -> should return, now, a Correction object.
+                # Originally, StreetMisspelling.objects would hit the database for a list of corrected
+                # street names.  Now, we route this through an interface instead, which hands back
+                # the street unchanged when it has no correction.
+                with instrument.timer('spelling'):
                     misspelling = self.spelling.correct(incorrect=loc['street'])
+                if misspelling.correct != loc['street']:
                     loc['street'] = misspelling.correct
-                    
-                except StreetMisspelling.DoesNotExist:
-                    pass
-                else:
                     loc_results = self._db_lookup(loc)
                 
                 # Next, try removing the street suffix, in case an incorrect
@@ -95,9 +309,7 @@ class PostgisAddressGeocoder:
                         # DJANGOism: replace
                         # b_list = Block.objects.filter(*sided_filters, **kwargs).order_by('predir', 'from_num', 'to_num')
                         
-                        searcher = PostgisBlockSearcher(self.connection)
-                        b_list = searcher.search(**kwargs)
-                        searcher.close()
+                        b_list = self.block_searcher.search(**kwargs)
 
                         if b_list: raise InvalidBlockButValidStreet(loc['number'], b_list[0].pretty_name, b_list)
 
@@ -120,10 +332,9 @@ class PostgisAddressGeocoder:
             return []
 
         # Query the blocks table in the database.
-        searcher = PostgisBlockSearcher(self.connection)
         # print location.keys()
-        blocks = searcher.search(**location)
-        searcher.close()
+        with instrument.timer('block_search'):
+            blocks = self.block_searcher.search(**location)
         
         return [self._build_result(location, block_result) for block_result in blocks]
 
@@ -133,7 +344,7 @@ class PostgisAddressGeocoder:
         # by values returned from the DB itself (normalization).  We should probably add that
         # back in here.
         return PostgisResult(**{
-            'address': unicode(" ".join([str(s) for s in [location['number'], location['predir'], block.pretty_name, location['postdir']] if s])),
+            'address': unicode(" ".join([str(s) for s in [location['number'], location['pre_dir'], block.pretty_name, location['post_dir']] if s])),
             'city': location['city'],
             'state': location['state'],
             'zip': location['zip'],
@@ -148,8 +359,8 @@ class PostgisBlockGeocoder(PostgisAddressGeocoder):
     """
     Copied from ebpub.base.BlockGeocoder
     """
-    def _do_geocode(self, location_string):
-        m = block_re.search(locationstring)
+    def geocode(self, location_string):
+        m = block_re.search(location_string)
         if not m:
             # TODO: replace with Block-specific exception
             raise ParsingError("BlockGeocoder somehow got an address it can't parse: %r" % location_string)
@@ -160,9 +371,10 @@ class PostgisIntersectionGeocoder:
     """
     A replacement for ebpub.base.IntersectionGeocoder
     """
-    def __init__(self, cxn):
+    def __init__(self, cxn, intersection_searcher=None, spelling=None):
         self.connection = cxn
-        self.spelling = SpellingCorrector()
+        self.spelling = spelling or SpellingCorrector()
+        self.intersection_searcher = intersection_searcher or PostgisIntersectionSearcher(cxn)
 
     def geocode(self, location_string):
         sides = intersection_re.split(location_string)
@@ -171,18 +383,20 @@ class PostgisIntersectionGeocoder:
 
         # Parse each side of the intersection to a list of possibilities.
         # Let the ParseError exception propagate, if it's raised.
-        left_side = parse(sides[0])
-        right_side = parse(sides[1])
+        left_side = parse_location(sides[0])
+        right_side = parse_location(sides[1])
 
         all_results = []
         seen_intersections = set()
         for street_a in left_side:
-            street_a['street'] = self.spelling.correct(street_a['street'])
+            with instrument.timer('spelling'):
+                street_a['street'] = self.spelling.correct(street_a['street']).correct
             for street_b in right_side:
-                street_b['street'] = self.spelling.correct(street_b['street'])
+                with instrument.timer('spelling'):
+                    street_b['street'] = self.spelling.correct(street_b['street']).correct
                 for result in self._db_lookup(street_a, street_b):
-                    if result["intersection_id"] not in seen_intersections:
-                        seen_intersections.add(result["intersection_id"])
+                    if result.intersection_id not in seen_intersections:
+                        seen_intersections.add(result.intersection_id)
                         all_results.append(result)
 
         if not all_results:
@@ -194,18 +408,17 @@ class PostgisIntersectionGeocoder:
 
     def _db_lookup(self, street_a, street_b):
         try:
-            searcher = PostgisIntersectionSearcher(self.connection)
-            intersections = searcher.search(
-                predir_a=street_a['pre_dir'],
-                street_a=street_a['street'],
-                suffix_a=street_a['suffix'],
-                postdir_a=street_a['post_dir'],
-                predir_b=street_b['pre_dir'],
-                street_b=street_b['street'],
-                suffix_b=street_b['suffix'],
-                postdir_b=street_b['post_dir'],
-            )
-            searcher.close()
+            with instrument.timer('intersection_search'):
+                intersections = self.intersection_searcher.search(
+                    predir_a=street_a['pre_dir'],
+                    street_a=street_a['street'],
+                    suffix_a=street_a['suffix'],
+                    postdir_a=street_a['post_dir'],
+                    predir_b=street_b['pre_dir'],
+                    street_b=street_b['street'],
+                    suffix_b=street_b['suffix'],
+                    postdir_b=street_b['post_dir'],
+                )
         # except Exception, e:
         except DoesNotExist, e:
             raise DoesNotExist("Intersection db query failed: %r" % e)
@@ -221,8 +434,6 @@ class PostgisIntersectionGeocoder:
             'intersection': intersection,
             'block': None,
             'point': intersection.location,
-            'url': intersection.url(),
-            'wkt': str(intersection.location),
         })
 
 class PostgisResult(object): 
@@ -0,0 +1,206 @@
+"""
+Just enough planar geometry to do block interpolation in Python rather than
+in PostGIS.
+
+Interpolation follows PostGIS's line_interpolate_point(): lengths are
+measured in the plane of the coordinates (degrees, for SRID 4326), so the
+results agree with PostGIS to within floating-point rounding. We treat
+anything within INTERPOLATION_TOLERANCE degrees (about a tenth of a
+millimeter) as the same point; ST_AsEWKT() itself only prints 15
+significant digits.
+"""
+import bisect
+import math
+import re
+
+INTERPOLATION_TOLERANCE = 1e-9
+
+linestring_pattern = re.compile(r'LINESTRING\s*\(([^)]*)\)')
+
+class GeometryParsingException(Exception):
+    def __init__(self, str):
+        self.str = str
+    def __repr__(self):
+        return 'String \'%s\' could not be parsed into a linestring.' % self.str
+
+def parse_linestring(wkt_str):
+    """
+    Parses a (E)WKT LINESTRING into a list of (x, y) coordinate pairs.
+
+    >>> parse_linestring('SRID=4326;LINESTRING(-71.15591 42.262545,-71.155487 42.262962)')
+    [(-71.15591, 42.262545), (-71.155487, 42.262962)]
+    """
+    matcher = linestring_pattern.search(wkt_str)
+    if matcher == None: raise GeometryParsingException(wkt_str)
+    coords = []
+    for pair in matcher.group(1).split(','):
+        x, y = pair.split()
+        coords.append((float(x), float(y)))
+    if not coords: raise GeometryParsingException(wkt_str)
+    return coords
+
+def point_wkt(x, y, srid=4326):
+    """
+    Formats a point as EWKT, the way ST_AsEWKT() would.
+
+    >>> point_wkt(-71.15591, 42.262545)
+    'SRID=4326;POINT(-71.15591 42.262545)'
+    """
+    return 'SRID=%d;POINT(%r %r)' % (srid, x, y)
+
+def interpolation_fraction(number, from_num, to_num):
+    """
+    Returns how far along a block's from_num-to_num range a house number
+    lies, falling back to the middle of the block when there's no number or
+    the range is empty.
+
+    >>> interpolation_fraction('15', 10, 20)
+    0.5
+    >>> interpolation_fraction(None, 10, 20)
+    0.5
+    """
+    try:
+        return (float(number) - from_num) / (to_num - from_num)
+    except TypeError:
+        # TODO: revisit this clause.  We're getting here because the 'number' field was zero.  What do
+        # we do in this case?  What does the original code do?
+        return 0.5
+    except ZeroDivisionError:
+        return 0.5
+
+class LineString(object):
+    """
+    A parsed linestring, with the cumulative length at each vertex computed
+    once so that repeated interpolation is a binary search.
+
+    >>> line = LineString([(0.0, 0.0), (1.0, 0.0), (1.0, 1.0)])
+    >>> line.length
+    2.0
+    >>> line.interpolate(0.25)
+    (0.5, 0.0)
+    """
+    __slots__ = ('coords', 'cumulative', 'length')
+
+    def __init__(self, coords):
+        self.coords = tuple(coords)
+        cumulative = [0.0]
+        for (x1, y1), (x2, y2) in zip(self.coords, self.coords[1:]):
+            cumulative.append(cumulative[-1] + math.hypot(x2 - x1, y2 - y1))
+        self.cumulative = tuple(cumulative)
+        self.length = cumulative[-1]
+
+    @classmethod
+    def from_wkt(cls, wkt_str):
+        return cls(parse_linestring(wkt_str))
+
+    def interpolate(self, fraction):
+        """
+        Returns the point that lies the given fraction (between 0 and 1) of
+        the way along the line.
+        """
+        coords = self.coords
+        if fraction <= 0 or self.length == 0:
+            return coords[0]
+        if fraction >= 1:
+            return coords[-1]
+
+        target = self.length * fraction
+        # The segment ending at the first vertex past the target.
+        i = bisect.bisect_right(self.cumulative, target)
+        x1, y1 = coords[i - 1]
+        x2, y2 = coords[i]
+        f = (target - self.cumulative[i - 1]) / (self.cumulative[i] - self.cumulative[i - 1])
+        return (x1 + (x2 - x1) * f, y1 + (y2 - y1) * f)
+
+    def fraction_at(self, segment, t):
+        """
+        Returns the fraction of the way along the line of the point t of
+        the way along its segment'th segment; the inverse of interpolate().
+
+        >>> LineString([(0.0, 0.0), (1.0, 0.0), (1.0, 1.0)]).fraction_at(1, 0.5)
+        0.75
+        """
+        if self.length == 0:
+            return 0.0
+        start, end = self.cumulative[segment], self.cumulative[segment + 1]
+        return (start + (end - start) * t) / self.length
+
+def closest_on_segment(x, y, x1, y1, x2, y2):
+    """
+    Returns (squared distance, t) for the point of the segment from (x1, y1)
+    to (x2, y2) nearest to (x, y), which is t (between 0 and 1) of the way
+    along it.
+
+    >>> closest_on_segment(1.0, 1.0, 0.0, 0.0, 4.0, 0.0)
+    (1.0, 0.25)
+    >>> closest_on_segment(-3.0, 0.0, 0.0, 0.0, 4.0, 0.0)
+    (9.0, 0.0)
+    """
+    dx, dy = x2 - x1, y2 - y1
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        t = 0.0
+    else:
+        t = ((x - x1) * dx + (y - y1) * dy) / length_sq
+        if t < 0:
+            t = 0.0
+        elif t > 1:
+            t = 1.0
+    px, py = x1 + dx * t - x, y1 + dy * t - y
+    return px * px + py * py, t
+
+def side_of_segment(x, y, x1, y1, x2, y2):
+    """
+    Returns 1 if (x, y) is to the left of the segment from (x1, y1) to
+    (x2, y2), looking along it, -1 if it's to the right and 0 if it's on
+    the line.
+
+    >>> side_of_segment(1.0, 1.0, 0.0, 0.0, 4.0, 0.0), side_of_segment(1.0, -1.0, 0.0, 0.0, 4.0, 0.0)
+    (1, -1)
+    """
+    cross = (x2 - x1) * (y - y1) - (y2 - y1) * (x - x1)
+    return (cross > 0) - (cross < 0)
+
+def segment_intersects_box(x1, y1, x2, y2, min_x, min_y, max_x, max_y):
+    """
+    Returns True if any of the segment from (x1, y1) to (x2, y2) is inside
+    the box, by clipping it to each edge in turn (Liang-Barsky).
+
+    >>> segment_intersects_box(-1.0, 0.5, 2.0, 0.5, 0.0, 0.0, 1.0, 1.0)
+    True
+    >>> segment_intersects_box(-1.0, 0.5, 0.5, 2.0, 0.0, 0.0, 1.0, 1.0)
+    False
+    """
+    if min_x <= x1 <= max_x and min_y <= y1 <= max_y:
+        return True
+    t0, t1 = 0.0, 1.0
+    dx, dy = x2 - x1, y2 - y1
+    for p, q in ((-dx, x1 - min_x), (dx, max_x - x1), (-dy, y1 - min_y), (dy, max_y - y1)):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = float(q) / p
+            if p < 0:
+                if t > t1:
+                    return False
+                t0 = max(t0, t)
+            else:
+                if t < t0:
+                    return False
+                t1 = min(t1, t)
+    return True
+
+def line_interpolate_point(coords, fraction):
+    """
+    Returns the point that lies the given fraction (between 0 and 1) of the
+    way along a list of coordinates, like PostGIS's line_interpolate_point().
+
+    >>> line_interpolate_point([(0.0, 0.0), (1.0, 0.0), (1.0, 1.0)], 0.75)
+    (1.0, 0.5)
+    """
+    return LineString(coords).interpolate(fraction)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,194 @@
+"""
+Opt-in timings and counters for the geocoding hot path.
+
+The geocoders and searchers report how long each stage takes (normalize,
+parse, sql, interpolate, parse_point, ...) and count things (candidate
+parses, SQL queries and rows, blocks rejected by contains_number) to the
+current sink. There's no sink until enable() is called, and until then
+timer() hands back a shared do-nothing context manager and count() returns
+straight away.
+
+    import instrument
+    recorder = instrument.enable()
+    geocoder.geocode('24 Tobin Rd')
+    print recorder.report()
+
+A sink is any object with timing(stage, seconds) and count(name, n)
+methods; Recorder aggregates them into histograms.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# The current sink, or None when instrumentation is off.
+sink = None
+
+def enable(new_sink=None):
+    """
+    Starts sending timings and counts to new_sink (by default a new
+    Recorder), which is returned.
+    """
+    global sink
+    if new_sink is None:
+        new_sink = Recorder()
+    sink = new_sink
+    return new_sink
+
+def disable():
+    global sink
+    sink = None
+
+def enabled():
+    return sink is not None
+
+@contextmanager
+def recording(new_sink=None):
+    """
+    Instruments the body of a with statement, then puts the previous sink
+    back.
+    """
+    previous = sink
+    try:
+        yield enable(new_sink)
+    finally:
+        if previous is None:
+            disable()
+        else:
+            enable(previous)
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = NullTimer()
+
+class Timer(object):
+    __slots__ = ('sink', 'stage', 'start')
+    def __init__(self, sink, stage):
+        self.sink = sink
+        self.stage = stage
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, *exc_info):
+        self.sink.timing(self.stage, time.time() - self.start)
+        return False
+
+def timer(stage):
+    """
+    Returns a context manager that times its body as stage.
+    """
+    if sink is None:
+        return NULL_TIMER
+    return Timer(sink, stage)
+
+def count(name, n=1):
+    if sink is not None:
+        sink.count(name, n)
+
+class Histogram(object):
+    """
+    Durations bucketed by powers of two microseconds, so that percentiles
+    can be estimated without keeping every sample.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        # Bucket b holds durations under 2**b microseconds.
+        bucket = math.frexp(seconds * 1e6)[1]
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def mean(self):
+        return self.count and self.total / self.count or 0.0
+
+    def percentile(self, p):
+        """
+        Returns an upper bound on the p'th percentile, in seconds.
+        """
+        if not self.count:
+            return 0.0
+        wanted = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= wanted:
+                return min(2.0 ** bucket / 1e6, self.max)
+        return self.max
+
+class Recorder(object):
+    """
+    A sink that keeps a Histogram per stage and a total per counter.
+    """
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def timing(self, stage, seconds):
+        with self.lock:
+            try:
+                histogram = self.timings[stage]
+            except KeyError:
+                histogram = self.timings[stage] = Histogram()
+            histogram.add(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+
+    def summary(self):
+        """
+        Returns the timings and counters as a dict, e.g. for json.dumps().
+        """
+        with self.lock:
+            timings = dict((stage, {
+                'count': h.count, 'total': h.total, 'mean': h.mean(), 'min': h.min, 'max': h.max,
+                'p50': h.percentile(50), 'p90': h.percentile(90), 'p99': h.percentile(99),
+            }) for stage, h in self.timings.items())
+            return {'timings': timings, 'counters': dict(self.counters)}
+
+    def report(self, histograms=False):
+        """
+        Returns a table of the stages, slowest in total first, and the
+        counters. With histograms, each stage's buckets are drawn too.
+        """
+        summary = self.summary()
+        lines = ['%-20s %8s %10s %9s %9s %9s %9s %9s' % ('stage', 'count', 'total ms', 'mean us', 'p50 us', 'p90 us', 'p99 us', 'max us')]
+        for stage, t in sorted(summary['timings'].items(), key=lambda item: -item[1]['total']):
+            lines.append('%-20s %8d %10.1f %9.1f %9.1f %9.1f %9.1f %9.1f' % (
+                stage, t['count'], t['total'] * 1e3, t['mean'] * 1e6, t['p50'] * 1e6, t['p90'] * 1e6, t['p99'] * 1e6, t['max'] * 1e6))
+            if histograms:
+                lines.extend(self.draw(self.timings[stage]))
+        if summary['counters']:
+            lines.append('')
+            lines.append('%-24s %10s' % ('counter', 'total'))
+            for name, total in sorted(summary['counters'].items()):
+                lines.append('%-24s %10d' % (name, total))
+        return '\n'.join(lines)
+
+    def draw(self, histogram, width=40):
+        most = max(histogram.buckets.values())
+        lines = []
+        for bucket in range(min(histogram.buckets), max(histogram.buckets) + 1):
+            n = histogram.buckets.get(bucket, 0)
+            lines.append('    < %8d us %8d %s' % (2 ** bucket, n, '#' * int(math.ceil(float(n) * width / most))))
+        return lines
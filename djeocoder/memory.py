@@ -0,0 +1,625 @@
+"""
+In-memory replacements for the searchers in postgis.py, built from the
+pipe-delimited dumps that textfiles.py loads (e.g. blocks.txt.gz), so that
+geocoding doesn't need a live database.
+
+Built from a snapshot (see snapshot.py), the searchers don't index the
+rows up front: each street is looked up in the snapshot's postings the
+first time it's searched for, so startup is about as quick as mapping the
+file, and the rows stay in pages that every process shares.
+"""
+import bisect
+import collections
+import threading
+
+from geometry import LineString, interpolation_fraction
+from results import BlockResult, IntersectionResult, contains_number, parse_point
+from textfiles import BlockFileLoader, IntersectionFileLoader, RowView, DeltaError, read_deltas, INSERT, DELETE
+import instrument
+import snapshot
+
+def int_or_none(s):
+    if s is None or s == '': return None
+    return int(s)
+
+def upper_or_none(s):
+    if not s: return None
+    return s.upper()
+
+class IndexedBlock(object):
+    """
+    The parts of a blocks row that MemoryBlockSearcher needs, with the numeric
+    columns converted and the geometry parsed on first use.
+    """
+    __slots__ = ('id', 'pretty_name', 'predir', 'street', 'suffix', 'postdir',
+                 'from_num', 'to_num', 'left_from_num', 'left_to_num', 'right_from_num', 'right_to_num',
+                 'left_zip', 'right_zip', 'left_city', 'right_city', 'left_state', 'right_state',
+                 'geom', 'line')
+
+    def __init__(self, row):
+        self.id = int(row['id'])
+        self.pretty_name = row['pretty_name']
+        self.predir = upper_or_none(row['predir'])
+        self.street = upper_or_none(row['street'])
+        self.suffix = upper_or_none(row['suffix'])
+        self.postdir = upper_or_none(row['postdir'])
+        for key in ('from_num', 'to_num', 'left_from_num', 'left_to_num', 'right_from_num', 'right_to_num'):
+            setattr(self, key, int_or_none(row[key]))
+        for key in ('left_zip', 'right_zip'):
+            setattr(self, key, row[key] or None)
+        for key in ('left_city', 'right_city', 'left_state', 'right_state'):
+            setattr(self, key, upper_or_none(row[key]))
+        # Rows from a loader keep their coordinates in the loader's columns,
+        # so hang on to the row rather than copying its geometry out.
+        if isinstance(row, RowView):
+            self.geom = row
+        else:
+            self.geom = row['geom']
+        self.line = None
+
+    def wkt(self):
+        if isinstance(self.geom, RowView):
+            return self.geom['geom']
+        return self.geom
+
+    def as_tuple(self):
+        # The same columns, in the same order, that PostgisBlockSearcher selects.
+        return (self.id, self.pretty_name, self.from_num, self.to_num,
+                self.left_from_num, self.left_to_num, self.right_from_num, self.right_to_num, self.wkt())
+
+    def linestring(self):
+        if self.line is None:
+            if isinstance(self.geom, RowView):
+                self.line = LineString(self.geom.coordinates('geom'))
+            else:
+                self.line = LineString.from_wkt(self.geom)
+        return self.line
+
+    def interpolate(self, fraction):
+        return self.linestring().interpolate(fraction)
+
+class StreetBlocks(object):
+    """
+    All of the blocks on one street, sorted by from_num. max_span is the
+    widest from_num-to_num range, which bounds how far back from a number we
+    have to look for a block that contains it.
+    """
+    def __init__(self, blocks):
+        self.blocks = sorted(blocks, key=lambda b: (b.from_num, b.id))
+        self.numbered = [b for b in self.blocks if b.from_num is not None and b.to_num is not None]
+        self.from_nums = [b.from_num for b in self.numbered]
+        self.max_span = max([b.to_num - b.from_num for b in self.numbered] or [0])
+
+    def containing(self, number):
+        """
+        Returns the blocks with from_num <= number <= to_num, in from_num order.
+        """
+        found = []
+        i = bisect.bisect_right(self.from_nums, number) - 1
+        while i >= 0 and self.from_nums[i] >= number - self.max_span:
+            if self.numbered[i].to_num >= number:
+                found.append(self.numbered[i])
+            i -= 1
+        found.reverse()
+        return found
+
+class MemoryBlockSearcher:
+    """
+    A drop-in replacement for PostgisBlockSearcher that answers searches from
+    an in-memory index instead of the blocks table.
+
+    Built from an iterable of block rows (dicts keyed by BlockFileLoader's
+    column names), hashed on street, with each street's blocks sorted by
+    number range.
+
+    Changes can be applied from delta files with apply(), without
+    reloading: they're made to copies of the affected streets, which are
+    swapped in together, so a search sees the blocks either wholly before
+    or wholly after a delta file.
+    """
+    def __init__(self, rows):
+        streets = {}
+        self.by_id = {}
+        for row in rows:
+            block = IndexedBlock(row)
+            self.by_id[block.id] = block
+            streets.setdefault(block.street, []).append(block)
+        self.streets = {}
+        for street, blocks in streets.items():
+            self.streets[street] = StreetBlocks(blocks)
+        # Only one apply() at a time.
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, filename):
+        # Uses filename's snapshot (see snapshot.py) when it's up to date.
+        loader = snapshot.load(filename, BlockFileLoader)
+        if isinstance(loader, snapshot.SnapshotLoader) and loader.uppercase('street'):
+            return cls.from_snapshot(loader)
+        return cls(loader.scan())
+
+    @classmethod
+    def from_snapshot(cls, loader):
+        """
+        Returns a searcher that reads each street's blocks out of a
+        snapshot.SnapshotLoader when it's first searched for.
+        """
+        searcher = cls([])
+        rows = SnapshotRows(loader, IndexedBlock)
+        searcher.by_id = SnapshotIds(rows)
+        searcher.streets = SnapshotIndex(rows, ('street',), StreetBlocks)
+        return searcher
+
+    def close(self):
+        pass
+
+    def apply(self, deltas):
+        """
+        Applies an iterable of (op, row) deltas, as read by
+        textfiles.read_deltas(), all or (if one of them is for a block that
+        doesn't exist, or already does) none of them.
+        """
+        with self.lock:
+            self.swap(self.updated(deltas))
+
+    def apply_file(self, filename):
+        self.apply(read_deltas(filename, BlockFileLoader))
+
+    def updated(self, deltas):
+        """
+        Returns the indexes with deltas applied, for swap(), leaving the
+        searcher as it is. Callers should hold self.lock until they swap.
+        """
+        by_id, removed, added = apply_deltas(self.by_id, deltas, IndexedBlock, 'block')
+        changed = {}
+        for block in removed + added:
+            changed[block.street] = []
+        for block in added:
+            changed[block.street].append(block)
+
+        changes = {}
+        for street, blocks in changed.items():
+            if street in self.streets:
+                blocks = [b for b in self.streets[street].blocks if by_id.get(b.id) is b] + blocks
+            changes[street] = blocks and StreetBlocks(blocks) or None
+        return by_id, replaced(self.streets, changes)
+
+    def updated_file(self, filename):
+        return self.updated(read_deltas(filename, BlockFileLoader))
+
+    def swap(self, indexes):
+        self.by_id, self.streets = indexes
+
+    def street_names(self):
+        """
+        Returns a dict of each street name to how many blocks it has.
+        """
+        if isinstance(self.streets, dict):
+            return dict((street, len(blocks.blocks)) for street, blocks in self.streets.items())
+        return self.streets.sizes(lambda blocks: len(blocks.blocks))
+
+    def blocks(self):
+        for street_blocks in self.streets.itervalues():
+            for block in street_blocks.blocks:
+                yield block
+
+    def contains_number(self, number, from_num, to_num, left_from_num, left_to_num, right_from_num, right_to_num):
+        return contains_number(number, from_num, to_num, left_from_num, left_to_num, right_from_num, right_to_num)
+
+    def candidates(self, street, number=None, pre_dir=None, suffix=None, post_dir=None, city=None, state=None, zip=None):
+        """
+        Returns the blocks that PostgisBlockSearcher's query would select,
+        before the parity check in contains_number().
+        """
+        street_blocks = self.streets.get(street.upper())
+        if street_blocks is None:
+            return []
+        if number:
+            blocks = street_blocks.containing(int(number))
+        else:
+            blocks = street_blocks.blocks
+
+        pre_dir, suffix, post_dir = upper_or_none(pre_dir), upper_or_none(suffix), upper_or_none(post_dir)
+        city, state = upper_or_none(city), upper_or_none(state)
+        found = []
+        for b in blocks:
+            if pre_dir and b.predir != pre_dir: continue
+            if suffix and b.suffix != suffix: continue
+            if post_dir and b.postdir != post_dir: continue
+            if city and city not in (b.left_city, b.right_city): continue
+            if state and state not in (b.left_state, b.right_state): continue
+            if zip and zip not in (b.left_zip, b.right_zip): continue
+            found.append(b)
+        return found
+
+    def search(self,street,number=None,pre_dir=None,suffix=None,post_dir=None,city=None,state=None,zip=None,left_city=None,right_city=None):
+        final_blocks = []
+        candidates = self.candidates(street, number, pre_dir, suffix, post_dir, city, state, zip)
+        for b in candidates:
+            containment = self.contains_number(number, b.from_num, b.to_num, b.left_from_num, b.left_to_num, b.right_from_num, b.right_to_num)
+            if not containment[0]:
+                continue
+            with instrument.timer('interpolate'):
+                point = b.interpolate(interpolation_fraction(number, containment[1], containment[2]))
+            final_blocks.append(BlockResult(b.as_tuple(), point))
+        instrument.count('blocks_rejected', len(candidates) - len(final_blocks))
+        return final_blocks
+
+def apply_deltas(by_id, deltas, make, kind):
+    """
+    Returns (by_id, removed, added): by_id (a mapping of id to IndexedBlock
+    or IndexedIntersection) with the deltas applied, as replaced() makes it,
+    the objects the deltas took out, and the ones they put in (made from
+    their rows by make()) that are still there at the end.
+    """
+    changes = {}
+    removed, added = [], []
+    for op, row in deltas:
+        id = int(row['id'])
+        if id in changes:
+            old = changes[id]
+        else:
+            old = by_id.get(id)
+        if old is None and op != INSERT:
+            raise DeltaError("Can't %s %s %d: there isn't one" % (op, kind, id))
+        elif old is not None and op == INSERT:
+            raise DeltaError("Can't INSERT %s %d: there already is one" % (kind, id))
+        if old is not None:
+            removed.append(old)
+        changes[id] = None
+        if op != DELETE:
+            changes[id] = make(row)
+            added.append(changes[id])
+    by_id = replaced(by_id, changes)
+    return by_id, removed, [x for x in added if by_id.get(x.id) is x]
+
+def replaced(index, changes):
+    """
+    Returns a copy of index with the keys in changes set to their values,
+    or, where the value is None, taken out. A dict is copied; one of the
+    snapshot indexes below is overlaid instead, since copying it would read
+    in the whole snapshot.
+    """
+    if isinstance(index, dict):
+        index = dict(index)
+        for key, value in changes.iteritems():
+            if value is None:
+                index.pop(key, None)
+            else:
+                index[key] = value
+        return index
+    return Overlay(index, changes)
+
+class IndexedIntersection(object):
+    """
+    The parts of an intersections row that MemoryIntersectionSearcher needs.
+    side_a and side_b are each (street, suffix, predir, postdir).
+    """
+    __slots__ = ('id', 'pretty_name', 'side_a', 'side_b', 'zip', 'city', 'state', 'location')
+
+    def __init__(self, row):
+        self.id = int(row['id'])
+        self.pretty_name = row['pretty_name']
+        self.side_a = tuple(upper_or_none(row[key]) for key in ('street_a', 'suffix_a', 'predir_a', 'postdir_a'))
+        self.side_b = tuple(upper_or_none(row[key]) for key in ('street_b', 'suffix_b', 'predir_b', 'postdir_b'))
+        self.city = upper_or_none(row['city'])
+        self.state = upper_or_none(row['state'])
+        self.zip = row['zip'] or None
+        if isinstance(row, RowView):
+            self.location = row.coordinates('location')[0]
+        else:
+            self.location = row['location']
+
+    def coordinates(self):
+        if isinstance(self.location, tuple):
+            return self.location
+        return parse_point(self.location)
+
+    def as_tuple(self):
+        return (self.id, self.pretty_name, self.location, self.zip, self.city, self.state)
+
+def pair_key(a, b):
+    """
+    Returns the same key for a pair of things whichever order they're in.
+
+    >>> pair_key('WASHINGTON', 'TOBIN') == pair_key('TOBIN', 'WASHINGTON')
+    True
+    """
+    if b < a:
+        return (b, a)
+    return (a, b)
+
+class MemoryIntersectionSearcher:
+    """
+    A drop-in replacement for PostgisIntersectionSearcher, built from an
+    iterable of intersection rows (dicts keyed by IntersectionFileLoader's
+    column names).
+
+    Intersections are indexed by the unordered pair of their street names
+    and by each street name, so a search naming both streets is a single
+    dictionary lookup. Like the PostGIS query, each value given to search()
+    may match either side of an intersection; the indexes only narrow down
+    the intersections to check.
+    """
+    def __init__(self, rows):
+        self.intersections = []
+        self.street_pairs = {}
+        self.streets = {}
+        self.by_id = {}
+        for row in rows:
+            i = IndexedIntersection(row)
+            self.intersections.append(i)
+            self.by_id[i.id] = i
+            for index, keys in zip((self.street_pairs, self.streets), self.index_keys(i)):
+                for key in keys:
+                    index.setdefault(key, []).append(i)
+        self.lock = threading.Lock()
+
+    def index_keys(self, i):
+        """
+        Returns the keys that i is filed under in street_pairs, and the
+        ones in streets.
+        """
+        return [pair_key(i.side_a[0], i.side_b[0])], list(set([i.side_a[0], i.side_b[0]]))
+
+    @classmethod
+    def from_file(cls, filename):
+        loader = snapshot.load(filename, IntersectionFileLoader)
+        if isinstance(loader, snapshot.SnapshotLoader) and loader.uppercase('street_a') and loader.uppercase('street_b'):
+            return cls.from_snapshot(loader)
+        return cls(loader.scan())
+
+    @classmethod
+    def from_snapshot(cls, loader):
+        """
+        Returns a searcher that reads the intersections of each street out
+        of a snapshot.SnapshotLoader when it's first searched for.
+        """
+        searcher = cls([])
+        rows = SnapshotRows(loader, IndexedIntersection)
+        searcher.intersections = rows
+        searcher.by_id = SnapshotIds(rows)
+        searcher.streets = SnapshotIndex(rows, ('street_a', 'street_b'), list)
+        searcher.street_pairs = SnapshotPairs(searcher.streets)
+        return searcher
+
+    def close(self):
+        pass
+
+    def apply(self, deltas):
+        """
+        Applies an iterable of (op, row) deltas, as read by
+        textfiles.read_deltas(), to copies of the indexes, which are then
+        swapped in. Each search only uses one of the indexes, so it sees the
+        intersections wholly before or wholly after the deltas.
+        """
+        with self.lock:
+            self.swap(self.updated(deltas))
+
+    def apply_file(self, filename):
+        self.apply(read_deltas(filename, IntersectionFileLoader))
+
+    def updated(self, deltas):
+        """
+        Returns the indexes with deltas applied, for swap(), leaving the
+        searcher as it is. Callers should hold self.lock until they swap.
+        """
+        by_id, removed, added = apply_deltas(self.by_id, deltas, IndexedIntersection, 'intersection')
+        indexes = (self.street_pairs, self.streets)
+        changes = ({}, {})
+        for i in removed + added:
+            for index, index_changes, keys in zip(indexes, changes, self.index_keys(i)):
+                for key in keys:
+                    if key not in index_changes:
+                        index_changes[key] = [x for x in index.get(key, ()) if by_id.get(x.id) is x]
+        for i in added:
+            for index_changes, keys in zip(changes, self.index_keys(i)):
+                for key in keys:
+                    index_changes[key].append(i)
+        indexes = tuple(replaced(index, dict((key, found or None) for key, found in index_changes.items()))
+                        for index, index_changes in zip(indexes, changes))
+        if removed:
+            intersections = [i for i in self.intersections if by_id.get(i.id) is i] + added
+        else:
+            intersections = list(self.intersections) + added
+        return (by_id,) + indexes + (intersections,)
+
+    def updated_file(self, filename):
+        return self.updated(read_deltas(filename, IntersectionFileLoader))
+
+    def swap(self, indexes):
+        self.by_id, self.street_pairs, self.streets, self.intersections = indexes
+
+    def search(self, predir_a=None, street_a=None, suffix_a=None, postdir_a=None, predir_b=None, street_b=None, suffix_b=None, postdir_b=None):
+        # (value, position in a side) for every filter given.
+        filters = []
+        for position, values in enumerate(((street_a, street_b), (suffix_a, suffix_b), (predir_a, predir_b), (postdir_a, postdir_b))):
+            for value in values:
+                if value:
+                    filters.append((value.upper(), position))
+
+        street_a, street_b = upper_or_none(street_a), upper_or_none(street_b)
+        if street_a and street_b and street_a != street_b:
+            # Each street has to be on one side or the other, so the
+            # intersection is of exactly these two.
+            candidates = self.street_pairs.get(pair_key(street_a, street_b), [])
+        elif street_a or street_b:
+            candidates = self.streets.get(street_a or street_b, [])
+        else:
+            candidates = self.intersections
+
+        results = []
+        for i in candidates:
+            side_a, side_b = i.side_a, i.side_b
+            for value, position in filters:
+                if side_a[position] != value and side_b[position] != value:
+                    break
+            else:
+                results.append(IntersectionResult(i.as_tuple()))
+        return results
+
+class SnapshotRows(collections.Sequence):
+    """
+    The rows of a snapshot.SnapshotLoader, made into IndexedBlocks or
+    IndexedIntersections by make as they're needed. Each is kept once
+    made, so the indexes over them share the objects.
+    """
+    def __init__(self, loader, make):
+        self.loader = loader
+        self.make = make
+        self.made = {}
+        self.ids = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self.loader):
+            raise IndexError(index)
+        made = self.made.get(index)
+        if made is None:
+            # setdefault, so that threads making the same row share one.
+            made = self.made.setdefault(index, self.make(self.loader.row(index)))
+        return made
+
+    def id_indexes(self):
+        """
+        Returns a dict of each row's id to its index, read the first time
+        it's needed (to apply deltas).
+        """
+        if self.ids is None:
+            self.ids = dict((row_id, index) for index, row_id in enumerate(self.loader.scan().column('id')))
+        return self.ids
+
+class SnapshotIds(collections.Mapping):
+    """
+    id -> the made row of a SnapshotRows.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __getitem__(self, id):
+        return self.rows[self.rows.id_indexes()[id]]
+
+    def __iter__(self):
+        return iter(self.rows.id_indexes())
+
+    def __len__(self):
+        return len(self.rows)
+
+class SnapshotIndex(collections.Mapping):
+    """
+    street -> build() of the made rows with that street in any of columns,
+    found in the snapshot's postings the first time it's asked for.
+    """
+    def __init__(self, rows, columns, build):
+        self.rows = rows
+        self.columns = columns
+        self.build = build
+        self.built = {}
+
+    def row_indexes(self, street):
+        found = set()
+        for column in self.columns:
+            found.update(self.rows.loader.rows_with(column, street))
+        return sorted(found)
+
+    def __getitem__(self, street):
+        built = self.built.get(street)
+        if built is None:
+            indexes = street and self.row_indexes(street)
+            if not indexes:
+                raise KeyError(street)
+            built = self.built.setdefault(street, self.build([self.rows[index] for index in indexes]))
+        return built
+
+    def __iter__(self):
+        seen = set()
+        for column in self.columns:
+            for street in self.rows.loader.values(column):
+                if street not in seen:
+                    seen.add(street)
+                    yield street
+
+    def __len__(self):
+        return sum(1 for street in self)
+
+    def sizes(self, size):
+        """
+        Returns a dict of each street to how many rows it has, counted from
+        the postings. (size is for Overlay's sizes().)
+        """
+        if len(self.columns) == 1:
+            return self.rows.loader.counts(self.columns[0])
+        return dict((street, len(self.row_indexes(street))) for street in self)
+
+class SnapshotPairs(collections.Mapping):
+    """
+    pair_key() of two streets -> the intersections of them, picked out of
+    a SnapshotIndex of intersections by street.
+    """
+    def __init__(self, streets):
+        self.streets = streets
+        self.built = {}
+
+    def __getitem__(self, key):
+        built = self.built.get(key)
+        if built is None:
+            built = [i for i in self.streets.get(key[0], ()) if pair_key(i.side_a[0], i.side_b[0]) == key]
+            if not built:
+                raise KeyError(key)
+            built = self.built.setdefault(key, built)
+        return built
+
+    def __iter__(self):
+        return iter(set(pair_key(i.side_a[0], i.side_b[0]) for i in self.streets.rows))
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+class Overlay(collections.Mapping):
+    """
+    A snapshot index with the keys in changes set to their values or,
+    where the value is None, taken out (see replaced()).
+    """
+    def __init__(self, base, changes):
+        if isinstance(base, Overlay):
+            changes = dict(base.changes.items() + changes.items())
+            base = base.base
+        self.base = base
+        self.changes = changes
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            value = self.changes[key]
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self.base[key]
+
+    def __iter__(self):
+        for key in self.base:
+            if key not in self.changes:
+                yield key
+        for key, value in self.changes.iteritems():
+            if value is not None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def sizes(self, size):
+        """
+        Returns a dict of each key to the size of its value, by size.
+        """
+        sizes = self.base.sizes(size)
+        for key, value in self.changes.iteritems():
+            if value is None:
+                sizes.pop(key, None)
+            else:
+                sizes[key] = size(value)
+        return sizes
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
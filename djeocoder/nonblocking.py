@@ -0,0 +1,346 @@
+"""
+A geocoder front end for event-driven servers, on psycopg2's asynchronous
+connections, so that one process can have thousands of geocodes in flight
+without a thread for each.
+
+    pool = AsyncConnectionPool('dbname=openblock user=...', size=10)
+    geocoder = AsyncLocalGeocoder(pool)
+    future = geocoder.geocode('24 Tobin Rd')
+    future.add_done_callback(respond)
+    ...
+    pool.poll(timeout)          # from the server's own loop, or
+    future.result()             # to wait for one
+
+geocode() doesn't touch the database itself: it queues the location, and
+the next poll() sends everything queued since the last one as one batch,
+with its blocks query and its intersections query running concurrently on
+two of the pool's connections. When both have come back, the batch is
+geocoded in memory by a LocalGeocoder over the fetched rows, just as
+LocalGeocoder.geocode_many() does, so parsing, spelling correction and
+contains_number() are all the usual ones.
+
+(This code base is Python 2, so there's no asyncio here: futures and
+callbacks stand in for coroutines, and poll() can be driven by any
+select()-based loop, using fileno_events() to know what to wait for.)
+"""
+import collections
+import select
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from djeocoder import LocalGeocoder, streets_for
+from memory import MemoryBlockSearcher, MemoryIntersectionSearcher
+from postgis import PostgisBlockSearcher, PostgisIntersectionSearcher
+from spelling import StreetCorrector
+
+class Future(object):
+    """
+    The eventual result of a query or a geocode, which pool.poll() fills in.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def set_result(self, value):
+        self.value = value
+        self.finish()
+
+    def set_exception(self, error):
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        self.finished = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        if self.finished:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def result(self):
+        """
+        Waits for the future to finish, then returns its value or raises its
+        exception.
+        """
+        self.pool.run_until_complete([self])
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+def wait_for_connection(conn):
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        elif state == psycopg2.extensions.POLL_READ:
+            select.select([conn.fileno()], [], [])
+        elif state == psycopg2.extensions.POLL_WRITE:
+            select.select([], [conn.fileno()], [])
+
+class AsyncConnectionPool:
+    """
+    Runs queries on size asynchronous connections, queueing the rest.
+    submit() returns a Future for the query's rows; poll() does whatever
+    work is ready and fills in the futures that are finished.
+
+    Connections that close (e.g. when the database restarts) are dropped,
+    and new ones opened in their place when there are queries waiting.
+    """
+    def __init__(self, dsn, size=10):
+        self.dsn = dsn
+        self.size = size
+        self.idle = []
+        for i in range(size):
+            self.idle.append(self.connect())
+        # conn -> (cursor, future)
+        self.busy = {}
+        # conn -> the select.POLLIN or POLLOUT its query is waiting for
+        self.events = {}
+        self.queue = collections.deque()
+        # Called at the start of every poll(), e.g. to submit batched work.
+        self.hooks = []
+
+    def submit(self, query, params=()):
+        future = Future(self)
+        self.queue.append((query, params, future))
+        return future
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def connect(self):
+        conn = psycopg2.connect(self.dsn, async_=1)
+        wait_for_connection(conn)
+        return conn
+
+    def reconnect(self):
+        """
+        Opens connections in place of the ones that have closed, if there
+        are queries waiting. If there are no connections left and none can
+        be opened, the queued queries fail rather than waiting for ever.
+        """
+        self.idle = [conn for conn in self.idle if not conn.closed]
+        error = None
+        while self.queue and len(self.idle) + len(self.busy) < self.size:
+            try:
+                self.idle.append(self.connect())
+            except psycopg2.Error, e:
+                error = e
+                break
+        if self.queue and not self.idle and not self.busy:
+            error = error or psycopg2.pool.PoolError('No connections to run queries on')
+            while self.queue:
+                query, params, future = self.queue.popleft()
+                future.set_exception(error)
+
+    def start(self):
+        self.reconnect()
+        while self.queue and self.idle:
+            query, params, future = self.queue.popleft()
+            conn = self.idle.pop()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(query, params)
+            except psycopg2.Error, e:
+                self.release(conn)
+                future.set_exception(e)
+                continue
+            self.busy[conn] = (cursor, future)
+
+    def release(self, conn):
+        # A closed connection is dropped, for reconnect() to replace.
+        if not conn.closed:
+            self.idle.append(conn)
+
+    def step(self, conn):
+        """
+        Moves conn's query along, finishing its future if it's done.
+        """
+        cursor, future = self.busy[conn]
+        try:
+            state = conn.poll()
+            if state == psycopg2.extensions.POLL_READ:
+                self.events[conn] = select.POLLIN
+                return
+            elif state == psycopg2.extensions.POLL_WRITE:
+                self.events[conn] = select.POLLOUT
+                return
+            rows = cursor.fetchall()
+        except psycopg2.Error, e:
+            self.finish(conn)
+            future.set_exception(e)
+        else:
+            self.finish(conn)
+            future.set_result(rows)
+
+    def finish(self, conn):
+        del self.busy[conn]
+        self.events.pop(conn, None)
+        self.release(conn)
+
+    def fileno_events(self):
+        """
+        Returns (readable, writable): the file descriptors a select() loop
+        should wait on before calling poll() again.
+        """
+        readable = [conn.fileno() for conn, event in self.events.items() if event == select.POLLIN]
+        writable = [conn.fileno() for conn, event in self.events.items() if event == select.POLLOUT]
+        return readable, writable
+
+    def poll(self, timeout=0):
+        """
+        Runs the hooks, starts queued queries and finishes the ones whose
+        results are in, waiting up to timeout seconds (None for as long as
+        it takes) for one to be ready.
+        """
+        for hook in self.hooks:
+            hook()
+        self.start()
+        for conn in list(self.busy):
+            if conn not in self.events:
+                # Just started.
+                self.step(conn)
+        if not self.busy:
+            return
+        readable, writable = self.fileno_events()
+        ready_r, ready_w, _ = select.select(readable, writable, [], timeout)
+        ready = set(ready_r + ready_w)
+        for conn in list(self.busy):
+            if conn.fileno() in ready:
+                self.step(conn)
+        self.start()
+
+    def pending(self):
+        return bool(self.queue or self.busy)
+
+    def run_until_complete(self, futures):
+        while not all(f.done() for f in futures):
+            self.poll(timeout=None)
+            if not self.pending() and not all(f.done() for f in futures):
+                raise RuntimeError('Waiting for futures that nothing will finish')
+
+    def fetchall(self, query, params=()):
+        return self.submit(query, params).result()
+
+    def closeall(self):
+        for conn in self.idle + self.busy.keys():
+            conn.close()
+        self.idle = []
+        self.busy = {}
+
+class AsyncLocalGeocoder:
+    """
+    Geocodes through an AsyncConnectionPool (or anything with its submit(),
+    add_hook() and run_until_complete()), batching together the locations
+    asked for between polls, up to batch_size at a time.
+    """
+    def __init__(self, pool, spelling=None, batch_size=1000):
+        self.pool = pool
+        self.batch_size = batch_size
+        # Only used to build queries; they're run through the pool.
+        self.block_searcher = PostgisBlockSearcher(None)
+        self.intersection_searcher = PostgisIntersectionSearcher(None)
+        if spelling is None:
+            spelling = StreetCorrector(dict(pool.fetchall(self.block_searcher.street_names_query)))
+        self.spelling = spelling
+        # (location, future) pairs waiting for the next batch.
+        self.waiting = []
+        pool.add_hook(self.flush)
+
+    def geocode(self, location):
+        """
+        Returns a Future for the PostgisResult of geocoding location, or
+        the exception (usually a GeocoderException or ParsingError) it
+        raises.
+        """
+        future = Future(self.pool)
+        self.waiting.append((location, future))
+        return future
+
+    def geocode_many(self, locations, batch_size=None):
+        """
+        Yields (location, result, error) for every location, in input
+        order, like LocalGeocoder.geocode_many(), with a few batches in
+        flight at once.
+        """
+        batch_size = batch_size or self.batch_size
+        in_flight = collections.deque()
+        for location in locations:
+            in_flight.append((location, self.geocode(location)))
+            if len(in_flight) >= batch_size * 4:
+                for item in self.finish_first(in_flight, batch_size):
+                    yield item
+        while in_flight:
+            for item in self.finish_first(in_flight, len(in_flight)):
+                yield item
+
+    def finish_first(self, in_flight, n):
+        first = [in_flight.popleft() for i in range(min(n, len(in_flight)))]
+        self.pool.run_until_complete([future for location, future in first])
+        for location, future in first:
+            yield location, future.value, future.error
+
+    def flush(self):
+        while self.waiting:
+            batch, self.waiting = self.waiting[:self.batch_size], self.waiting[self.batch_size:]
+            self.start_batch(batch)
+
+    def start_batch(self, batch):
+        locations = [location for location, future in batch]
+        block_streets, intersection_streets = streets_for(locations, self.spelling)
+        queries = [
+            (self.block_searcher, self.block_searcher.streets_query(block_streets)),
+            (self.intersection_searcher, self.intersection_searcher.streets_query(intersection_streets)),
+        ]
+        fetches = []
+        for searcher, query in queries:
+            if query is None:
+                fetch = Future(self.pool)
+                fetch.set_result([])
+            else:
+                fetch = self.pool.submit(*query)
+            fetches.append((searcher, fetch))
+
+        def fetched(future):
+            if not all(fetch.done() for searcher, fetch in fetches):
+                return
+            for searcher, fetch in fetches:
+                if fetch.error is not None:
+                    for location, f in batch:
+                        f.set_exception(fetch.error)
+                    return
+            block_rows, intersection_rows = [[dict(zip(searcher.row_columns, row)) for row in fetch.value]
+                                             for searcher, fetch in fetches]
+            self.geocode_batch(batch, block_rows, intersection_rows)
+        for searcher, fetch in fetches:
+            fetch.add_done_callback(fetched)
+
+    def geocode_batch(self, batch, block_rows, intersection_rows):
+        # This runs inside pool.poll(), so nothing may escape from it with
+        # futures left unfinished.
+        try:
+            geocoder = LocalGeocoder(None, MemoryBlockSearcher(block_rows), MemoryIntersectionSearcher(intersection_rows),
+                                     spelling=self.spelling)
+        except Exception, e:
+            for location, future in batch:
+                future.set_exception(e)
+            return
+        for location, future in batch:
+            try:
+                result = geocoder.geocode(location)
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
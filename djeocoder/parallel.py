@@ -0,0 +1,109 @@
+"""
+Spreads geocoding over a pool of worker processes, for batch jobs on
+multi-core machines; parsing and building results are pure Python, so
+threads can't do this.
+
+    geocoder = ParallelGeocoder(processes=32, dsn='dbname=openblock user=...')
+    for location, result, error in geocoder.geocode_many(locations):
+        ...
+    print geocoder.stats()
+    geocoder.close()
+"""
+import collections
+import itertools
+import multiprocessing
+import os
+import time
+
+from cache import GeocodeCache
+from djeocoder import LocalGeocoder
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Each worker process builds its own geocoder once, in _init_worker().
+_worker_geocoder = None
+
+def _init_worker(dsn, blocks_file, intersections_file, cache_file=None):
+    global _worker_geocoder
+    cache = cache_file and GeocodeCache(cache_file) or None
+    if dsn:
+        import psycopg2
+        _worker_geocoder = LocalGeocoder(psycopg2.connect(dsn), cache=cache)
+    else:
+        _worker_geocoder = LocalGeocoder.from_files(blocks_file, intersections_file, cache=cache)
+
+def _geocode_chunk(locations):
+    start = time.time()
+    results = list(_worker_geocoder.geocode_many(locations, batch_size=len(locations)))
+    return os.getpid(), time.time() - start, results
+
+class ParallelGeocoder:
+    """
+    Geocodes batches of locations across a multiprocessing pool, with the
+    same geocode_many() interface as LocalGeocoder.
+
+    Workers search PostGIS through dsn if it's given, and otherwise load
+    the blocks and intersections files into memory. With cache_file, they
+    share a cache.GeocodeCache in that file.
+    """
+    def __init__(self, processes=None, dsn=None, blocks_file=None, intersections_file=None, chunk_size=1000, cache_file=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.pool = multiprocessing.Pool(self.processes, _init_worker, (
+            dsn,
+            blocks_file or os.path.join(DATA_DIR, 'blocks.txt.gz'),
+            intersections_file or os.path.join(DATA_DIR, 'intersections.txt.gz'),
+            cache_file,
+        ))
+        # pid -> [locations geocoded, seconds spent geocoding]
+        self.worker_stats = {}
+
+    def geocode_many(self, locations, batch_size=None):
+        """
+        Yields a (location, result, error) triple for every location, in
+        input order, exactly as LocalGeocoder.geocode_many() does.
+
+        Locations are sent to the workers in chunks of batch_size (by
+        default, the chunk_size given to the constructor), with only a few
+        chunks per worker in flight at once, so the input can be arbitrarily
+        long.
+        """
+        batch_size = batch_size or self.chunk_size
+        locations = iter(locations)
+        pending = collections.deque()
+        max_pending = self.processes * 2
+        while True:
+            while len(pending) < max_pending:
+                chunk = list(itertools.islice(locations, batch_size))
+                if not chunk:
+                    break
+                pending.append(self.pool.apply_async(_geocode_chunk, (chunk,)))
+            if not pending:
+                break
+            pid, seconds, results = pending.popleft().get()
+            stats = self.worker_stats.setdefault(pid, [0, 0.0])
+            stats[0] += len(results)
+            stats[1] += seconds
+            for item in results:
+                yield item
+
+    def stats(self):
+        """
+        Returns each worker's throughput so far, keyed by process id.
+        """
+        stats = {}
+        for pid, (count, seconds) in self.worker_stats.items():
+            stats[pid] = {
+                'locations': count,
+                'seconds': seconds,
+                'per_second': seconds and count / seconds or 0.0,
+            }
+        return stats
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+
+_missing = object()
+
+class LRUCache(object):
+    """
+    A size-bounded, thread-safe least-recently-used cache.
+
+    >>> cache = LRUCache(2)
+    >>> cache.put('a', 1)
+    >>> cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.stats().items())
+    [('evictions', 1), ('hits', 1), ('maxsize', 2), ('misses', 1), ('size', 2)]
+    """
+    def __init__(self, maxsize):
+        if maxsize < 1:
+            raise ValueError('LRUCache maxsize must be at least 1, got %r' % maxsize)
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.pop(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            # Re-inserting moves the key to the most-recently-used end.
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+            }
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
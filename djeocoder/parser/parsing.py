@@ -1,12 +1,12 @@
 import re
 import string
-from itertools import izip
 
 # The following are all relative imports
 from suffixes import suffixes
 from states import states
 from cities import cities
 from numbered_streets import numbered_streets
+from lru import LRUCache
 
 class ParsingError(Exception):
     pass
@@ -39,6 +39,8 @@ class Standardizer(object):
     'N'
     >>> dir_standardizer("n")
     'N'
+    >>> "Avenu" in suff_standardizer, "Avenues" in suff_standardizer
+    (True, False)
     """
     def __init__(self, d):
         self.replacement = {}
@@ -52,10 +54,13 @@ class Standardizer(object):
             self.replacement[standard] = standard
 
     def __call__(self, s):
-        if s.upper() in self.replacement:
-            return self.replacement[s.upper()]
-        else:
-            return s
+        upper = s.upper()
+        if upper in self.replacement:
+            return self.replacement[upper]
+        return s
+
+    def __contains__(self, s):
+        return s.upper() in self.replacement
 
 def number_standardizer(s):
     """
@@ -101,6 +106,16 @@ def normalize(location):
     >>> normalize(u"n kimball ave & w diversey ave")
     u'N KIMBALL AVE & W DIVERSEY AVE'
     """
+    cache = _cache
+    if cache is None:
+        return _normalize(location)
+    normalized = cache.normalized.get(location)
+    if normalized is None:
+        normalized = _normalize(location)
+        cache.normalized.put(location, normalized)
+    return normalized
+
+def _normalize(location):
     location = location.upper()
     location = half_addresses_re.sub('', location) # Strip "1/2" addresses.
     location = multi_dash_re.sub('-', location)
@@ -155,14 +170,17 @@ def abbrev_regex(d, case_insensitive=True, matches_entirely=True):
         pattern = "(?i)" + pattern
     return pattern
 
-directional_re = re.compile(abbrev_regex(DIRECTIONALS))
+# Token types that are a word from a fixed list, in any case: the words
+# their standardizers know. They're looked up in VOCABULARY_BITS rather than
+# matched against an alternation of every word.
+VOCABULARY_TYPES = ('pre_dir', 'suffix', 'post_dir')
 
+# The rest are recognized by their shape. (There are lists of cities and
+# states, but only to standardize them; any word of the right length can be
+# a city or a state.)
 TOKEN_REGEXES = {
     'number': re.compile(r'^\d+[A-Z]?(?:-\d+[A-Z]?)?$'),
-    'pre_dir': directional_re,
     'street': re.compile(r'^[0-9]{1,3}(?:ST|ND|RD|TH)|[A-Z]{1,25}|[0-9]{1,3}$'),
-    'suffix': re.compile(abbrev_regex(suffixes)),
-    'post_dir': directional_re,
 
     # Cities are assumed to have at least three letters and at most 25 letters.
     # This is a safe assumption that comes from this page:
@@ -177,6 +195,56 @@ TOKEN_REGEXES = {
     'zip': re.compile(r'^\d{5}(?:-\d{4})?$'),
 }
 
+########################
+# TOKEN CLASSIFICATION #
+########################
+
+TOKEN_TYPES = ('number', 'pre_dir', 'street', 'suffix', 'post_dir', 'city', 'state', 'zip')
+TOKEN_BITS = dict((token_type, 1 << i) for i, token_type in enumerate(TOKEN_TYPES))
+
+def _vocabulary_bits():
+    # Words in more than one vocabulary (every directional is both a pre_dir
+    # and a post_dir) get all of their bits.
+    bits = {}
+    for token_type in VOCABULARY_TYPES:
+        for word in STANDARDIZERS[token_type].replacement:
+            bits[word] = bits.get(word, 0) | TOKEN_BITS[token_type]
+    return bits
+
+# Upper-cased word -> the bits of the vocabulary types it belongs to.
+VOCABULARY_BITS = _vocabulary_bits()
+
+TOKEN_CLASSIFIERS = tuple((TOKEN_REGEXES[token_type].match, TOKEN_BITS[token_type])
+                          for token_type in TOKEN_TYPES if token_type in TOKEN_REGEXES)
+
+def classify_token(token):
+    """
+    Returns a bitmask of every token type (see TOKEN_BITS) that a single
+    normalized token could be.
+
+    >>> classify_token('60604') == TOKEN_BITS['number'] | TOKEN_BITS['zip']
+    True
+    >>> token_types_for(classify_token('N'))
+    ['pre_dir', 'street', 'post_dir']
+    """
+    mask = VOCABULARY_BITS.get(token.upper(), 0)
+    for match, bits in TOKEN_CLASSIFIERS:
+        if match(token):
+            mask |= bits
+    return mask
+
+def classify_tokens(tokens):
+    """
+    Returns the classify_token() bitmask of each token in a list of tokens.
+    """
+    return [classify_token(token) for token in tokens]
+
+def token_types_for(mask):
+    """
+    Returns the names of the token types set in a classify_token() bitmask.
+    """
+    return [token_type for token_type in TOKEN_TYPES if mask & TOKEN_BITS[token_type]]
+
 class Location(dict):
     location_keys = ('number', 'pre_dir', 'street', 'suffix', 'post_dir', 'city', 'state', 'zip')
 
@@ -212,43 +280,196 @@ def address_combinations():
                                 for zip_times in (0, 1):
                                     yield ['number'] * number_times + ['pre_dir'] * pre_dir_times + ['street'] * street_times + ['suffix'] * suffix_times + ['post_dir'] * post_dir_times + ['city'] * city_times + ['state'] * state_times + ['zip'] * zip_times
 
+class ParseNode(object):
+    """
+    A node in the compiled grammar built by compile_combinations().
+
+    children is a tuple of (token_bit, ParseNode) pairs, remaining is the set
+    of token counts that can still be consumed below this node, and
+    combination is (index, token_types, spans) if a complete address ends here.
+    """
+    __slots__ = ('children', 'remaining', 'combination')
+
+    def __init__(self):
+        self.children = {}
+        self.remaining = set()
+        self.combination = None
+
+def compile_combinations(combinations):
+    """
+    Compiles a list of token-type lists into a trie, so that parse() can walk
+    the tokens once instead of testing every combination.
+
+    >>> root = compile_combinations([['number', 'street'], ['street']])
+    >>> [token_types_for(bit) for bit, child in root.children]
+    [['number'], ['street']]
+    >>> sorted(root.remaining)
+    [1, 2]
+    """
+    root = ParseNode()
+    nodes = [root]
+    for index, token_types in enumerate(combinations):
+        node = root
+        node.remaining.add(len(token_types))
+        for depth, token_type in enumerate(token_types):
+            if token_type not in node.children:
+                node.children[token_type] = ParseNode()
+                nodes.append(node.children[token_type])
+            node = node.children[token_type]
+            node.remaining.add(len(token_types) - depth - 1)
+
+        # Precompute the token span covered by each token type, so building a
+        # Location is just a matter of joining slices.
+        spans = []
+        for i, token_type in enumerate(token_types):
+            if spans and spans[-1][0] == token_type:
+                spans[-1][2] = i + 1
+            else:
+                spans.append([token_type, i, i + 1])
+        node.combination = (index, tuple(token_types), tuple(tuple(span) for span in spans))
+
+    # Freeze everything now that the trie is complete.
+    for node in nodes:
+        node.children = tuple(sorted((TOKEN_BITS[token_type], child) for token_type, child in node.children.items()))
+        node.remaining = frozenset(node.remaining)
+    return root
+
+PARSE_TREE = compile_combinations(address_combinations())
+
+def match_combinations(classes, tree=PARSE_TREE):
+    """
+    Given the classify_tokens() bitmasks of a list of tokens, returns the
+    (index, token_types, spans) of every combination in tree that matches,
+    in the order the combinations were compiled.
+    """
+    len_tokens = len(classes)
+    if len_tokens not in tree.remaining:
+        return []
+
+    matched = []
+    stack = [(tree, 0)]
+    while stack:
+        node, i = stack.pop()
+        if i == len_tokens:
+            matched.append(node.combination)
+            continue
+        remaining = len_tokens - i - 1
+        token_class = classes[i]
+        for token_bit, child in node.children:
+            if token_class & token_bit and remaining in child.remaining:
+                stack.append((child, i + 1))
+    matched.sort()
+    return matched
+
 punc_split = re.compile(r"\S+").findall
 
-def parse(location):
-    s = strip_unit(normalize(location))
-    tokens = punc_split(s)
-    len_tokens = len(tokens)
+def parse_tokens(tokens):
+    """
+    Returns a list of every Location that a list of normalized tokens could
+    be, which is empty if the tokens can't be parsed.
+    """
     result_list = []
+    for index, token_types, spans in match_combinations(classify_tokens(tokens)):
+        # All of the tokens are valid, so create the Location object.
+        result = Location()
+        for token_type, start, end in spans:
+            result[token_type] = ' '.join(tokens[start:end])
+
+        # Standardize all values.
+        for key, value in result.items():
+            if value and key in STANDARDIZERS:
+                result[key] = STANDARDIZERS[key](value)
+
+        result_list.append(result)
+    return result_list
 
-    for token_types in address_combinations():
-        if len(token_types) == len_tokens:
-            try:
-                for token, token_type in izip(tokens, token_types):
-                    if not TOKEN_REGEXES[token_type].match(token):
-                        raise StopIteration() # Token regex didn't match.
-            except StopIteration:
-                continue
-
-            # If we made it this far, then all of the tokens are valid.
-            # Create the Location object.
-            result = Location()
-            for token, token_type in izip(tokens, token_types):
-                if result[token_type]:
-                    result[token_type] += ' ' + token
-                else:
-                    result[token_type] = token
-
-            # Standardize all values.
-            for key, value in result.items():
-                if value and key in STANDARDIZERS:
-                    result[key] = STANDARDIZERS[key](value)
-
-            result_list.append(result)
+def parse(location, normalized=None):
+    """
+    Returns the possible Locations that location could be. normalized, if
+    given, is normalize(location), for callers that already have it.
+    """
+    cache = _cache
+    if cache is None:
+        if normalized is None:
+            normalized = normalize(location)
+        result_list = parse_tokens(punc_split(strip_unit(normalized)))
+    else:
+        # Results are cached under both the raw string and the normalized
+        # string, so differently-formatted copies of the same location share
+        # an entry. Failed parses are cached too, as an empty tuple.
+        results = cache.parsed.get(('raw', location))
+        if results is None:
+            if normalized is None:
+                normalized = normalize(location)
+            s = strip_unit(normalized)
+            results = cache.parsed.get(('normalized', s))
+            if results is None:
+                results = tuple(parse_tokens(punc_split(s)))
+                cache.parsed.put(('normalized', s), results)
+            cache.parsed.put(('raw', location), results)
+        # Hand out copies, so callers can't modify the cached Locations.
+        result_list = [Location(result) for result in results]
 
     if not result_list:
         raise ParsingError("Failed to parse location %r" % location)
     return result_list
 
+###########
+# CACHING #
+###########
+
+class ParseCache(object):
+    """
+    Memoizes normalize() and parse(); see enable_cache().
+    """
+    def __init__(self, maxsize):
+        self.normalized = LRUCache(maxsize)
+        self.parsed = LRUCache(maxsize)
+
+    def clear(self):
+        self.normalized.clear()
+        self.parsed.clear()
+
+    def stats(self):
+        return {
+            'normalize': self.normalized.stats(),
+            'parse': self.parsed.stats(),
+        }
+
+_cache = None
+
+def enable_cache(maxsize=10000):
+    """
+    Turns on memoization of normalize() and parse(), keeping at most maxsize
+    entries for each. The cache is shared by every thread in the process.
+
+    >>> cache = enable_cache(100)
+    >>> parse('1 Nob Hill') == parse('1 NOB HILL.')
+    True
+    >>> cache_stats()['parse']['hits']
+    1
+    >>> disable_cache()
+    >>> cache_stats() is None
+    True
+    """
+    global _cache
+    _cache = ParseCache(maxsize)
+    return _cache
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+def cache_stats():
+    """
+    Returns the hits, misses, evictions and size of the normalize() and
+    parse() caches, or None if caching isn't enabled.
+    """
+    cache = _cache
+    if cache is None:
+        return None
+    return cache.stats()
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -10,9 +10,22 @@ from parsing import parse
 from parsing import address_combinations
 from parsing import ParsingError 
 from parsing import Location
+from parsing import TOKEN_REGEXES, punc_split, match_combinations
+from parsing import classify_token, classify_tokens, token_types_for
+from parsing import enable_cache, disable_cache, cache_stats
+from parsing import abbrev_regex, DIRECTIONALS, STANDARDIZERS
+from suffixes import suffixes
 
+import re
 import unittest
 
+# Every token type as a regex, as they were before the vocabulary types were
+# looked up in a dict, to check classify_token() against.
+ALL_TOKEN_REGEXES = dict(TOKEN_REGEXES,
+    pre_dir=re.compile(abbrev_regex(DIRECTIONALS)),
+    suffix=re.compile(abbrev_regex(suffixes)),
+    post_dir=re.compile(abbrev_regex(DIRECTIONALS)))
+
 class AutoLocationMetaclass(type):
     """
     Metaclass that adds a test method for every combination of test data
@@ -265,5 +278,86 @@ class LocationTestCase(unittest.TestCase):
             {'number': '1110', 'pre_dir': None, 'street': 'BRONX RIVER', 'suffix': 'AVE', 'post_dir': None, 'city': 'THE BRONX', 'state': None, 'zip': None},
         )
 
+class CompiledGrammarTestCase(unittest.TestCase):
+    """
+    Checks that the compiled grammar finds exactly the combinations that a
+    brute-force scan of address_combinations() would find, in the same order.
+    """
+    LOCATIONS = (
+        '228 S BROADWAY AVE S CHICAGO IL 60604',
+        '11466 S ST LOUIS AVE CHICAGO IL 60655',
+        '260 W 44TH NEW YORK NY 10036',
+        '1 NOB HILL',
+        'N KIMBALL AVE',
+        '830 N MIES VAN DER ROHE WY',
+        '25-82 MAIN ST QUEENS',
+        '123 MAIN ST THE BRONX NEW YORK 10001',
+        '',
+    )
+
+    def brute_force(self, tokens):
+        matched = []
+        for token_types in address_combinations():
+            if len(token_types) != len(tokens):
+                continue
+            for token, token_type in zip(tokens, token_types):
+                if not ALL_TOKEN_REGEXES[token_type].match(token):
+                    break
+            else:
+                matched.append(tuple(token_types))
+        return matched
+
+    def test_matches_brute_force(self):
+        for location in self.LOCATIONS:
+            tokens = punc_split(location)
+            expected = self.brute_force(tokens)
+            actual = [token_types for index, token_types, spans in match_combinations(classify_tokens(tokens))]
+            self.assertEqual(actual, expected, location)
+
+    def test_classify_token(self):
+        for location in self.LOCATIONS:
+            for token in punc_split(location):
+                expected = [t for t in ALL_TOKEN_REGEXES if ALL_TOKEN_REGEXES[t].match(token)]
+                self.assertEqual(sorted(token_types_for(classify_token(token))), sorted(expected), token)
+
+    def test_classify_vocabulary(self):
+        words = set(STANDARDIZERS['suffix'].replacement) | set(STANDARDIZERS['pre_dir'].replacement)
+        tokens = set()
+        for word in words:
+            tokens.update([word, word.lower(), word.title(), word + 'S', word[:-1], '1' + word])
+        for token in tokens:
+            expected = [t for t in ALL_TOKEN_REGEXES if ALL_TOKEN_REGEXES[t].match(token)]
+            self.assertEqual(sorted(token_types_for(classify_token(token))), sorted(expected), token)
+
+class ParseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        enable_cache(4)
+
+    def tearDown(self):
+        disable_cache()
+
+    def test_cached_results_match(self):
+        uncached = parse('11466 S Saint Louis Ave, Chicago, IL, 60655')
+        self.assertEqual(parse('11466 S Saint Louis Ave, Chicago, IL, 60655'), uncached)
+        self.assertEqual(parse('11466 s. saint louis ave chicago il 60655'), uncached)
+        stats = cache_stats()['parse']
+        self.assertEqual((stats['hits'], stats['misses']), (2, 3))
+
+    def test_defensive_copies(self):
+        parse('1 Nob Hill')[0]['street'] = 'CHANGED'
+        self.assertNotEqual(parse('1 Nob Hill')[0]['street'], 'CHANGED')
+
+    def test_failures_cached(self):
+        self.assertRaises(ParsingError, parse, '')
+        self.assertRaises(ParsingError, parse, '')
+        self.assertEqual(cache_stats()['parse']['hits'], 1)
+
+    def test_evictions(self):
+        for number in range(10):
+            parse('%s Main St' % number)
+        stats = cache_stats()['parse']
+        self.assertEqual(stats['size'], 4)
+        self.assertEqual(stats['evictions'], 16)
+
 if __name__ == "__main__":
     unittest.main()
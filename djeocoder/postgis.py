@@ -1,17 +1,18 @@
+import hashlib
+import re
+import threading
+
 import psycopg2
+import psycopg2.pool
 
+import instrument
+from geometry import LineString, interpolation_fraction
+from parser.lru import LRUCache
 from parser.parsing import normalize, parse, ParsingError
-from results import BlockResult, IntersectionResult, parse_point
-
-class Correction:
-    def __init__(self, incorrect, correct):
-        self.incorrect = incorrect
-        self.correct = correct
+from results import BlockResult, IntersectionResult, PointParsingException, contains_number, parse_point
 
-class SpellingCorrector: 
-    def correct(self, incorrect):
-        # by default, correct nothing.
-        return Correction(incorrect, incorrect)
+# These used to live here.
+from spelling import Correction, SpellingCorrector
 
 # TODO: There's also a GeocoderException class in djeocoder.py
 # -- these should probably be merged.
@@ -21,12 +22,151 @@ class GeocodingException(Exception):
 class DoesNotExist(GeocodingException):
     pass
 
-class PointParsingException(Exception):
-    def __init__(self, str):
-        self.str = str
-    def __repr__(self):
-        return 'String \'%s\' could not be parsed into points.' % self.str
 
+class DirectConnection:
+    """
+    Runs the searchers' queries on a single psycopg2 connection, exactly as
+    given.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def fetchall(self, query, params):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+def fetchall(connections, query, params):
+    # All of the searchers' queries go through here, to be instrumented.
+    with instrument.timer('sql'):
+        rows = connections.fetchall(query, params)
+    instrument.count('sql_queries')
+    instrument.count('sql_rows', len(rows))
+    return rows
+
+placeholder_re = re.compile(r'%([%s])')
+
+def numbered_placeholders(query):
+    """
+    Rewrites a query's psycopg2 placeholders as PREPARE's numbered ones.
+
+    >>> numbered_placeholders('select * from blocks where street=%s and from_num %% 2 = %s')
+    'select * from blocks where street=$1 and from_num % 2 = $2'
+    """
+    counter = [0]
+    def replace(m):
+        if m.group(1) == '%':
+            return '%'
+        counter[0] += 1
+        return '$%d' % counter[0]
+    return placeholder_re.sub(replace, query)
+
+class ConnectionPool:
+    """
+    A thread-safe pool of connections for the searchers, which can be passed
+    anywhere a connection is expected (e.g. PostgisBlockSearcher(pool) or
+    LocalGeocoder(pool)).
+
+    Each distinct query the searchers build -- one per combination of
+    filters -- is PREPAREd the first time it's run on a connection, and
+    EXECUTEd from then on, so the server only plans it once per connection.
+
+    When all maxconn connections are in use, getconn() waits for one to be
+    put back.
+    """
+    def __init__(self, dsn, minconn=None, maxconn=10, prepare=True):
+        # psycopg2's pool closes connections returned beyond minconn, which
+        # would throw away their prepared statements, so by default it keeps
+        # all of them.
+        if minconn is None:
+            minconn = maxconn
+        self.pool = self.connect(dsn, minconn, maxconn)
+        self.prepare = prepare
+        # Statement names prepared on each open connection.
+        self.prepared = {}
+        self.lock = threading.Lock()
+        # psycopg2's pool raises PoolError rather than waiting when every
+        # connection is out, so callers wait here first.
+        self.available = threading.BoundedSemaphore(maxconn)
+
+    def connect(self, dsn, minconn, maxconn):
+        return psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+
+    def getconn(self):
+        self.available.acquire()
+        try:
+            conn = self.pool.getconn()
+        except:
+            self.available.release()
+            raise
+        # The searchers only read, and PREPARE shouldn't be tied to a
+        # transaction the pool might roll back.
+        if not conn.autocommit:
+            conn.autocommit = True
+        return conn
+
+    def putconn(self, conn, close=False):
+        try:
+            self.pool.putconn(conn, close=close)
+        finally:
+            self.available.release()
+        if conn.closed:
+            with self.lock:
+                self.prepared.pop(conn, None)
+
+    def closeall(self):
+        with self.lock:
+            self.prepared.clear()
+        self.pool.closeall()
+
+    def statement_name(self, query):
+        return 'djeocoder_%s' % hashlib.md5(query).hexdigest()[:16]
+
+    def fetchall(self, query, params):
+        conn = self.getconn()
+        close = False
+        try:
+            return self.execute(conn, query, params)
+        except psycopg2.Error:
+            # Don't trust what we know about a connection that's gone bad:
+            # close it, along with whatever it has prepared on the server,
+            # rather than pool it with statements we've lost track of.
+            close = True
+            raise
+        finally:
+            self.putconn(conn, close)
+
+    def execute(self, conn, query, params):
+        cursor = conn.cursor()
+        try:
+            if not self.prepare:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+            name = self.statement_name(query)
+            with self.lock:
+                prepared = self.prepared.setdefault(conn, set())
+            if name not in prepared:
+                cursor.execute('PREPARE %s AS %s' % (name, numbered_placeholders(query)))
+                prepared.add(name)
+            if params:
+                cursor.execute('EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(params))), params)
+            else:
+                cursor.execute('EXECUTE %s' % name)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+def connection_provider(conn):
+    """
+    Returns something with a fetchall(query, params) method for conn, which
+    is either a ConnectionPool or a plain psycopg2 connection.
+    """
+    if isinstance(conn, ConnectionPool):
+        return conn
+    return DirectConnection(conn)
 
 class PostgisBlockSearcher:
     """
@@ -34,57 +174,46 @@ class PostgisBlockSearcher:
     Handles interaction with the underlying database, taking a call to the search() method, converting it into a query,
     and then forming the response rows into BlockResult objects.
     """
-    def __init__(self, conn): 
+    # Parsed block geometries, keyed by block id and shared by all searchers,
+    # so a block's linestring is only parsed the first time it's found.
+    geometry_cache = LRUCache(50000)
+
+    def __init__(self, conn, single_query=False): 
+        """
+        If single_query is True, the parity check and interpolation are done
+        in the database (see search_single_query()), rather than in Python.
+        """
         self.conn =conn
+        self.connections = connection_provider(conn)
+        self.single_query = single_query
         
     def close(self):
         # self.conn.close()
         pass
 
+    def line(self, block_id, wkt_str):
+        cached = self.geometry_cache.get(block_id)
+        # Check the WKT too, in case the block's geometry was changed.
+        if cached is None or cached[0] != wkt_str:
+            cached = (wkt_str, LineString.from_wkt(wkt_str))
+            self.geometry_cache.put(block_id, cached)
+        return cached[1]
+
     def contains_number(self, number, from_num, to_num, left_from_num, left_to_num, right_from_num, right_to_num):
         """
-        Copied almost verbatim from the corresponding EveryBlock class.
-        
-        Attempts to discover whether a particular triple of ranges
-          [ (from_num, to_num), (left_from_num, left_to_num), (right_from_num, right_to_num) ]
-        contains the given number.  The trick is that the number's parity may not match the parity of either the corresponding
-        left or right range...
+        See results.contains_number().
         """
-        if not number: return True, from_num, to_num
-        
-        parity = int(number) % 2
-        if left_from_num and right_from_num:
-            left_parity = left_from_num % 2
-            # If this block's left side has the same parity as the right side,
-            # all bets are off -- just use the from_num and to_num.
-            if right_to_num % 2 == left_parity or left_to_num % 2 == right_from_num % 2:
-                from_num, to_num = from_num, to_num
-            elif left_parity == parity:
-                from_num, to_num = left_from_num, left_to_num
-            else:
-                from_num, to_num = right_from_num, right_to_num
-        elif left_from_num:
-            from_parity, to_parity = left_from_num % 2, left_to_num % 2
-            from_num, to_num = left_from_num, left_to_num
-            # If the parity is equal for from_num and to_num, make sure the
-            # parity of the number is the same.
-            if (from_parity == to_parity) and from_parity != parity:
-                return False, from_num, to_num
-            else:
-                from_parity, to_parity = right_from_num % 2, right_to_num % 2
-                from_num, to_num = right_from_num, right_to_num
-                # If the parity is equal for from_num and to_num, make sure the
-                # parity of the number is the same.
-                if (from_parity == to_parity) and from_parity != parity:
-                    return False, from_num, to_num
-        return (from_num <= number <= to_num), from_num, to_num
+        return contains_number(number, from_num, to_num, left_from_num, left_to_num, right_from_num, right_to_num)
 
-    def search(self,street,number=None,pre_dir=None,suffix=None,post_dir=None,city=None,state=None,zip=None,left_city=None,right_city=None):
-        query = 'select id, pretty_name, from_num, to_num, left_from_num, left_to_num, right_from_num, right_to_num, ST_AsEWKT(geom) from blocks where street=%s' 
+    def filters(self,street,number=None,pre_dir=None,suffix=None,post_dir=None,city=None,state=None,zip=None):
+        """
+        Returns the where clause for a search, and its parameters.
+        """
+        query = 'street=%s'
         params = [street.upper()]
         if pre_dir: 
             query += ' and predir=%s' 
-            params.apepnd(pre_dir.upper())
+            params.append(pre_dir.upper())
         if suffix: 
             query += ' and suffix=%s' 
             params.append(suffix.upper())
@@ -105,56 +234,153 @@ class PostgisBlockSearcher:
         if number: 
             query += ' and from_num <= %s and to_num >= %s' 
             params.extend([number, number])
+        return query, params
 
-        cursor = self.conn.cursor()
-        cursor.execute(query, tuple(params))
+    # The columns of the blocks table, named as in textfiles.BlockFileLoader.
+    row_columns = ['id', 'pretty_name', 'predir', 'street', 'suffix', 'postdir', 'left_from_num', 'left_to_num', 'right_from_num', 'right_to_num', 'from_num', 'to_num', 'left_zip', 'right_zip', 'left_city', 'right_city', 'left_state', 'right_state', 'geom']
+
+    def search_streets(self, streets):
+        """
+        Fetches every block on any of the given streets in one query, as
+        dicts that memory.MemoryBlockSearcher can index.
+        """
+        query = self.streets_query(streets)
+        if query is None:
+            return []
+        return [dict(zip(self.row_columns, row)) for row in fetchall(self.connections, *query)]
+
+    def streets_query(self, streets):
+        """
+        Returns the (query, params) that search_streets() runs, or None if
+        there are no streets to search for.
+        """
+        streets = sorted(set(s.upper() for s in streets if s))
+        if not streets:
+            return None
+        return 'select %s, ST_AsEWKT(geom) from blocks where street = ANY(%%s)' % ', '.join(self.row_columns[:-1]), (streets,)
+
+    street_names_query = 'select street, count(*) from blocks group by street'
+
+    def street_names(self):
+        """
+        Returns a dict of each street name to how many blocks it has.
+        """
+        return dict(fetchall(self.connections, self.street_names_query, ()))
+
+    def search(self,street,number=None,pre_dir=None,suffix=None,post_dir=None,city=None,state=None,zip=None,left_city=None,right_city=None):
+        if self.single_query:
+            return self.search_single_query(street, number, pre_dir, suffix, post_dir, city, state, zip)
+
+        where, params = self.filters(street, number, pre_dir, suffix, post_dir, city, state, zip)
+        query = 'select id, pretty_name, from_num, to_num, left_from_num, left_to_num, right_from_num, right_to_num, ST_AsEWKT(geom) from blocks where ' + where
 
         blocks = []
-        for block in cursor.fetchall(): 
+        rows = fetchall(self.connections, query, tuple(params))
+        for block in rows: 
             containment = self.contains_number(number, block[2], block[3], block[4], block[5], block[6], block[7])
             if containment[0]: blocks.append([block, containment[1], containment[2]])
+        instrument.count('blocks_rejected', len(rows) - len(blocks))
             
         final_blocks = []
         
         for b in blocks: 
             block = b[0]
-            from_num = b[1]
-            to_num = b[2]
-            try:
-                fraction = (float(number) - from_num) / (to_num - from_num)
-            except TypeError:
-                # TODO: revisit this clause.  We're getting here because the 'number' field was zero.  What do
-                # we do in this case?  What does the original code do? 
-                fraction = 0.5
-            except ZeroDivisionError:
-                fraction = 0.5
-
-            # TODO: when we want to extract the geocoder from dependence on
-            # Postgis, this is one of the main dependencies: we'll need to introduce
-            # a new GIS library, so that we can do this interpolation "in code" -TWD
-            cursor.execute('SELECT ST_AsEWKT(line_interpolate_point(%s, %s))', [block[8], fraction])
-            wkt_str = cursor.fetchone()[0]
+            fraction = interpolation_fraction(number, b[1], b[2])
+            # Interpolating here, rather than with a line_interpolate_point()
+            # query per block, saves a round trip for every candidate; see
+            # geometry.py for how closely this agrees with PostGIS.
+            with instrument.timer('interpolate'):
+                point = self.line(block[0], block[8]).interpolate(fraction)
+            final_blocks.append(BlockResult(block, point))
             
-            x,y = parse_point(wkt_str)
-            final_blocks.append(BlockResult(block, wkt_str))
-            
-        cursor.close()
         return final_blocks
 
+    # The SQL equivalent of contains_number(): the range (as a two-element
+    # array) whose parity matches the number, and whether a block with only
+    # one side numbered has the wrong parity altogether. Both take the
+    # number's parity as their single parameter.
+    range_sql = """
+        case
+            when coalesce(left_from_num, 0) <> 0 and coalesce(right_from_num, 0) <> 0 then
+                case
+                    when right_to_num %% 2 = left_from_num %% 2 or left_to_num %% 2 = right_from_num %% 2 then array[from_num, to_num]
+                    when left_from_num %% 2 = %s then array[left_from_num, left_to_num]
+                    else array[right_from_num, right_to_num]
+                end
+            when coalesce(left_from_num, 0) <> 0 then array[left_from_num, left_to_num]
+            when coalesce(right_from_num, 0) <> 0 then array[right_from_num, right_to_num]
+            else array[from_num, to_num]
+        end"""
+    wrong_parity_sql = """
+        case
+            when coalesce(left_from_num, 0) <> 0 and coalesce(right_from_num, 0) <> 0 then false
+            when coalesce(left_from_num, 0) <> 0 then left_from_num %% 2 = left_to_num %% 2 and left_from_num %% 2 <> %s
+            when coalesce(right_from_num, 0) <> 0 then right_from_num %% 2 = right_to_num %% 2 and right_from_num %% 2 <> %s
+            else false
+        end"""
+
+    # Called line_interpolate_point() before PostGIS 1.5.
+    interpolate_function = 'ST_LineInterpolatePoint'
+
+    def search_single_query(self,street,number=None,pre_dir=None,suffix=None,post_dir=None,city=None,state=None,zip=None):
+        """
+        Does the same search as search(), but selects the parity-matched range
+        and interpolates the point in the database, so it's always exactly
+        one query.
+        """
+        where, where_params = self.filters(street, number, pre_dir, suffix, post_dir, city, state, zip)
+        columns = 'id, pretty_name, from_num, to_num, left_from_num, left_to_num, right_from_num, right_to_num, ST_AsEWKT(geom)'
+        if not number:
+            query = 'select %s, ST_AsEWKT(%s(geom, 0.5)) from blocks where %s' % (columns, self.interpolate_function, where)
+            params = where_params
+        else:
+            number = int(number)
+            parity = number % 2
+            query = ('select %s, ST_AsEWKT(%s(geom, case when r[2] = r[1] then 0.5 else (%%s - r[1])::float8 / (r[2] - r[1]) end))'
+                     ' from (select *, %s as r, %s as wrong_parity from blocks where %s) b'
+                     ' where not wrong_parity and r[1] <= %%s and %%s <= r[2]') % (columns, self.interpolate_function, self.range_sql, self.wrong_parity_sql, where)
+            params = [number, parity, parity, parity] + where_params + [number, number]
+
+        return [BlockResult(row[:9], row[9]) for row in fetchall(self.connections, query, tuple(params))]
+
 class PostgisIntersectionSearcher:
     """
     Replaces the IntersectionManager clmass.
     """
     def __init__(self,conn):
         self.connection = conn
+        self.connections = connection_provider(conn)
 
     def close(self):
         # self.connection.close()
         pass
     
+    # The columns of the intersections table, named as in textfiles.IntersectionFileLoader.
+    row_columns = ['id', 'pretty_name', 'predir_a', 'street_a', 'suffix_a', 'postdir_a', 'predir_b', 'street_b', 'suffix_b', 'postdir_b', 'zip', 'city', 'state', 'location']
+
+    def search_streets(self, streets):
+        """
+        Fetches every intersection involving any of the given streets in one
+        query, as dicts that memory.MemoryIntersectionSearcher can index.
+        """
+        query = self.streets_query(streets)
+        if query is None:
+            return []
+        return [dict(zip(self.row_columns, row)) for row in fetchall(self.connections, *query)]
+
+    def streets_query(self, streets):
+        """
+        Returns the (query, params) that search_streets() runs, or None if
+        there are no streets to search for.
+        """
+        streets = sorted(set(s.upper() for s in streets if s))
+        if not streets:
+            return None
+        query = 'select %s, ST_AsEWKT(location) from intersections where street_a = ANY(%%s) or street_b = ANY(%%s)' % ', '.join(self.row_columns[:-1])
+        return query, (streets, streets)
+
     def search(self, predir_a=None, street_a=None, suffix_a=None, postdir_a=None, predir_b=None, street_b=None, suffix_b=None, postdir_b=None):
-        cursor = self.connection.cursor()
-        query = 'select id, pretty_name, ST_AsEWKT(location) from intersections'
+        query = 'select id, pretty_name, ST_AsEWKT(location), zip, city, state from intersections'
         filters = []
         params = []
         if predir_a: 
@@ -195,8 +421,6 @@ class PostgisIntersectionSearcher:
         # print query
         # print filters
 
-        cursor.execute(query, params)
-        results = cursor.fetchall()
-        cursor.close()
+        results = fetchall(self.connections, query, tuple(params))
 
         return [IntersectionResult(res) for res in results]
@@ -1,20 +1,34 @@
 
 import re
 
+import instrument
+
 point_pattern = re.compile('POINT\((-?\d+\.\d+)\s+(-?\d+\.\d+)\)')
 
+class PointParsingException(Exception):
+    def __init__(self, str):
+        self.str = str
+    def __repr__(self):
+        return 'String \'%s\' could not be parsed into points.' % self.str
+
 def parse_point(wkt_str):
-    matcher = point_pattern.search(wkt_str)
-    if matcher==None: raise PointParsingException(wkt_str)
-    x = float(matcher.group(1))
-    y = float(matcher.group(2))
+    with instrument.timer('parse_point'):
+        matcher = point_pattern.search(wkt_str)
+        if matcher==None: raise PointParsingException(wkt_str)
+        x = float(matcher.group(1))
+        y = float(matcher.group(2))
     return x, y
 
 # I'd like the Searcher classes to return well-defined objects,
 # rather than raw tuples from the database.
 class LocatableResult:
     def __init__(self, location):
-        self.location = parse_point(location)
+        # location is either an EWKT point string from the database or an
+        # already-computed (x, y) pair.
+        if isinstance(location, tuple):
+            self.location = location
+        else:
+            self.location = parse_point(location)
     def __repr__(self):
         return '(%.5f,%.5f)' % (self.location[0], self.location[1])
 
@@ -37,47 +51,70 @@ class BlockResult(LocatableResult):
         return '%s %s' % ( self.pretty_name, LocatableResult.__repr__(self) )
         
     def contains_number(self, number):
-        parity = number % 2
-        fn, tn = self.from_num, self.to_num
-        
-        if self.left_from_num and self.right_from_num:
-            left_parity = self.left_from_num % 2
-
-            # If this block's left side has the same parity as the right side,
-            # all bets are off -- just use the from_num and to_num.
-            
-            if self.right_to_num % 2 == left_parity or self.left_to_num % 2 == self.right_from_num % 2:
-                fn, tn = self.from_num, self.to_num
-            elif left_parity == parity:
-                fn, tn = self.left_from_num, self.left_to_num
-            else:
-                fn, tn = self.right_from_num, self.right_to_num
-                
-        elif self.left_from_num:
-            from_parity, to_parity = self.left_from_num % 2, self.left_to_num % 2
-            fn, tn = self.left_from_num, self.left_to_num
-            
-            # If the parity is equal for from_num and to_num, make sure the
-            # parity of the number is the same.
-            if (from_parity == to_parity) and from_parity != parity:
-                return False, fn, tn
-            else:
-                from_parity, to_parity = self.right_from_num % 2, self.right_to_num % 2
-                fn, tn = self.right_from_num, self.right_to_num
-                
-                # If the parity is equal for from_num and to_num, make sure the
-                # parity of the number is the same.
-                if (from_parity == to_parity) and from_parity != parity:
-                    return False, fn, tn
-        return (fn <= number <= tn), fn, tn
+        return contains_number(number, self.from_num, self.to_num, self.left_from_num, self.left_to_num, self.right_from_num, self.right_to_num)
+
+def contains_number(number, from_num, to_num, left_from_num, left_to_num, right_from_num, right_to_num):
+    """
+    Copied almost verbatim from the corresponding EveryBlock class.
+
+    Attempts to discover whether a particular triple of ranges
+      [ (from_num, to_num), (left_from_num, left_to_num), (right_from_num, right_to_num) ]
+    contains the given number.  The trick is that the number's parity may not match the parity of either the corresponding
+    left or right range...
+
+    Returns a (contains, from_num, to_num) triple, where from_num and to_num are the range that was actually used.
+
+    >>> contains_number('25', 1, 24, 2, 24, 1, 23)
+    (False, 1, 23)
+    >>> contains_number(22, 1, 24, 2, 24, 1, 23)
+    (True, 2, 24)
+    >>> contains_number(None, 1, 24, 2, 24, 1, 23)
+    (True, 1, 24)
+    """
+    if not number: return True, from_num, to_num
+
+    number = int(number)
+    parity = number % 2
+    if left_from_num and right_from_num:
+        left_parity = left_from_num % 2
+        # If this block's left side has the same parity as the right side,
+        # all bets are off -- just use the from_num and to_num.
+        if right_to_num % 2 == left_parity or left_to_num % 2 == right_from_num % 2:
+            from_num, to_num = from_num, to_num
+        elif left_parity == parity:
+            from_num, to_num = left_from_num, left_to_num
+        else:
+            from_num, to_num = right_from_num, right_to_num
+    elif left_from_num:
+        from_parity, to_parity = left_from_num % 2, left_to_num % 2
+        from_num, to_num = left_from_num, left_to_num
+        # If the parity is equal for from_num and to_num, make sure the
+        # parity of the number is the same.
+        if (from_parity == to_parity) and from_parity != parity:
+            return False, from_num, to_num
+    elif right_from_num:
+        from_parity, to_parity = right_from_num % 2, right_to_num % 2
+        from_num, to_num = right_from_num, right_to_num
+        # If the parity is equal for from_num and to_num, make sure the
+        # parity of the number is the same.
+        if (from_parity == to_parity) and from_parity != parity:
+            return False, from_num, to_num
+    return (from_num <= number <= to_num), from_num, to_num
 
 class IntersectionResult(LocatableResult):
     """
     Objects of this class are returned by the PostgisIntersectionSearcher.search() method.
+
+    The tuple is (id, pretty_name, location), optionally followed by (zip, city, state).
     """
     def __init__(self, intersection_tuple):
         LocatableResult.__init__(self, intersection_tuple[2])
         self.id = intersection_tuple[0]
         self.pretty_name = intersection_tuple[1]
+        self.zip, self.city, self.state = (tuple(intersection_tuple[3:6]) + (None, None, None))[:3]
     def __repr__(self):
         return '%s %s' % (self.pretty_name, LocatableResult.__repr__(self))
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
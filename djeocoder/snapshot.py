@@ -0,0 +1,436 @@
+"""
+Compiles the pipe-delimited data files into binary snapshots that load by
+mmap()ing them, so startup doesn't have to gunzip and split the text, and
+every worker process on a machine shares the same pages.
+
+    python snapshot.py blocks.txt.gz          # writes blocks.txt.gz.snap
+    python snapshot.py --check blocks.txt.gz.snap
+
+A snapshot holds the same columns as textfiles.PipeFileLoader: string
+tables with a uint32 index per row for text, int32 arrays for ints, and
+flat float64 coordinate buffers with uint32 offsets for geometries. It also
+holds prebuilt postings (the rows having each value, and the values in
+sorted order, to find one by binary search) for the loader's index_columns,
+which the searchers in memory.py look streets up in. Everything is read in
+place from the mmap, so opening a snapshot takes about as long as checking
+it. The header records the size, mtime and MD5 of the source file, so
+load() can tell when a snapshot is stale and fall back to the text loader,
+plus a CRC32 of the body, which load() checks too.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+from textfiles import BlockFileLoader, IntersectionFileLoader, RowView, Scan, NULL_INT
+
+MAGIC = 'DJEOSNAP'
+VERSION = 2
+
+# magic, version, byte order, rows, body CRC32, source size, source mtime,
+# source MD5, directory offset, directory length
+HEADER = struct.Struct('<8sIBxxxQIxxxxQd32sQQ')
+
+LOADER_CLASSES = {
+    'blocks': BlockFileLoader,
+    'intersections': IntersectionFileLoader,
+}
+
+# Columns to build postings for, by loader class.
+INDEX_COLUMNS = {
+    BlockFileLoader: ('street',),
+    IntersectionFileLoader: ('street_a', 'street_b'),
+}
+
+class SnapshotError(Exception):
+    pass
+
+def file_md5(filename):
+    digest = hashlib.md5()
+    inf = open(filename, 'rb')
+    try:
+        for chunk in iter(lambda: inf.read(1 << 20), ''):
+            digest.update(chunk)
+    finally:
+        inf.close()
+    return digest.hexdigest()
+
+def snapshot_filename(filename):
+    return filename + '.snap'
+
+###########
+# WRITING #
+###########
+
+class SnapshotWriter:
+    def __init__(self, outf):
+        self.outf = outf
+        self.crc = 0
+        self.offset = HEADER.size
+
+    def write(self, data):
+        self.outf.write(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.offset += len(data)
+
+    def write_array(self, arr):
+        # Keep every array 8-byte aligned.
+        if self.offset % 8:
+            self.write('\0' * (8 - self.offset % 8))
+        offset = self.offset
+        self.write(arr.tostring())
+        return [offset, len(arr)]
+
+    def write_strings(self, strings):
+        """
+        Writes a string table, returning its directory entry and a dict
+        mapping each string to its position in the table.
+        """
+        positions = {}
+        offsets = array('I', [0])
+        blob = []
+        size = 0
+        for s in strings:
+            if s not in positions:
+                positions[s] = len(positions)
+                blob.append(s)
+                size += len(s)
+                offsets.append(size)
+        entry = {'offsets': self.write_array(offsets)}
+        entry['blob'] = self.write_array(array('c', ''.join(blob)))
+        return entry, positions
+
+def compile_snapshot(filename, loader_class, output=None):
+    """
+    Loads filename with loader_class and writes it out as a snapshot, to
+    output or snapshot_filename(filename).
+    """
+    output = output or snapshot_filename(filename)
+    loader = loader_class(filename)
+    index_columns = INDEX_COLUMNS.get(loader_class, ())
+    stat = os.stat(filename)
+
+    tmp = output + '.tmp'
+    outf = open(tmp, 'wb')
+    try:
+        outf.write('\0' * HEADER.size)
+        writer = SnapshotWriter(outf)
+        directory = {'loader': loader_class.__name__, 'columns': []}
+        for i, name in enumerate(loader.column_names):
+            data = loader.data[i]
+            if name in loader.int_columns:
+                directory['columns'].append({'name': name, 'kind': 'int', 'values': writer.write_array(data)})
+            elif name in loader.geometry_columns:
+                prefixes, coords, offsets = data
+                strings, positions = writer.write_strings(prefixes)
+                directory['columns'].append({
+                    'name': name, 'kind': 'geometry', 'strings': strings,
+                    'prefixes': writer.write_array(array('I', [positions[p] for p in prefixes])),
+                    'offsets': writer.write_array(array('I', offsets)),
+                    'coords': writer.write_array(coords),
+                })
+            else:
+                strings, positions = writer.write_strings(data)
+                rows = array('I', [positions[s] for s in data])
+                column = {'name': name, 'kind': 'text', 'strings': strings, 'rows': writer.write_array(rows)}
+                if name in index_columns:
+                    # Postings: for each string, the sorted ids of the rows having it.
+                    postings = [[] for _ in positions]
+                    for row, position in enumerate(rows):
+                        postings[position].append(row)
+                    posting_offsets = array('I', [0])
+                    posting_rows = array('I')
+                    for p in postings:
+                        posting_rows.extend(p)
+                        posting_offsets.append(len(posting_rows))
+                    order = array('I', [positions[value] for value in sorted(positions)])
+                    column['postings'] = {'offsets': writer.write_array(posting_offsets), 'rows': writer.write_array(posting_rows),
+                                          'order': writer.write_array(order),
+                                          'uppercase': all(value and value == value.upper() for value in positions)}
+                directory['columns'].append(column)
+
+        directory_offset = writer.offset
+        directory_json = json.dumps(directory)
+        writer.write(directory_json)
+
+        outf.seek(0)
+        outf.write(HEADER.pack(MAGIC, VERSION, sys.byteorder == 'little' and 0 or 1, loader.size, writer.crc & 0xffffffff,
+                               stat.st_size, stat.st_mtime, file_md5(filename), directory_offset, len(directory_json)))
+    finally:
+        outf.close()
+    os.rename(tmp, output)
+    return output
+
+###########
+# LOADING #
+###########
+
+class MappedArray:
+    """
+    An array written by SnapshotWriter.write_array(), read in place from
+    the mmap rather than copied out, so worker processes share its pages.
+    """
+    def __init__(self, mm, (offset, length), typecode):
+        self.mm = mm
+        self.offset = offset
+        self.length = length
+        self.item = struct.Struct('=' + typecode)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return self.item.unpack_from(self.mm, self.offset + i * self.item.size)[0]
+
+    def slice(self, start, stop):
+        return struct.unpack_from('=%d%s' % (stop - start, self.item.format[1:]), self.mm, self.offset + start * self.item.size)
+
+class MappedStrings:
+    def __init__(self, mm, entry, order=None):
+        self.mm = mm
+        self.offsets = MappedArray(mm, entry['offsets'], 'I')
+        self.blob = entry['blob'][0]
+        # The positions of the strings in sorted order, if the snapshot has
+        # them (for the indexed columns).
+        self.order = order
+        self.strings = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        s = self.strings.get(i)
+        if s is None:
+            start, stop = self.offsets.slice(i, i + 2)
+            s = self.strings[i] = self.mm[self.blob + start:self.blob + stop]
+        return s
+
+    def position(self, s):
+        """
+        Returns the position of s in the table, or None, by binary search
+        through the sorted order.
+        """
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[self.order[mid]] < s:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.order) and self[self.order[lo]] == s:
+            return self.order[lo]
+        return None
+
+class SnapshotLoader(object):
+    """
+    Reads a snapshot through mmap, with the same interface as
+    textfiles.PipeFileLoader (column_names, scan(), row(), coordinates(),
+    and RowViews), plus rows_with() and values() for the prebuilt postings.
+
+    Raises SnapshotError if the file isn't a whole snapshot, or, with
+    verify, if its checksum doesn't match.
+    """
+    def __init__(self, filename, verify=False):
+        inf = open(filename, 'rb')
+        try:
+            self.mm = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            inf.close()
+        try:
+            self.open(filename, verify)
+        except:
+            self.mm.close()
+            raise
+
+    def open(self, filename, verify):
+        self.header = read_header(self.mm)
+        (magic, version, byteorder, self.size, crc, source_size, source_mtime, source_md5,
+         directory_offset, directory_length) = self.header
+        if len(self.mm) != directory_offset + directory_length:
+            raise SnapshotError('%s is truncated: %d bytes, expected %d' % (filename, len(self.mm), directory_offset + directory_length))
+        if verify and zlib.crc32(self.mm[HEADER.size:]) & 0xffffffff != crc:
+            raise SnapshotError('%s is corrupt: checksum mismatch' % filename)
+        try:
+            directory = json.loads(self.mm[directory_offset:directory_offset + directory_length])
+        except ValueError:
+            raise SnapshotError('%s is corrupt: unreadable directory' % filename)
+
+        self.loader_name = directory['loader']
+        self.column_names = []
+        self.columns = {}
+        self.getters = {}
+        self.geometries = {}
+        self.postings = {}
+        for i, column in enumerate(directory['columns']):
+            name = str(column['name'])
+            self.column_names.append(name)
+            self.columns[name] = i
+            if column['kind'] == 'int':
+                self.getters[name] = mapped_int_getter(MappedArray(self.mm, column['values'], 'i'))
+            elif column['kind'] == 'geometry':
+                geometry = (MappedStrings(self.mm, column['strings']), MappedArray(self.mm, column['prefixes'], 'I'),
+                            MappedArray(self.mm, column['offsets'], 'I'), MappedArray(self.mm, column['coords'], 'd'))
+                self.geometries[name] = geometry
+                self.getters[name] = mapped_geometry_getter(geometry)
+            else:
+                postings = column.get('postings')
+                order = postings and MappedArray(self.mm, postings['order'], 'I')
+                strings = MappedStrings(self.mm, column['strings'], order)
+                rows = MappedArray(self.mm, column['rows'], 'I')
+                self.getters[name] = mapped_text_getter(strings, rows)
+                if postings:
+                    self.postings[name] = (strings, MappedArray(self.mm, postings['offsets'], 'I'),
+                                           MappedArray(self.mm, postings['rows'], 'I'), postings['uppercase'])
+
+    def __len__(self):
+        return self.size
+
+    def row(self, index):
+        return RowView(self, index)
+
+    def scan(self):
+        return Scan(self)
+
+    def coordinates(self, name, index):
+        strings, prefixes, offsets, coords = self.geometries[name]
+        flat = coords.slice(offsets[index], offsets[index + 1])
+        return [(flat[j], flat[j + 1]) for j in xrange(0, len(flat), 2)]
+
+    def rows_with(self, name, value):
+        """
+        Returns the ids of the rows whose value in an indexed column is value.
+        """
+        strings, offsets, rows, uppercase = self.postings[name]
+        position = strings.position(value)
+        if position is None:
+            return []
+        return list(rows.slice(*offsets.slice(position, position + 2)))
+
+    def values(self, name):
+        """
+        Returns the distinct values of an indexed column.
+        """
+        strings = self.postings[name][0]
+        return [strings[i] for i in xrange(len(strings))]
+
+    def counts(self, name):
+        """
+        Returns a dict of each distinct value of an indexed column to how
+        many rows have it.
+        """
+        strings, offsets, rows, uppercase = self.postings[name]
+        bounds = offsets.slice(0, len(offsets))
+        return dict((strings[i], bounds[i + 1] - bounds[i]) for i in xrange(len(strings)))
+
+    def uppercase(self, name):
+        """
+        Returns whether every value of an indexed column is non-empty and
+        upper case, as the searchers in memory.py key streets on.
+        """
+        return self.postings[name][3]
+
+    def close(self):
+        self.mm.close()
+
+def mapped_int_getter(values):
+    def get(index):
+        value = values[index]
+        if value == NULL_INT:
+            return None
+        return value
+    return get
+
+def mapped_text_getter(strings, rows):
+    def get(index):
+        return strings[rows[index]]
+    return get
+
+def mapped_geometry_getter(geometry):
+    strings, prefixes, offsets, coords = geometry
+    def get(index):
+        prefix = strings[prefixes[index]]
+        if not prefix:
+            return ''
+        flat = coords.slice(offsets[index], offsets[index + 1])
+        pairs = ['%r %r' % (flat[j], flat[j + 1]) for j in xrange(0, len(flat), 2)]
+        return '%s(%s)' % (prefix, ','.join(pairs))
+    return get
+
+def read_header(data):
+    if len(data) < HEADER.size:
+        raise SnapshotError('Not a snapshot: too short')
+    header = HEADER.unpack_from(data)
+    if header[0] != MAGIC:
+        raise SnapshotError('Not a snapshot: bad magic number')
+    if header[1] != VERSION:
+        raise SnapshotError('Snapshot version %s, expected %s' % (header[1], VERSION))
+    if header[2] != (sys.byteorder == 'little' and 0 or 1):
+        raise SnapshotError('Snapshot was written on a machine with the other byte order')
+    return header
+
+def is_fresh(snapshot, filename):
+    """
+    Returns whether snapshot is a usable snapshot of filename as it is now.
+    """
+    try:
+        inf = open(snapshot, 'rb')
+    except IOError:
+        return False
+    try:
+        header = read_header(inf.read(HEADER.size))
+    except SnapshotError:
+        return False
+    finally:
+        inf.close()
+    source_size, source_mtime, source_md5 = header[5:8]
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        # Nothing to be stale relative to.
+        return True
+    if stat.st_size == source_size and stat.st_mtime == source_mtime:
+        return True
+    # Touched, maybe not changed.
+    return stat.st_size == source_size and file_md5(filename) == source_md5
+
+def load(filename, loader_class, snapshot=None):
+    """
+    Returns a SnapshotLoader for filename if it has a fresh, intact snapshot
+    (by default, snapshot_filename(filename)), and otherwise loads the text
+    with loader_class.
+    """
+    snapshot = snapshot or snapshot_filename(filename)
+    if is_fresh(snapshot, filename):
+        try:
+            loader = SnapshotLoader(snapshot, verify=True)
+        except SnapshotError:
+            # Truncated or corrupt; the text file is still good.
+            return loader_class(filename)
+        if loader.loader_name == loader_class.__name__:
+            return loader
+        loader.close()
+    return loader_class(filename)
+
+def main(argv):
+    if argv[:1] == ['--check']:
+        for filename in argv[1:]:
+            loader = SnapshotLoader(filename, verify=True)
+            print '%s: %s, %d rows, OK' % (filename, loader.loader_name, loader.size)
+            loader.close()
+        return
+    if not argv:
+        print __doc__
+        sys.exit(1)
+    filename = argv[0]
+    kind = len(argv) > 1 and argv[1] or os.path.basename(filename).split('.')[0]
+    if kind not in LOADER_CLASSES:
+        print 'Usage: python snapshot.py FILE [%s]' % '|'.join(sorted(LOADER_CLASSES))
+        sys.exit(1)
+    print 'Wrote %s' % compile_snapshot(filename, LOADER_CLASSES[kind])
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,468 @@
+"""
+Reverse geocoding and searching by area, from a uniform grid over the block
+LINESTRINGs and intersection POINTs of the pipe-delimited dumps (or the
+memory.py searchers already built from them).
+
+ReverseGeocoder finds the nearest block and intersection to a longitude and
+latitude:
+
+    geocoder = ReverseGeocoder.from_files('blocks.txt.gz', 'intersections.txt.gz')
+    block, intersection = geocoder.reverse_geocode(-71.161144, 42.25932)
+    block.number, block.side, block.distance, intersection.distance
+
+and SpatialSearcher all of them in a bounding box or within a radius.
+
+Coordinates are projected into meters around the data's mean latitude
+(equirectangular, which is plenty accurate over a city), and each block
+segment is filed under every grid cell its bounding box touches, so a
+query only looks at the segments in the few cells around it.
+"""
+import math
+
+from memory import IndexedBlock, IndexedIntersection
+from geometry import closest_on_segment, segment_intersects_box, side_of_segment
+from results import BlockResult, IntersectionResult
+from textfiles import BlockFileLoader, IntersectionFileLoader
+import snapshot
+
+# Mean radius of the earth, in meters.
+EARTH_RADIUS = 6371008.8
+
+# Meters on a side. About a city block, so most queries look at the nine
+# cells around them and a few dozen segments.
+DEFAULT_CELL_SIZE = 100.0
+
+# A query that's more than NEAR cells from everything is searched by the
+# coarse blocks of COARSE by COARSE cells instead.
+NEAR = 2
+COARSE = 8
+
+class Projection:
+    """
+    An equirectangular projection into meters about latitude lat0. It's
+    affine, so the fraction of the way along a segment and which side of it
+    a point lies on are the same before and after projecting.
+    """
+    def __init__(self, lat0):
+        self.ky = EARTH_RADIUS * math.pi / 180
+        self.kx = self.ky * math.cos(math.radians(lat0))
+
+    def project(self, lon, lat):
+        return lon * self.kx, lat * self.ky
+
+    def unproject(self, x, y):
+        return x / self.kx, y / self.ky
+
+class Grid:
+    """
+    Square cells of cell_size meters, each holding the items that overlap
+    it. The occupied cells are also grouped into COARSE by COARSE blocks,
+    so that a search far from everything can pass over the empty ones.
+    """
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        # (block x, block y) -> keys of the occupied cells in the block.
+        self.coarse = {}
+        # (min_ix, min_iy, max_ix, max_iy) of the occupied cells.
+        self.bounds = None
+
+    def cell(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def insert(self, item, min_x, min_y, max_x, max_y):
+        ix0, iy0 = self.cell(min_x, min_y)
+        ix1, iy1 = self.cell(max_x, max_y)
+        for ix in xrange(ix0, ix1 + 1):
+            for iy in xrange(iy0, iy1 + 1):
+                items = self.cells.get((ix, iy))
+                if items is None:
+                    items = self.cells[(ix, iy)] = []
+                    self.coarse.setdefault((ix // COARSE, iy // COARSE), []).append((ix, iy))
+                items.append(item)
+        if self.bounds is None:
+            self.bounds = (ix0, iy0, ix1, iy1)
+        else:
+            bx0, by0, bx1, by1 = self.bounds
+            self.bounds = (min(bx0, ix0), min(by0, iy0), max(bx1, ix1), max(by1, iy1))
+
+    def cell_distance_sq(self, key, x, y, size=None):
+        """
+        Returns the squared distance from (x, y) to the nearest point of the
+        cell with the given key, or of the square of the given size.
+        """
+        size = size or self.cell_size
+        x0, y0 = key[0] * size, key[1] * size
+        dx = max(x0 - x, 0.0, x - x0 - size)
+        dy = max(y0 - y, 0.0, y - y0 - size)
+        return dx * dx + dy * dy
+
+    def within(self, min_x, min_y, max_x, max_y):
+        """
+        Yields the items in the cells that overlap the box; an item in more
+        than one of them is yielded more than once.
+        """
+        if self.bounds is None:
+            return
+        ix0, iy0 = self.cell(min_x, min_y)
+        ix1, iy1 = self.cell(max_x, max_y)
+        bx0, by0, bx1, by1 = self.bounds
+        cells = self.cells
+        for ix in xrange(max(ix0, bx0), min(ix1, bx1) + 1):
+            for iy in xrange(max(iy0, by0), min(iy1, by1) + 1):
+                items = cells.get((ix, iy))
+                if items:
+                    for item in items:
+                        yield item
+
+    def nearest(self, x, y, distance_sq, max_distance=None):
+        """
+        Returns (squared distance, item) for the item nearest to (x, y), as
+        measured by distance_sq(item, x, y), or None if there's none within
+        max_distance.
+
+        Searches outwards a ring of cells at a time: anything beyond ring k
+        is more than k cells away, so the search can stop as soon as the
+        best so far is closer than that. Past NEAR rings it goes on a ring
+        of coarse blocks at a time instead, only looking in the occupied
+        cells that are closer than the best so far.
+        """
+        if self.bounds is None:
+            return None
+        size = self.cell_size
+        cells = self.cells
+        ix, iy = self.cell(x, y)
+        bx0, by0, bx1, by1 = self.bounds
+        # Beyond this many rings, everything's outside the bounds.
+        last = max(ix - bx0, bx1 - ix, iy - by0, by1 - iy)
+        if max_distance is not None:
+            last = min(last, int(max_distance / size) + 1)
+        best = None
+        best_sq = None
+
+        for k in xrange(min(last, NEAR) + 1):
+            for key in ring(ix, iy, k, self.bounds):
+                items = cells.get(key)
+                if items:
+                    for item in items:
+                        d = distance_sq(item, x, y)
+                        if best_sq is None or d < best_sq:
+                            best, best_sq = item, d
+            if best_sq is not None and best_sq <= (k * size) ** 2:
+                return self.found(best, best_sq, max_distance)
+
+        # The cells in the rings so far are skipped below.
+        cx, cy = ix // COARSE, iy // COARSE
+        coarse_bounds = (bx0 // COARSE, by0 // COARSE, bx1 // COARSE, by1 // COARSE)
+        for k in xrange(last // COARSE + 2):
+            for block in ring(cx, cy, k, coarse_bounds):
+                keys = self.coarse.get(block)
+                if not keys or (best_sq is not None and self.cell_distance_sq(block, x, y, COARSE * size) >= best_sq):
+                    continue
+                for key in keys:
+                    if abs(key[0] - ix) <= NEAR and abs(key[1] - iy) <= NEAR:
+                        continue
+                    if best_sq is not None and self.cell_distance_sq(key, x, y) >= best_sq:
+                        continue
+                    for item in cells[key]:
+                        d = distance_sq(item, x, y)
+                        if best_sq is None or d < best_sq:
+                            best, best_sq = item, d
+            if best_sq is not None and best_sq <= (k * COARSE * size) ** 2:
+                break
+        return self.found(best, best_sq, max_distance)
+
+    def found(self, best, best_sq, max_distance):
+        if best is None or (max_distance is not None and best_sq > max_distance * max_distance):
+            return None
+        return best_sq, best
+
+def ring(ix, iy, k, bounds):
+    """
+    Returns the keys of the cells exactly k cells from (ix, iy), leaving
+    out those beyond bounds, (min_ix, min_iy, max_ix, max_iy).
+
+    >>> sorted(ring(0, 0, 1, (-5, -5, 5, 5)))
+    [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+    >>> sorted(ring(0, 0, 1, (0, 0, 5, 5)))
+    [(0, 1), (1, 0), (1, 1)]
+    """
+    if k == 0:
+        return [(ix, iy)]
+    bx0, by0, bx1, by1 = bounds
+    keys = []
+    x0, x1 = max(ix - k, bx0), min(ix + k, bx1)
+    for y in (iy - k, iy + k):
+        if by0 <= y <= by1:
+            keys.extend([(x, y) for x in xrange(x0, x1 + 1)])
+    y0, y1 = max(iy - k + 1, by0), min(iy + k - 1, by1)
+    for x in (ix - k, ix + k):
+        if bx0 <= x <= bx1:
+            keys.extend([(x, y) for y in xrange(y0, y1 + 1)])
+    return keys
+
+def segment_distance_sq(segment, x, y):
+    block, n, x1, y1, x2, y2 = segment
+    return closest_on_segment(x, y, x1, y1, x2, y2)[0]
+
+def point_distance_sq(point, x, y):
+    intersection, px, py = point
+    return (px - x) * (px - x) + (py - y) * (py - y)
+
+class SpatialIndex:
+    """
+    Grids over an iterable of memory.IndexedBlocks and one of
+    memory.IndexedIntersections. The block grid holds a
+    (block, segment number, x1, y1, x2, y2) tuple per segment, and the
+    intersection grid an (intersection, x, y) per intersection, all in
+    projected meters.
+    """
+    def __init__(self, blocks, intersections, cell_size=DEFAULT_CELL_SIZE):
+        self.blocks = list(blocks)
+        self.intersections = list(intersections)
+        latitudes = [b.linestring().coords[0][1] for b in self.blocks] + \
+                    [i.coordinates()[1] for i in self.intersections]
+        self.projection = Projection(latitudes and sum(latitudes) / len(latitudes) or 0.0)
+        project = self.projection.project
+
+        self.block_grid = Grid(cell_size)
+        for block in self.blocks:
+            points = [project(lon, lat) for lon, lat in block.linestring().coords]
+            if len(points) == 1:
+                points.append(points[0])
+            for n in xrange(len(points) - 1):
+                (x1, y1), (x2, y2) = points[n], points[n + 1]
+                self.block_grid.insert((block, n, x1, y1, x2, y2), min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+        self.intersection_grid = Grid(cell_size)
+        for intersection in self.intersections:
+            x, y = project(*intersection.coordinates())
+            self.intersection_grid.insert((intersection, x, y), x, y, x, y)
+
+    @classmethod
+    def from_searchers(cls, block_searcher, intersection_searcher, cell_size=DEFAULT_CELL_SIZE):
+        """
+        Indexes the blocks and intersections of a MemoryBlockSearcher and a
+        MemoryIntersectionSearcher, sharing their parsed geometries.
+        """
+        return cls(block_searcher.blocks(), intersection_searcher.intersections, cell_size)
+
+    @classmethod
+    def from_loaders(cls, block_loader, intersection_loader, cell_size=DEFAULT_CELL_SIZE):
+        """
+        Indexes the rows of a BlockFileLoader and an IntersectionFileLoader
+        (or their snapshots).
+        """
+        return cls((IndexedBlock(row) for row in block_loader.scan()),
+                   (IndexedIntersection(row) for row in intersection_loader.scan()), cell_size)
+
+    @classmethod
+    def from_files(cls, blocks_file, intersections_file, cell_size=DEFAULT_CELL_SIZE):
+        return cls.from_loaders(snapshot.load(blocks_file, BlockFileLoader),
+                                snapshot.load(intersections_file, IntersectionFileLoader), cell_size)
+
+    def nearest_block(self, lon, lat, max_distance=None):
+        """
+        Returns (block, distance, fraction, side, point) for the block
+        nearest to (lon, lat), where point is the nearest point on it,
+        fraction how far along the block that is, and side 1 if (lon, lat)
+        is to the left of the block (looking from its start), -1 if it's to
+        the right and 0 if it's on it. Returns None if there's no block
+        within max_distance meters.
+        """
+        x, y = self.projection.project(lon, lat)
+        found = self.block_grid.nearest(x, y, segment_distance_sq, max_distance)
+        if found is None:
+            return None
+        distance_sq, (block, n, x1, y1, x2, y2) = found
+        t = closest_on_segment(x, y, x1, y1, x2, y2)[1]
+        line = block.linestring()
+        (lon1, lat1), (lon2, lat2) = line.coords[n], line.coords[min(n + 1, len(line.coords) - 1)]
+        point = (lon1 + (lon2 - lon1) * t, lat1 + (lat2 - lat1) * t)
+        return block, math.sqrt(distance_sq), line.fraction_at(n, t), side_of_segment(x, y, x1, y1, x2, y2), point
+
+    def closest_point(self, block, lon, lat):
+        """
+        Returns (distance, point): the point on block nearest to (lon, lat)
+        and how many meters away it is.
+        """
+        x, y = self.projection.project(lon, lat)
+        best = None
+        coords = block.linestring().coords
+        for n in xrange(max(1, len(coords) - 1)):
+            (lon1, lat1), (lon2, lat2) = coords[n], coords[min(n + 1, len(coords) - 1)]
+            x1, y1 = self.projection.project(lon1, lat1)
+            x2, y2 = self.projection.project(lon2, lat2)
+            distance_sq, t = closest_on_segment(x, y, x1, y1, x2, y2)
+            if best is None or distance_sq < best[0]:
+                best = (distance_sq, (lon1 + (lon2 - lon1) * t, lat1 + (lat2 - lat1) * t))
+        return math.sqrt(best[0]), best[1]
+
+    def distance(self, a, b):
+        """
+        Returns the distance in meters between two (lon, lat) points.
+        """
+        (x1, y1), (x2, y2) = self.projection.project(*a), self.projection.project(*b)
+        return math.hypot(x2 - x1, y2 - y1)
+
+    def nearest_intersection(self, lon, lat, max_distance=None):
+        """
+        Returns (intersection, distance) for the intersection nearest to
+        (lon, lat), or None if there's none within max_distance meters.
+        """
+        x, y = self.projection.project(lon, lat)
+        found = self.intersection_grid.nearest(x, y, point_distance_sq, max_distance)
+        if found is None:
+            return None
+        distance_sq, (intersection, px, py) = found
+        return intersection, math.sqrt(distance_sq)
+
+def house_number(block, fraction, side):
+    """
+    Returns the house number the given fraction of the way along block, on
+    the given side (as returned by nearest_block()), or None if the block
+    isn't numbered.
+
+    Uses the side's own range when the two sides have opposite parities,
+    as contains_number() does, and the block's from_num-to_num otherwise.
+    Numbers are rounded to the parity of their range.
+    """
+    from_num, to_num = block.from_num, block.to_num
+    if block.left_from_num and block.right_from_num:
+        if block.right_to_num % 2 != block.left_from_num % 2 and block.left_to_num % 2 != block.right_from_num % 2:
+            if side >= 0:
+                from_num, to_num = block.left_from_num, block.left_to_num
+            else:
+                from_num, to_num = block.right_from_num, block.right_to_num
+    elif block.left_from_num:
+        from_num, to_num = block.left_from_num, block.left_to_num
+    elif block.right_from_num:
+        from_num, to_num = block.right_from_num, block.right_to_num
+    if not from_num or not to_num:
+        return None
+    number = from_num + (to_num - from_num) * fraction
+    if from_num % 2 == to_num % 2:
+        number = from_num + 2 * int(round((number - from_num) / 2.0))
+    else:
+        number = int(round(number))
+    return max(min(from_num, to_num), min(max(from_num, to_num), number))
+
+class ReverseGeocoder:
+    """
+    Answers reverse_geocode() from a SpatialIndex.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    @classmethod
+    def from_files(cls, blocks_file, intersections_file, cell_size=DEFAULT_CELL_SIZE):
+        return cls(SpatialIndex.from_files(blocks_file, intersections_file, cell_size))
+
+    def reverse_geocode(self, lon, lat, max_distance=None):
+        """
+        Returns (block, intersection): the BlockResult for the nearest
+        point on the nearest block and the IntersectionResult for the
+        nearest intersection, either of them None if there isn't one within
+        max_distance meters.
+
+        The BlockResult also has number (the house number interpolated
+        from its range, or None), side ('left' or 'right') and distance (in
+        meters); the IntersectionResult has distance.
+        """
+        block_result = intersection_result = None
+        found = self.index.nearest_block(lon, lat, max_distance)
+        if found is not None:
+            block, distance, fraction, side, point = found
+            block_result = BlockResult(block.as_tuple(), point)
+            block_result.number = house_number(block, fraction, side)
+            block_result.side = side >= 0 and 'left' or 'right'
+            block_result.distance = distance
+        found = self.index.nearest_intersection(lon, lat, max_distance)
+        if found is not None:
+            intersection, distance = found
+            intersection_result = IntersectionResult(intersection.as_tuple())
+            intersection_result.distance = distance
+        return block_result, intersection_result
+
+class SpatialSearcher:
+    """
+    Finds the blocks and intersections in an area, from a SpatialIndex:
+
+        searcher = SpatialSearcher.from_files('blocks.txt.gz', 'intersections.txt.gz')
+        for result in searcher.within_radius(-71.161144, 42.25932, 250):
+            ...
+
+    Both searches are generators of BlockResults (then IntersectionResults),
+    made as they're asked for, so a caller that stops early (or only wants
+    intersections) doesn't pay for the rest. A block's location is the
+    point on it nearest to the center of the search, and every result has
+    the distance in meters from there.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    @classmethod
+    def from_files(cls, blocks_file, intersections_file, cell_size=DEFAULT_CELL_SIZE):
+        return cls(SpatialIndex.from_files(blocks_file, intersections_file, cell_size))
+
+    def within_bbox(self, min_lon, min_lat, max_lon, max_lat, blocks=True, intersections=True):
+        """
+        Yields a result for each block that crosses the box and each
+        intersection inside it (including those on its edges).
+        """
+        project = self.index.projection.project
+        min_x, min_y = project(min_lon, min_lat)
+        max_x, max_y = project(max_lon, max_lat)
+
+        def block_inside(segment):
+            block, n, x1, y1, x2, y2 = segment
+            return segment_intersects_box(x1, y1, x2, y2, min_x, min_y, max_x, max_y)
+
+        def intersection_inside(point):
+            intersection, x, y = point
+            return min_x <= x <= max_x and min_y <= y <= max_y
+
+        center = ((min_lon + max_lon) / 2.0, (min_lat + max_lat) / 2.0)
+        return self.search(center, (min_x, min_y, max_x, max_y), block_inside, intersection_inside, blocks, intersections)
+
+    def within_radius(self, lon, lat, meters, blocks=True, intersections=True):
+        """
+        Yields a result for each block and intersection within meters of
+        (lon, lat).
+        """
+        x, y = self.index.projection.project(lon, lat)
+        limit = meters * meters
+
+        def block_inside(segment):
+            return segment_distance_sq(segment, x, y) <= limit
+
+        def intersection_inside(point):
+            return point_distance_sq(point, x, y) <= limit
+
+        box = (x - meters, y - meters, x + meters, y + meters)
+        return self.search((lon, lat), box, block_inside, intersection_inside, blocks, intersections)
+
+    def search(self, center, box, block_inside, intersection_inside, blocks=True, intersections=True):
+        lon, lat = center
+        if blocks:
+            seen = set()
+            for segment in self.index.block_grid.within(*box):
+                block = segment[0]
+                if block.id in seen or not block_inside(segment):
+                    continue
+                seen.add(block.id)
+                distance, point = self.index.closest_point(block, lon, lat)
+                result = BlockResult(block.as_tuple(), point)
+                result.distance = distance
+                yield result
+        if intersections:
+            for point in self.index.intersection_grid.within(*box):
+                if intersection_inside(point):
+                    intersection = point[0]
+                    result = IntersectionResult(intersection.as_tuple())
+                    result.distance = self.index.distance(intersection.coordinates(), (lon, lat))
+                    yield result
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,133 @@
+"""
+Street name spelling correction.
+
+Openblock kept a StreetMisspelling table of hand-entered corrections; here a
+SpellingCorrector is any object whose correct(incorrect) returns a
+Correction. SpellingCorrector itself corrects nothing, and StreetCorrector
+finds the closest known street name by edit distance:
+
+>>> corrector = StreetCorrector({'MASSACHUSETTS': 40, 'TOBIN': 4, 'TOBEY': 1, 'MAIN': 12})
+>>> corrector.correct('MASACHUSETTS').correct
+'MASSACHUSETTS'
+>>> corrector.correct('TOBIM').correct
+'TOBIN'
+>>> corrector.correct('MAIN').correct
+'MAIN'
+>>> corrector.correct('NOWHERE').correct
+'NOWHERE'
+"""
+
+class Correction:
+    def __init__(self, incorrect, correct):
+        self.incorrect = incorrect
+        self.correct = correct
+
+    def __repr__(self):
+        return 'Correction(%r, %r)' % (self.incorrect, self.correct)
+
+class SpellingCorrector:
+    def correct(self, incorrect):
+        # by default, correct nothing.
+        return Correction(incorrect, incorrect)
+
+def trigrams(word):
+    """
+    Returns the set of three-letter substrings of word, padded so that its
+    start and end count too.
+
+    >>> sorted(trigrams('ELM'))
+    ['  E', ' EL', 'ELM', 'LM ']
+    """
+    word = '  ' + word + ' '
+    return set(word[i:i + 3] for i in xrange(len(word) - 2))
+
+def edit_distance(a, b, limit):
+    """
+    Returns the Levenshtein distance between a and b, or limit + 1 as soon
+    as it's clear that it's more than limit.
+
+    >>> edit_distance('WASHINTON', 'WASHINGTON', 2)
+    1
+    >>> edit_distance('ELM', 'WASHINGTON', 2)
+    3
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = range(len(b) + 1)
+    for i, ca in enumerate(a):
+        current = [i + 1]
+        for j, cb in enumerate(b):
+            current.append(min(previous[j + 1] + 1, current[j] + 1, previous[j] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+class StreetCorrector(SpellingCorrector):
+    """
+    Corrects a street name to the closest one in an index of the known
+    street names, built once from a dict of street name -> how many blocks
+    it has (as returned by the block searchers' street_names()).
+
+    The index maps each trigram to the streets containing it. A name within
+    d edits of the query shares all but at most 3 * d of the query's
+    trigrams, so only the streets sharing enough of them get their edit
+    distance computed.
+
+    The number of edits allowed grows with the length of the name, one per
+    letters_per_edit letters, up to max_distance: short names have too
+    many near neighbours to guess between. Ties go to the street with the
+    most blocks.
+    """
+    def __init__(self, streets, max_distance=2, letters_per_edit=4):
+        self.streets = dict(streets)
+        self.max_distance = max_distance
+        self.letters_per_edit = letters_per_edit
+        self.postings = {}
+        for street in self.streets:
+            for gram in trigrams(street):
+                self.postings.setdefault(gram, []).append(street)
+
+    @classmethod
+    def from_searcher(cls, block_searcher, **kwargs):
+        return cls(block_searcher.street_names(), **kwargs)
+
+    def allowed_distance(self, word):
+        return min(self.max_distance, len(word) // self.letters_per_edit)
+
+    def candidates(self, incorrect):
+        """
+        Returns (distance, street) for the known streets close enough to
+        incorrect, closest first.
+        """
+        limit = self.allowed_distance(incorrect)
+        if incorrect in self.streets:
+            return [(0, incorrect)]
+        if not limit:
+            return []
+        grams = trigrams(incorrect)
+        shared = {}
+        for gram in grams:
+            for street in self.postings.get(gram, ()):
+                shared[street] = shared.get(street, 0) + 1
+        needed = len(grams) - 3 * limit
+        found = []
+        for street, count in shared.iteritems():
+            if count >= needed:
+                distance = edit_distance(incorrect, street, limit)
+                if distance <= limit:
+                    found.append((distance, -self.streets[street], street))
+        found.sort()
+        return [(distance, street) for distance, blocks, street in found]
+
+    def correct(self, incorrect):
+        if not incorrect:
+            return Correction(incorrect, incorrect)
+        found = self.candidates(incorrect)
+        if found:
+            return Correction(incorrect, found[0][1])
+        return Correction(incorrect, incorrect)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,208 @@
+"""
+Streams CSV or JSON-lines records through LocalGeocoder.geocode_many().
+
+Records are read, geocoded and written a chunk at a time, so memory use
+doesn't grow with the size of the input. With --checkpoint, the number of
+records finished is saved after every chunk, and a restarted job picks up
+where the last one stopped.
+
+    python -m djeocoder.stream --dsn 'dbname=openblock user=...' --column address in.csv > out.csv
+    python -m djeocoder.stream --checkpoint job.offset --output out.jsonl in.jsonl
+
+Without --dsn, the bundled blocks and intersections files are searched in
+memory (see --blocks and --intersections). --processes spreads the work
+over a parallel.ParallelGeocoder, and --cache keeps results in a
+cache.GeocodeCache file across runs.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+
+from cache import GeocodeCache
+from djeocoder import LocalGeocoder
+import instrument
+from parallel import ParallelGeocoder
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The fields added to every output record.
+RESULT_FIELDS = ['geocoded_address', 'longitude', 'latitude', 'geocode_error']
+
+def result_fields(result, error):
+    if error is not None:
+        return {'geocoded_address': None, 'longitude': None, 'latitude': None,
+                'geocode_error': '%s: %s' % (error.__class__.__name__, error)}
+    return {'geocoded_address': result.address, 'longitude': result.point[0], 'latitude': result.point[1],
+            'geocode_error': None}
+
+class CSVFormat:
+    def __init__(self, inf, column):
+        self.reader = csv.DictReader(inf)
+        if self.reader.fieldnames is None or column not in self.reader.fieldnames:
+            raise ValueError('Input has no %r column' % column)
+        self.fieldnames = self.reader.fieldnames + [f for f in RESULT_FIELDS if f not in self.reader.fieldnames]
+        self.column = column
+
+    def records(self):
+        for record in self.reader:
+            yield record, record[self.column] or ''
+
+    def writer(self, outf, write_header):
+        writer = csv.DictWriter(outf, self.fieldnames)
+        if write_header:
+            writer.writerow(dict(zip(self.fieldnames, self.fieldnames)))
+        def write(record):
+            writer.writerow(dict((k, v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in record.items()))
+        return write
+
+class JSONLinesFormat:
+    def __init__(self, inf, column):
+        self.inf = inf
+        self.column = column
+
+    def records(self):
+        for line in self.inf:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            location = record.get(self.column)
+            if location is None:
+                location = ''
+            elif not isinstance(location, basestring):
+                # e.g. a number; it fails to geocode like any other bad
+                # location, rather than stopping the job.
+                location = unicode(location)
+            yield record, location
+
+    def writer(self, outf, write_header):
+        def write(record):
+            outf.write(json.dumps(record, sort_keys=True) + '\n')
+        return write
+
+FORMATS = {'csv': CSVFormat, 'jsonl': JSONLinesFormat}
+
+def read_checkpoint(filename):
+    try:
+        inf = open(filename)
+    except IOError:
+        return 0
+    try:
+        return int(inf.read().strip() or 0)
+    finally:
+        inf.close()
+
+def write_checkpoint(filename, offset):
+    # Write to a temporary file and rename it over the old one, so a crash
+    # can never leave a half-written offset behind.
+    tmp = filename + '.tmp'
+    outf = open(tmp, 'w')
+    outf.write('%d\n' % offset)
+    outf.close()
+    os.rename(tmp, filename)
+
+def geocode_stream(geocoder, records, chunk_size=1000, start=0):
+    """
+    Geocodes an iterable of (record, location) pairs, skipping the first
+    start of them. Yields (offset, chunk) after every chunk_size records,
+    where chunk is the list of records with RESULT_FIELDS added and offset
+    is the number of input records finished so far.
+    """
+    offset = start
+    records = itertools.islice(records, start, None)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        locations = [location for record, location in chunk]
+        results = geocoder.geocode_many(locations, batch_size=chunk_size)
+        output = []
+        for (record, location), (_, result, error) in itertools.izip(chunk, results):
+            record = dict(record)
+            record.update(result_fields(result, error))
+            output.append(record)
+        offset += len(chunk)
+        yield offset, output
+
+def run(geocoder, inf, outf, format='csv', column='location', chunk_size=1000, start=0, checkpoint=None, write_header=True):
+    """
+    Geocodes every record read from inf, writing them to outf. Returns the
+    number of input records finished.
+    """
+    if checkpoint:
+        start = max(start, read_checkpoint(checkpoint))
+    reader = FORMATS[format](inf, column)
+    write = reader.writer(outf, write_header and start == 0)
+    offset = start
+    for offset, output in geocode_stream(geocoder, reader.records(), chunk_size, start):
+        for record in output:
+            write(record)
+        outf.flush()
+        if checkpoint:
+            write_checkpoint(checkpoint, offset)
+    return offset
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Geocode a stream of CSV or JSON-lines records.')
+    parser.add_argument('input', nargs='?', help='input file (default: stdin)')
+    parser.add_argument('--output', help='output file (default: stdout); appended to when resuming')
+    parser.add_argument('--format', choices=sorted(FORMATS), help='input format (default: from the file extension, else csv)')
+    parser.add_argument('--column', default='location', help='field holding the location string (default: location)')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='records geocoded per chunk (default: 1000)')
+    parser.add_argument('--start', type=int, default=0, help='number of input records to skip')
+    parser.add_argument('--checkpoint', help='file recording the number of records finished, for resuming')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes to geocode with (default: 1)')
+    parser.add_argument('--dsn', help='PostGIS connection string; without it, searches the files below in memory')
+    parser.add_argument('--blocks', default=os.path.join(DATA_DIR, 'blocks.txt.gz'))
+    parser.add_argument('--intersections', default=os.path.join(DATA_DIR, 'intersections.txt.gz'))
+    parser.add_argument('--cache', help='SQLite file to cache results in')
+    parser.add_argument('--timings', action='store_true', help='print a breakdown of where the time went (not with --processes)')
+    options = parser.parse_args(argv)
+
+    format = options.format
+    if format is None:
+        format = options.input and options.input.endswith(('.jsonl', '.json')) and 'jsonl' or 'csv'
+
+    cache = None
+    if options.processes > 1:
+        cxn = None
+        geocoder = ParallelGeocoder(options.processes, options.dsn, options.blocks, options.intersections, options.chunk_size,
+                                    options.cache)
+    else:
+        cache = options.cache and GeocodeCache(options.cache) or None
+        if options.dsn:
+            import psycopg2
+            cxn = psycopg2.connect(options.dsn)
+            geocoder = LocalGeocoder(cxn, cache=cache)
+        else:
+            cxn = None
+            geocoder = LocalGeocoder.from_files(options.blocks, options.intersections, cache=cache)
+
+    recorder = options.timings and instrument.enable() or None
+
+    inf = options.input and open(options.input, 'rb') or sys.stdin
+    resuming = options.start or (options.checkpoint and read_checkpoint(options.checkpoint))
+    if options.output:
+        outf = open(options.output, resuming and 'ab' or 'wb')
+    else:
+        outf = sys.stdout
+    try:
+        offset = run(geocoder, inf, outf, format, options.column, options.chunk_size, options.start, options.checkpoint,
+                     write_header=not resuming)
+    finally:
+        if outf is not sys.stdout:
+            outf.close()
+        if cxn is not None:
+            cxn.close()
+        if isinstance(geocoder, ParallelGeocoder):
+            geocoder.close()
+        if cache is not None:
+            cache.close()
+    sys.stderr.write('Geocoded %d records\n' % offset)
+    if recorder is not None:
+        sys.stderr.write(recorder.report() + '\n')
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,7 +2,10 @@ import sys
 import psycopg2
 
 import djeocoder
+import nonblocking
 import postgis
+from geometry import INTERPOLATION_TOLERANCE, LineString
+from results import parse_point
 
 # Example usage: 
 #
@@ -25,17 +28,85 @@ def test_PostgisBlockSearcher(cxn):
     assert len(results) > 0, 'No results returned from PostgisBlockSearcher'
     print results
 
+def test_PostgisBlockSearcher_single_query(cxn):
+    # Both search modes should find the same blocks, at the same points.
+    s = postgis.PostgisBlockSearcher(cxn)
+    single = postgis.PostgisBlockSearcher(cxn, single_query=True)
+    for street, number in [('Tobin', 25), ('Tobin', 24), ('Washington', 1001), ('Centre', None)]:
+        results = s.search(street, number)
+        single_results = single.search(street, number)
+        assert [r.id for r in results] == [r.id for r in single_results], \
+            'Single-query search found different blocks for %s %s' % (number, street)
+        for r, single_r in zip(results, single_results):
+            assert abs(r.location[0] - single_r.location[0]) <= INTERPOLATION_TOLERANCE and \
+                abs(r.location[1] - single_r.location[1]) <= INTERPOLATION_TOLERANCE, \
+                'Single-query search interpolated %s differently: %r != %r' % (r.id, r.location, single_r.location)
+
 def test_PostgisIntersectionSearcher(cxn):
     s = postgis.PostgisIntersectionSearcher(cxn)
     results = s.search(street_a='MALVERN')
     assert len(results) > 0, 'No results returned from PostgisIntersectionSearcher'
     print results
 
+def test_interpolation_matches_postgis(cxn):
+    # geometry.LineString should agree with PostGIS's own interpolation.
+    cursor = cxn.cursor()
+    cursor.execute('select id, ST_AsEWKT(geom) from blocks order by id limit 500')
+    for block_id, wkt_str in cursor.fetchall():
+        line = LineString.from_wkt(wkt_str)
+        for fraction in (0.0, 0.25, 0.5, 0.75, 1.0):
+            cursor.execute('SELECT ST_AsEWKT(line_interpolate_point(%s, %s))', [wkt_str, fraction])
+            px, py = parse_point(cursor.fetchone()[0])
+            x, y = line.interpolate(fraction)
+            assert abs(x - px) <= INTERPOLATION_TOLERANCE and abs(y - py) <= INTERPOLATION_TOLERANCE, \
+                'Block %s at %s: %r != %r' % (block_id, fraction, (x, y), (px, py))
+    cursor.close()
+
+def test_ConnectionPool(cxn, dsn):
+    # Prepared statements on pooled connections should find the same rows,
+    # the first time a filter shape is seen and after it's been prepared.
+    pool = postgis.ConnectionPool(dsn, maxconn=2)
+    for single_query in (False, True):
+        s = postgis.PostgisBlockSearcher(cxn, single_query)
+        pooled = postgis.PostgisBlockSearcher(pool, single_query)
+        for i in range(2):
+            for kwargs in [{'street': 'Tobin', 'number': 25}, {'street': 'Tobin', 'suffix': 'RD'}, {'street': 'Centre', 'city': 'Boston'}]:
+                assert [r.id for r in s.search(**kwargs)] == [r.id for r in pooled.search(**kwargs)], \
+                    'Pooled search found different blocks for %r' % kwargs
+    s = postgis.PostgisIntersectionSearcher(cxn)
+    pooled = postgis.PostgisIntersectionSearcher(pool)
+    assert [r.id for r in s.search(street_a='MALVERN')] == [r.id for r in pooled.search(street_a='MALVERN')], \
+        'Pooled search found different intersections'
+    pool.closeall()
+
+def test_AsyncLocalGeocoder(cxn, dsn):
+    # Concurrent geocodes through the async pool should agree with the
+    # blocking geocoder, including failures.
+    pool = nonblocking.AsyncConnectionPool(dsn, size=4)
+    geocoder = nonblocking.AsyncLocalGeocoder(pool)
+    blocking = djeocoder.LocalGeocoder(cxn)
+    locations = ['24 Tobin Rd', 'Tobin Rd & Kerna Rd', '24 Tobim Rd', '12 Nowhere St', 'garbage!!']
+    futures = [geocoder.geocode(l) for l in locations]
+    pool.run_until_complete(futures)
+    for location, future in zip(locations, futures):
+        try:
+            expected = blocking.geocode(location).point
+        except Exception, e:
+            assert isinstance(future.error, e.__class__), 'Async geocode of %r: %r' % (location, future.error)
+        else:
+            assert future.error is None and future.value.point == expected, 'Async geocode of %r' % location
+    pool.closeall()
+
 def main(argv):
-    cxn = psycopg2.connect('dbname=openblock user=%s password=%s' % (argv[0], argv[1]))
+    dsn = 'dbname=openblock user=%s password=%s' % (argv[0], argv[1])
+    cxn = psycopg2.connect(dsn)
     test_PostgisBlockSearcher(cxn)
+    test_PostgisBlockSearcher_single_query(cxn)
     test_PostgisIntersectionSearcher(cxn)
     test_PostgisAddressGeocoder(cxn)
+    test_interpolation_matches_postgis(cxn)
+    test_ConnectionPool(cxn, dsn)
+    test_AsyncLocalGeocoder(cxn, dsn)
     cxn.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,1297 @@
+"""
+Tests for the parts of the geocoder that don't need a database, run against
+the bundled Boston data.
+
+The parser has its own tests in parser/tests.py, and test.py exercises the
+PostGIS searchers against a live database.
+"""
+import bisect
+import gzip
+import json
+import math
+import os
+import random
+import select
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from geometry import INTERPOLATION_TOLERANCE, LineString, closest_on_segment, parse_linestring, segment_intersects_box
+from djeocoder import LocalGeocoder, AmbiguousResult, DoesNotExist
+import autocomplete
+import benchmark
+import instrument
+import nonblocking
+import postgis
+import snapshot
+import spatial
+from cache import GeocodeCache
+import spelling
+import stream
+from parallel import ParallelGeocoder
+from memory import MemoryBlockSearcher, MemoryIntersectionSearcher, IndexedBlock, SnapshotIndex
+from results import BlockResult, IntersectionResult, contains_number
+import textfiles
+from textfiles import BlockFileLoader, IntersectionFileLoader
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+BLOCKS_FILE = os.path.join(DATA_DIR, 'blocks.txt.gz')
+INTERSECTIONS_FILE = os.path.join(DATA_DIR, 'intersections.txt.gz')
+
+class MemoryBlockSearcherTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.rows = list(BlockFileLoader(BLOCKS_FILE).scan())
+        cls.searcher = MemoryBlockSearcher(cls.rows)
+        cls.blocks = [IndexedBlock(row) for row in cls.rows]
+
+    def linear_search(self, street, number):
+        # What PostgisBlockSearcher's query and parity check would return.
+        found = []
+        for block in self.blocks:
+            if block.street != street or not (block.from_num <= number <= block.to_num):
+                continue
+            if contains_number(number, block.from_num, block.to_num, block.left_from_num, block.left_to_num, block.right_from_num, block.right_to_num)[0]:
+                found.append(block.id)
+        return sorted(found)
+
+    def test_tobin(self):
+        results = self.searcher.search('Tobin', '24', suffix='rd', city='boston')
+        self.assertEqual([r.id for r in results], [1])
+        self.assertEqual(self.searcher.search('Tobin', '24', suffix='st'), [])
+        self.assertEqual(self.searcher.search('Tobin', '24', zip='02101'), [])
+
+    def test_interpolated_location(self):
+        # 24 is at the end of block 1's left (even) range.
+        results = self.searcher.search('TOBIN', 24)
+        self.assertEqual(results[0].location, (-71.161144, 42.25932))
+
+    def test_unknown_street(self):
+        self.assertEqual(self.searcher.search('NOSUCHSTREET', 10), [])
+
+    def test_street_without_number(self):
+        results = self.searcher.search('TOBIN')
+        self.assertEqual(len(results), len([r for r in self.rows if r['street'] == 'TOBIN']))
+
+    def test_matches_linear_search(self):
+        for street in ('WASHINGTON', 'CENTRE', 'DORCHESTER', 'COTTAGE', 'BOUNDARY'):
+            for number in (1, 2, 55, 100, 101, 186, 1000, 1001, 4000):
+                actual = sorted(r.id for r in self.searcher.search(street, number))
+                self.assertEqual(actual, self.linear_search(street, number), '%s %s' % (number, street))
+
+class PrefetchingSearcher:
+    """
+    Stands in for a PostGIS searcher's search_streets(), counting queries.
+    """
+    def __init__(self, rows, street_columns):
+        self.rows = rows
+        self.street_columns = street_columns
+        self.queries = []
+
+    def search_streets(self, streets):
+        self.queries.append(sorted(streets))
+        return [r for r in self.rows if set(r[c] for c in self.street_columns) & set(streets)]
+
+class GeocodeManyTestCase(unittest.TestCase):
+    LOCATIONS = ['24 Tobin Rd', 'Tobin Rd & Kerna Rd', 'garbage!!', '1001 Washington St', '12 Nowhere St']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.block_rows = list(BlockFileLoader(BLOCKS_FILE).scan())
+        cls.intersection_rows = list(IntersectionFileLoader(INTERSECTIONS_FILE).scan())
+
+    def test_grouped_queries(self):
+        blocks = PrefetchingSearcher(self.block_rows, ['street'])
+        intersections = PrefetchingSearcher(self.intersection_rows, ['street_a', 'street_b'])
+        results = list(LocalGeocoder(None, blocks, intersections).geocode_many(self.LOCATIONS, batch_size=3))
+        self.assertEqual([location for location, result, error in results], self.LOCATIONS)
+        self.assertEqual(len(blocks.queries), 2)
+        self.assertEqual(len(intersections.queries), 2)
+
+        (_, tobin, _), (_, corner, _), (_, _, garbage), (_, _, washington), (_, _, nowhere) = results
+        self.assertEqual(tobin.point, (-71.161144, 42.25932))
+        self.assertEqual(corner.intersection_id, 1)
+        self.assert_(isinstance(garbage, DoesNotExist))
+        self.assert_(isinstance(washington, AmbiguousResult))
+        self.assert_(isinstance(nowhere, DoesNotExist))
+
+    def test_matches_geocode(self):
+        geocoder = LocalGeocoder(None, MemoryBlockSearcher(self.block_rows), MemoryIntersectionSearcher(self.intersection_rows))
+        for location, result, error in geocoder.geocode_many(self.LOCATIONS):
+            if error is None:
+                expected = geocoder.geocode(location)
+                self.assertEqual((result.address, result.point), (expected.address, expected.point))
+            else:
+                self.assertRaises(error.__class__, geocoder.geocode, location)
+
+    def test_prefetches_corrected_streets(self):
+        blocks = PrefetchingSearcher(self.block_rows, ['street'])
+        intersections = PrefetchingSearcher(self.intersection_rows, ['street_a', 'street_b'])
+        corrector = spelling.StreetCorrector(MemoryBlockSearcher(self.block_rows).street_names())
+        geocoder = LocalGeocoder(None, blocks, intersections, spelling=corrector)
+        ((location, result, error),) = geocoder.geocode_many(['24 Tobim Rd'])
+        self.assertEqual(result.point, (-71.161144, 42.25932))
+        self.assertEqual(len(blocks.queries), 1)
+
+class SpellingTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.searcher = MemoryBlockSearcher.from_file(BLOCKS_FILE)
+        cls.corrector = spelling.StreetCorrector.from_searcher(cls.searcher)
+
+    def test_corrections(self):
+        for incorrect, correct in [('MASACHUSETTS', 'MASSACHUSETTS'), ('COMONWEALTH', 'COMMONWEALTH'),
+                                   ('WASHINTON', 'WASHINGTON'), ('TOBIM', 'TOBIN'), ('TOBIN', 'TOBIN')]:
+            self.assertEqual(self.corrector.correct(incorrect).correct, correct)
+
+    def test_threshold(self):
+        # Short names aren't guessed at, and nothing is corrected further than max_distance.
+        self.assertEqual(self.corrector.correct('ZZ').correct, 'ZZ')
+        self.assertEqual(self.corrector.correct('MSACHUSETS').correct, 'MSACHUSETS')
+        corrector = spelling.StreetCorrector(self.searcher.street_names(), max_distance=3, letters_per_edit=3)
+        self.assertEqual(corrector.correct('MSACHUSETS').correct, 'MASSACHUSETTS')
+
+    def test_candidates_match_brute_force(self):
+        streets = self.searcher.street_names()
+        for word in ['WASHINTON', 'BEACONN', 'CENTRE', 'HARVERD', 'DOCHESTER']:
+            limit = self.corrector.allowed_distance(word)
+            expected = sorted((spelling.edit_distance(word, s, limit), -streets[s], s) for s in streets)
+            expected = [(d, s) for d, n, s in expected if d <= limit]
+            if word in streets:
+                expected = [(0, word)]
+            self.assertEqual(self.corrector.candidates(word), expected)
+
+    def test_geocode_misspelled(self):
+        geocoder = LocalGeocoder(None, self.searcher, MemoryIntersectionSearcher.from_file(INTERSECTIONS_FILE))
+        self.assertEqual(geocoder.geocode('24 Tobim Rd').point, (-71.161144, 42.25932))
+        self.assertEqual(geocoder.geocode('Tobim Rd & Kerna Rd').intersection_id, 1)
+
+class GeocodeCacheTestCase(unittest.TestCase):
+    class CountingGeocoder(LocalGeocoder):
+        def geocoder_for(self, location, *args):
+            self.searched.append(location)
+            return LocalGeocoder.geocoder_for(self, location, *args)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.blocks = MemoryBlockSearcher.from_file(BLOCKS_FILE)
+        cls.intersections = MemoryIntersectionSearcher.from_file(INTERSECTIONS_FILE)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'geocodes.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def geocoder(self, cache):
+        geocoder = self.CountingGeocoder(None, self.blocks, self.intersections, cache=cache)
+        geocoder.searched = []
+        return geocoder
+
+    def test_survives_restart(self):
+        cache = GeocodeCache(self.filename)
+        geocoder = self.geocoder(cache)
+        self.assertEqual(geocoder.geocode('24 Tobin Rd').point, (-71.161144, 42.25932))
+        self.assertRaises(DoesNotExist, geocoder.geocode, '12 Nowhere St')
+        cache.close()
+
+        geocoder = self.geocoder(GeocodeCache(self.filename))
+        self.assertEqual(geocoder.geocode('24 TOBIN RD.').point, (-71.161144, 42.25932))
+        self.assertRaises(DoesNotExist, geocoder.geocode, '12 nowhere st')
+        self.assertEqual(geocoder.searched, [])
+        self.assertEqual(geocoder.cache.stats()['entries'], {'OK': 1, 'DoesNotExist': 1})
+
+    def test_expiry(self):
+        cache = GeocodeCache(self.filename, ttl=60, negative_ttl=-1)
+        geocoder = self.geocoder(cache)
+        geocoder.geocode('24 Tobin Rd')
+        self.assertRaises(DoesNotExist, geocoder.geocode, '12 Nowhere St')
+        self.assert_(cache.get('24 Tobin Rd'))
+        self.assertEqual(cache.get('12 Nowhere St'), None)
+        self.assertEqual(cache.purge(), 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_intersection_and_address(self):
+        # These normalize the same, but only the first is an intersection.
+        geocoder = self.geocoder(GeocodeCache(':memory:'))
+        self.assertRaises(DoesNotExist, geocoder.geocode, 'Tobin Rd Kerna Rd')
+        self.assertEqual(geocoder.geocode('Tobin Rd @ Kerna Rd').intersection_id, 1)
+        self.assertEqual(geocoder.geocode('Tobin Rd & Kerna Rd').intersection_id, 1)
+        self.assertEqual(geocoder.searched, ['Tobin Rd Kerna Rd', 'Tobin Rd @ Kerna Rd'])
+
+    def test_stored_as_json(self):
+        cache = GeocodeCache(self.filename)
+        geocoder = self.geocoder(cache)
+        intersection = geocoder.geocode('Tobin Rd & Kerna Rd')
+        choices = [geocoder.geocode('24 Tobin Rd'), intersection]
+        cache.put('Somewhere', None, AmbiguousResult(choices))
+        for value, in cache.conn.execute('select value from geocodes'):
+            json.loads(value)
+
+        result, error = GeocodeCache(self.filename).get('Tobin Rd and Kerna Rd')
+        self.assertEqual(error, None)
+        self.assertEqual(sorted(result.__dict__), sorted(intersection.__dict__))
+        self.assertEqual((result.intersection_id, result.address, result.point), (1, intersection.address, intersection.point))
+        self.assertEqual((result.intersection.id, result.intersection.location), (1, intersection.intersection.location))
+        result, error = GeocodeCache(self.filename).get('somewhere')
+        self.assert_(isinstance(error, AmbiguousResult))
+        self.assertEqual(str(error), 'Geocoder db returned 2 results')
+        self.assertEqual([c.point for c in error.choices], [c.point for c in choices])
+
+    def test_geocode_many(self):
+        geocoder = self.geocoder(GeocodeCache(self.filename))
+        locations = GeocodeManyTestCase.LOCATIONS
+        first = list(geocoder.geocode_many(locations, batch_size=2))
+        searched = list(geocoder.searched)
+        second = list(geocoder.geocode_many(locations + ['24 Kerna Rd'], batch_size=2))
+        self.assertEqual(geocoder.searched, searched + ['24 Kerna Rd'])
+        self.assertEqual([(l, r and r.point, e.__class__) for l, r, e in first],
+                         [(l, r and r.point, e.__class__) for l, r, e in second[:-1]])
+
+class InstrumentTestCase(unittest.TestCase):
+    class FakeConnections:
+        def fetchall(self, query, params):
+            return [(1,), (2,)]
+
+    def test_disabled(self):
+        self.failIf(instrument.enabled())
+        self.assert_(instrument.timer('parse') is instrument.NULL_TIMER)
+
+    def test_geocode_stages(self):
+        geocoder = LocalGeocoder.from_files(BLOCKS_FILE, INTERSECTIONS_FILE)
+        with instrument.recording() as recorder:
+            geocoder.geocode('24 Tobin Rd')
+            geocoder.geocode('Tobin Rd & Kerna Rd')
+            postgis.fetchall(self.FakeConnections(), 'select 1', ())
+        self.failIf(instrument.enabled())
+        summary = recorder.summary()
+        for stage in ['geocode', 'normalize', 'parse', 'block_search', 'intersection_search', 'interpolate', 'sql']:
+            self.assert_(summary['timings'][stage]['count'] > 0, stage)
+        self.assertEqual(summary['timings']['geocode']['count'], 2)
+        self.assertEqual(summary['counters']['sql_queries'], 1)
+        self.assertEqual(summary['counters']['sql_rows'], 2)
+        self.assert_(summary['counters']['candidate_parses'] >= 3)
+        self.assert_('block_search' in recorder.report(histograms=True))
+
+    def test_histogram(self):
+        histogram = instrument.Histogram()
+        for us in [1, 2, 3, 100, 1000]:
+            histogram.add(us / 1e6)
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.percentile(50), 4 / 1e6)
+        self.assertEqual(histogram.percentile(100), 1000 / 1e6)
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_corpus_is_reproducible(self):
+        corpus = benchmark.make_corpus(size=50, seed=3)
+        self.assertEqual(len(corpus['addresses']), 50)
+        self.assertEqual(corpus, benchmark.make_corpus(size=50, seed=3))
+        self.assertNotEqual(corpus, benchmark.make_corpus(size=50, seed=4))
+
+    def test_load_corpus(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'cf_tests.py')
+            open(filename, 'w').write("cf_addrs = {\n    '2038 damen ave chicago il':\n    [],\n}\n")
+            self.assertEqual(benchmark.load_corpus(filename), ['2038 damen ave chicago il'])
+            open(filename, 'w').write('24 Tobin Rd\n\nTobin Rd & Kerna Rd\n')
+            self.assertEqual(benchmark.load_corpus(filename), ['24 Tobin Rd', 'Tobin Rd & Kerna Rd'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_compare(self):
+        old = {'metrics': {'parse_per_sec': 1000.0, 'blocks_p50_us': 100.0, 'blocks_found': 0.9}}
+        new = {'metrics': {'parse_per_sec': 800.0, 'blocks_p50_us': 90.0, 'blocks_found': 0.9}}
+        regressed = dict((name, worse) for name, a, b, change, worse in benchmark.compare(old, new))
+        self.assertEqual(regressed, {'parse_per_sec': True, 'blocks_p50_us': False, 'blocks_found': False})
+
+    def test_classify(self):
+        # classify_benchmark() checks that the old regexes agree on every token.
+        corpus = benchmark.make_corpus(size=100)
+        results = benchmark.classify_benchmark(corpus['addresses'] + corpus['intersections'])
+        self.assertEqual(sorted(results), ['classify_lookup', 'classify_regex', 'standardize', 'standardize_before'])
+
+class StubCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = None
+
+    def execute(self, sql, params=None):
+        conn = self.conn
+        if sql.startswith('PREPARE'):
+            name = sql.split()[1]
+            if name in conn.server_prepared:
+                raise psycopg2.ProgrammingError('prepared statement "%s" already exists' % name)
+            conn.server_prepared.add(name)
+            conn.prepares += 1
+        elif conn.fail_next:
+            conn.fail_next = False
+            raise psycopg2.OperationalError('canceling statement due to statement timeout')
+        time.sleep(conn.delay)
+        self.rows = [(len(conn.server_prepared),)]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+class StubConnection:
+    """
+    Keeps its server-side prepared statements until it's closed, like a
+    psycopg2 connection in autocommit mode.
+    """
+    def __init__(self):
+        self.autocommit = False
+        self.closed = 0
+        self.server_prepared = set()
+        self.prepares = 0
+        self.fail_next = False
+        self.delay = 0
+
+    def cursor(self):
+        return StubCursor(self)
+
+    def close(self):
+        self.closed = 1
+
+class StubPool:
+    """
+    psycopg2's ThreadedConnectionPool over StubConnections: connections put
+    back once minconn are already pooled are closed, and asking for one when
+    maxconn are out raises PoolError.
+    """
+    delay = 0
+
+    def __init__(self, minconn, maxconn):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle = []
+        self.opened = []
+        self.used = 0
+        self.most_used = 0
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            if self.used == self.maxconn:
+                raise psycopg2.pool.PoolError('connection pool exhausted')
+            self.used += 1
+            self.most_used = max(self.most_used, self.used)
+            if self.idle:
+                return self.idle.pop()
+            conn = StubConnection()
+            conn.delay = self.delay
+            self.opened.append(conn)
+            return conn
+
+    def putconn(self, conn, close=False):
+        with self.lock:
+            self.used -= 1
+        if not conn.closed:
+            if not close and len(self.idle) < self.minconn:
+                self.idle.append(conn)
+            else:
+                conn.close()
+
+    def closeall(self):
+        for conn in self.idle:
+            conn.close()
+        self.idle = []
+
+class StubConnectionPool(postgis.ConnectionPool):
+    def connect(self, dsn, minconn, maxconn):
+        return StubPool(minconn, maxconn)
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    QUERY = 'select id from blocks where street=%s'
+
+    def test_failed_query_runs_again(self):
+        pool = StubConnectionPool('dbname=stub', maxconn=1)
+        pool.fetchall(self.QUERY, ('TOBIN',))
+        (conn,) = pool.pool.opened
+        conn.fail_next = True
+        self.assertRaises(psycopg2.OperationalError, pool.fetchall, self.QUERY, ('TOBIN',))
+        # The connection that failed is closed, statements and all, so the
+        # query is prepared afresh rather than clashing with its old self.
+        self.assertEqual(pool.fetchall(self.QUERY, ('TOBIN',)), [(1,)])
+        self.assertEqual(pool.fetchall(self.QUERY, ('TOBIN',)), [(1,)])
+        self.assert_(conn.closed)
+        self.assertEqual(pool.prepared.keys(), pool.pool.idle)
+
+    def test_connections_stay_prepared(self):
+        pool = StubConnectionPool('dbname=stub', maxconn=3)
+        conns = [pool.getconn() for i in range(3)]
+        for conn in conns:
+            pool.execute(conn, self.QUERY, ('TOBIN',))
+        for conn in conns:
+            pool.putconn(conn)
+        for i in range(10):
+            pool.fetchall(self.QUERY, ('TOBIN',))
+        self.assertEqual(len(pool.pool.opened), 3)
+        self.assertEqual([conn.prepares for conn in pool.pool.opened], [1, 1, 1])
+
+    def test_waits_for_a_connection(self):
+        pool = StubConnectionPool('dbname=stub', maxconn=2)
+        pool.pool.delay = 0.01
+        errors = []
+        def run():
+            try:
+                for i in range(3):
+                    pool.fetchall(self.QUERY, ('TOBIN',))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(pool.pool.most_used, 2)
+        self.assertEqual(len(pool.pool.opened), 2)
+
+    def test_closed_connections_forgotten(self):
+        pool = StubConnectionPool('dbname=stub', minconn=1, maxconn=3)
+        conns = [pool.getconn() for i in range(3)]
+        for conn in conns:
+            pool.execute(conn, self.QUERY, ('TOBIN',))
+            pool.putconn(conn)
+        self.assertEqual(pool.prepared.keys(), [conns[0]])
+
+class FakeAsyncPool:
+    """
+    Answers AsyncLocalGeocoder's queries from the data files, when
+    run_until_complete() is called, recording each.
+    """
+    def __init__(self, block_rows, intersection_rows):
+        self.block_rows = block_rows
+        self.intersection_rows = intersection_rows
+        self.hooks = []
+        self.queue = []
+        self.queries = []
+
+    def submit(self, query, params=()):
+        future = nonblocking.Future(self)
+        self.queue.append((query, params, future))
+        return future
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def rows(self, query, params):
+        if 'group by street' in query:
+            return MemoryBlockSearcher(self.block_rows).street_names().items()
+        elif 'from blocks' in query:
+            columns = postgis.PostgisBlockSearcher.row_columns
+            return [tuple(r[c] for c in columns) for r in self.block_rows if r['street'] in params[0]]
+        columns = postgis.PostgisIntersectionSearcher.row_columns
+        return [tuple(r[c] for c in columns) for r in self.intersection_rows if r['street_a'] in params[0] or r['street_b'] in params[0]]
+
+    def run_until_complete(self, futures):
+        while not all(f.done() for f in futures):
+            for hook in self.hooks:
+                hook()
+            queue, self.queue = self.queue, []
+            self.queries.extend(query for query, params, future in queue)
+            for query, params, future in queue:
+                future.set_result(self.rows(query, params))
+
+    def fetchall(self, query, params=()):
+        return self.submit(query, params).result()
+
+class StubAsyncCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, params=()):
+        if query == 'bad sql':
+            raise psycopg2.ProgrammingError('syntax error')
+        self.conn.queries.append(query)
+
+    def fetchall(self):
+        return [(self.conn.queries[-1],)]
+
+class StubAsyncConnection:
+    """
+    An asynchronous connection whose query's results are in once ready()
+    has been called: until then, poll() asks to wait for its (real) file
+    descriptor to be readable.
+    """
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.closed = 0
+        self.queries = []
+        self.fail = False
+
+    def fileno(self):
+        return self.read_fd
+
+    def cursor(self):
+        return StubAsyncCursor(self)
+
+    def ready(self):
+        os.write(self.write_fd, 'x')
+
+    def poll(self):
+        if not select.select([self.read_fd], [], [], 0)[0]:
+            return psycopg2.extensions.POLL_READ
+        os.read(self.read_fd, 1)
+        if self.fail:
+            self.close()
+            self.closed = 2
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        return psycopg2.extensions.POLL_OK
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+        self.closed = 1
+
+class StubAsyncConnectionPool(nonblocking.AsyncConnectionPool):
+    # Set to make connecting fail, as if the database were down.
+    down = False
+
+    def connect(self):
+        if self.down:
+            raise psycopg2.OperationalError('could not connect to server')
+        return StubAsyncConnection()
+
+class AsyncConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = StubAsyncConnectionPool('dbname=stub', size=2)
+        self.conns = list(self.pool.idle)
+
+    def tearDown(self):
+        self.pool.closeall()
+
+    def test_poll(self):
+        futures = [self.pool.submit('select %d' % n) for n in range(3)]
+        self.pool.poll()
+        # Two queries are waiting on their connections, and one for a connection.
+        self.failIf(any(f.done() for f in futures))
+        self.assertEqual(len(self.pool.queue), 1)
+        readable, writable = self.pool.fileno_events()
+        self.assertEqual((sorted(readable), writable), (sorted(c.read_fd for c in self.conns), []))
+
+        started = dict((conn.queries[0], conn) for conn in self.conns)
+        started['select 0'].ready()
+        self.pool.poll()
+        self.assertEqual(futures[0].result(), [('select 0',)])
+        self.failIf(futures[1].done())
+        # The freed connection took the queued query.
+        self.assertEqual(started['select 0'].queries, ['select 0', 'select 2'])
+
+        for conn in self.conns:
+            conn.ready()
+        self.pool.run_until_complete(futures)
+        self.assertEqual([f.result() for f in futures], [[('select %d' % n,)] for n in range(3)])
+        self.failIf(self.pool.pending())
+        self.assertEqual(sorted(self.pool.idle), sorted(self.conns))
+
+    def test_errors(self):
+        bad = self.pool.submit('bad sql')
+        self.pool.poll()
+        self.assertRaises(psycopg2.ProgrammingError, bad.result)
+        self.assertEqual(len(self.pool.idle), 2)
+
+        lost = self.pool.submit('select 1')
+        self.pool.poll()
+        (conn,) = self.pool.busy
+        conn.fail = True
+        conn.ready()
+        self.assertRaises(psycopg2.OperationalError, lost.result)
+        self.failIf(self.pool.busy)
+
+    def test_reconnects(self):
+        # The database restarts, closing every connection.
+        futures = [self.pool.submit('select %d' % n) for n in range(2)]
+        self.pool.poll()
+        for conn in self.conns:
+            conn.fail = True
+            conn.ready()
+        for future in futures:
+            self.assertRaises(psycopg2.OperationalError, future.result)
+        self.failIf(self.pool.idle)
+        # The next query gets a new connection.
+        future = self.pool.submit('select 2')
+        self.pool.poll()
+        (conn,) = self.pool.busy
+        self.assert_(conn not in self.conns)
+        conn.ready()
+        self.assertEqual(future.result(), [('select 2',)])
+
+    def test_no_connections(self):
+        # Queued queries fail, rather than waiting for connections that
+        # will never come.
+        self.pool.down = True
+        for conn in self.conns:
+            conn.close()
+        self.assertRaises(psycopg2.OperationalError, self.pool.submit('select 1').result)
+        self.failIf(self.pool.pending())
+        empty = StubAsyncConnectionPool('dbname=stub', size=0)
+        self.assertRaises(psycopg2.pool.PoolError, empty.submit('select 1').result)
+
+class AsyncLocalGeocoderTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.block_rows = list(BlockFileLoader(BLOCKS_FILE).scan())
+        cls.intersection_rows = list(IntersectionFileLoader(INTERSECTIONS_FILE).scan())
+
+    def test_batches_between_polls(self):
+        pool = FakeAsyncPool(self.block_rows, self.intersection_rows)
+        geocoder = nonblocking.AsyncLocalGeocoder(pool)
+        futures = [geocoder.geocode(location) for location in GeocodeManyTestCase.LOCATIONS + ['24 Tobim Rd']]
+        self.failIf(any(f.done() for f in futures))
+        pool.run_until_complete(futures)
+        # The street names, then one blocks query and one intersections query for the lot.
+        self.assertEqual(len(pool.queries), 3)
+        tobin, corner, garbage, washington, nowhere, misspelled = futures
+        self.assertEqual(tobin.result().point, (-71.161144, 42.25932))
+        self.assertEqual(corner.result().intersection_id, 1)
+        self.assertEqual(misspelled.result().point, (-71.161144, 42.25932))
+        self.assertRaises(DoesNotExist, garbage.result)
+        self.assert_(isinstance(washington.error, AmbiguousResult))
+        self.assertRaises(DoesNotExist, nowhere.result)
+
+    def test_geocode_many_matches_local(self):
+        pool = FakeAsyncPool(self.block_rows, self.intersection_rows)
+        geocoder = nonblocking.AsyncLocalGeocoder(pool, batch_size=2)
+        local = LocalGeocoder(None, MemoryBlockSearcher(self.block_rows), MemoryIntersectionSearcher(self.intersection_rows))
+        locations = GeocodeManyTestCase.LOCATIONS * 3
+        expected = [(l, r and r.point, e.__class__) for l, r, e in local.geocode_many(locations)]
+        self.assertEqual([(l, r and r.point, e.__class__) for l, r, e in geocoder.geocode_many(locations)], expected)
+
+    def test_unexpected_error(self):
+        class BrokenGeocoder(LocalGeocoder):
+            def geocode(self, location):
+                if location == 'Tobin Rd & Kerna Rd':
+                    raise RuntimeError('broken')
+                return LocalGeocoder.geocode(self, location)
+        pool = FakeAsyncPool(self.block_rows, self.intersection_rows)
+        geocoder = nonblocking.AsyncLocalGeocoder(pool)
+        original, nonblocking.LocalGeocoder = nonblocking.LocalGeocoder, BrokenGeocoder
+        try:
+            tobin, corner, garbage = [geocoder.geocode(location) for location in GeocodeManyTestCase.LOCATIONS[:3]]
+            pool.run_until_complete([tobin, corner, garbage])
+        finally:
+            nonblocking.LocalGeocoder = original
+        # Only the location that broke gets the error.
+        self.assertRaises(RuntimeError, corner.result)
+        self.assertEqual(tobin.result().point, (-71.161144, 42.25932))
+        self.assertRaises(DoesNotExist, garbage.result)
+
+class ParallelGeocoderTestCase(unittest.TestCase):
+    def test_matches_serial(self):
+        locations = GeocodeManyTestCase.LOCATIONS * 3
+        geocoder = ParallelGeocoder(processes=2, blocks_file=BLOCKS_FILE, intersections_file=INTERSECTIONS_FILE)
+        try:
+            results = list(geocoder.geocode_many(locations, batch_size=2))
+        finally:
+            geocoder.close()
+        self.assertEqual([location for location, result, error in results], locations)
+        self.assertEqual(results[0][1].point, (-71.161144, 42.25932))
+        self.assert_(isinstance(results[3][2], AmbiguousResult))
+        self.assertEqual(len(results[3][2].choices), 2)
+        self.assertEqual(sum(s['locations'] for s in geocoder.stats().values()), len(locations))
+
+class StreamTestCase(unittest.TestCase):
+    INPUT = 'id,location\n1,24 Tobin Rd\n2,Tobin Rd & Kerna Rd\n3,garbage\n'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.geocoder = LocalGeocoder(None, MemoryBlockSearcher.from_file(BLOCKS_FILE), MemoryIntersectionSearcher.from_file(INTERSECTIONS_FILE))
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_csv(self):
+        outf = StringIO()
+        self.assertEqual(stream.run(self.geocoder, StringIO(self.INPUT), outf, chunk_size=2), 3)
+        lines = outf.getvalue().splitlines()
+        self.assertEqual(lines[0], 'id,location,geocoded_address,longitude,latitude,geocode_error')
+        self.assertEqual(lines[2], '2,Tobin Rd & Kerna Rd,Tobin Rd. & Kerna Rd.,-71.161144,42.25932,')
+        self.assert_(lines[3].endswith("DoesNotExist: Geocoder db couldn't find this location: 'garbage'"), lines[3])
+
+    def test_resume(self):
+        checkpoint = os.path.join(self.tmpdir, 'offset')
+        stream.write_checkpoint(checkpoint, 2)
+        outf = StringIO()
+        stream.run(self.geocoder, StringIO(self.INPUT), outf, chunk_size=2, checkpoint=checkpoint)
+        self.assertEqual(outf.getvalue().splitlines()[0].split(',')[:2], ['3', 'garbage'])
+        self.assertEqual(stream.read_checkpoint(checkpoint), 3)
+
+    def test_jsonl(self):
+        outf = StringIO()
+        stream.run(self.geocoder, StringIO('{"location": "24 Tobin Rd", "id": 1}\n'), outf, format='jsonl')
+        self.assertEqual(json.loads(outf.getvalue())['longitude'], -71.161144)
+
+    def test_jsonl_not_strings(self):
+        outf = StringIO()
+        lines = ['{"location": 5}', '{"location": null}', '{"location": ["24 Tobin Rd"]}', '{"location": "24 Tobin Rd"}']
+        self.assertEqual(stream.run(self.geocoder, StringIO('\n'.join(lines)), outf, format='jsonl'), 4)
+        records = [json.loads(line) for line in outf.getvalue().splitlines()]
+        self.assertEqual([r['location'] for r in records], [5, None, ['24 Tobin Rd'], '24 Tobin Rd'])
+        self.assert_(all(r['geocode_error'] for r in records[:3]))
+        self.assertEqual(records[3]['longitude'], -71.161144)
+
+class MemoryIntersectionSearcherTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.rows = list(IntersectionFileLoader(INTERSECTIONS_FILE).scan())
+        cls.searcher = MemoryIntersectionSearcher(cls.rows)
+
+    def ids(self, **kwargs):
+        return sorted(r.id for r in self.searcher.search(**kwargs))
+
+    def test_pair_in_either_order(self):
+        self.assertEqual(self.ids(street_a='TOBIN', street_b='KERNA'), [1])
+        self.assertEqual(self.ids(street_a='kerna', street_b='tobin'), [1])
+
+    def test_filters(self):
+        self.assertEqual(self.ids(street_a='TOBIN', suffix_a='RD', street_b='KERNA', suffix_b='RD'), [1])
+        self.assertEqual(self.ids(street_a='TOBIN', suffix_a='ST', street_b='KERNA'), [])
+
+    def postgis_ids(self, **kwargs):
+        # What PostgisIntersectionSearcher's query finds: each filter may
+        # match either side.
+        found = []
+        for r in self.rows:
+            for key, value in kwargs.items():
+                if value and value.upper() not in (r[key[:-1] + 'a'], r[key[:-1] + 'b']):
+                    break
+            else:
+                found.append(int(r['id']))
+        return sorted(found)
+
+    def test_matches_postgis(self):
+        rng = random.Random(0)
+        keys = ('predir_a', 'street_a', 'suffix_a', 'postdir_a', 'predir_b', 'street_b', 'suffix_b', 'postdir_b')
+        for r in rng.sample(self.rows, 100):
+            # Some of the row's values, on either side.
+            kwargs = dict((rng.choice([k[:-1] + 'a', k[:-1] + 'b']), r[k].lower()) for k in keys if r[k] and rng.random() < 0.6)
+            self.assertEqual(self.ids(**kwargs), self.postgis_ids(**kwargs), kwargs)
+        self.assertEqual(self.ids(street_a='TOBIN', street_b='TOBIN'), self.postgis_ids(street_a='TOBIN'))
+
+    def test_single_street(self):
+        expected = sorted(int(r['id']) for r in self.rows if 'TOBIN' in (r['street_a'], r['street_b']))
+        self.assertEqual(self.ids(street_a='TOBIN'), expected)
+        self.assertEqual(self.ids(street_b='TOBIN'), expected)
+
+    def test_fully_specified_pair(self):
+        row = {'predir_a': 'N', 'street_a': 'MAIN', 'suffix_a': 'ST', 'postdir_a': 'E',
+               'predir_b': 'S', 'street_b': 'ELM', 'suffix_b': 'AVE', 'postdir_b': 'W',
+               'id': '1', 'pretty_name': 'N. Main St. E. & S. Elm Ave. W.', 'zip': '', 'city': '', 'state': '',
+               'location': 'SRID=4326;POINT(-71.0 42.0)'}
+        searcher = MemoryIntersectionSearcher([row])
+        self.assertEqual(len(searcher.search('S', 'ELM', 'AVE', 'W', 'N', 'MAIN', 'ST', 'E')), 1)
+        self.assertEqual(len(searcher.search('S', 'ELM', 'AVE', 'W', 'N', 'MAIN', 'ST', 'NE')), 0)
+        # As in PostGIS, a value may be found on the other side.
+        self.assertEqual(len(searcher.search('S', 'ELM', 'AVE', 'W', 'N', 'MAIN', 'ST', 'W')), 1)
+
+    def test_every_row_found(self):
+        for r in self.rows[:200]:
+            kwargs = dict((k, r[k] or None) for k in ('predir_a', 'street_a', 'suffix_a', 'postdir_a', 'predir_b', 'street_b', 'suffix_b', 'postdir_b'))
+            self.assert_(int(r['id']) in self.ids(**kwargs), kwargs)
+
+def postgis_line_interpolate_point(coords, fraction):
+    """
+    A transliteration of PostGIS's LWGEOM_line_interpolate_point(), which
+    walks the segments accumulating lengths as fractions of the whole line.
+    """
+    if fraction == 0:
+        return coords[0]
+    if fraction == 1:
+        return coords[-1]
+    length = sum(math.hypot(x2 - x1, y2 - y1) for (x1, y1), (x2, y2) in zip(coords, coords[1:]))
+    tlength = 0.0
+    for (x1, y1), (x2, y2) in zip(coords, coords[1:]):
+        slength = math.hypot(x2 - x1, y2 - y1) / length
+        if fraction < tlength + slength:
+            dseg = (fraction - tlength) / slength
+            return (x1 + (x2 - x1) * dseg, y1 + (y2 - y1) * dseg)
+        tlength += slength
+    return coords[-1]
+
+class InterpolationTestCase(unittest.TestCase):
+    FRACTIONS = (0.0, 0.001, 0.25, 0.5, 0.7, 0.999, 1.0)
+
+    def test_matches_postgis_on_every_block(self):
+        for row in BlockFileLoader(BLOCKS_FILE).scan():
+            coords = parse_linestring(row['geom'])
+            line = LineString(coords)
+            for fraction in self.FRACTIONS:
+                x, y = line.interpolate(fraction)
+                px, py = postgis_line_interpolate_point(coords, fraction)
+                self.assert_(abs(x - px) <= INTERPOLATION_TOLERANCE and abs(y - py) <= INTERPOLATION_TOLERANCE,
+                             'block %s at %s: %r != %r' % (row['id'], fraction, (x, y), (px, py)))
+
+    def test_endpoints(self):
+        line = LineString.from_wkt('SRID=4326;LINESTRING(-71.160281 42.258729,-71.160837 42.259113,-71.161144 42.25932)')
+        self.assertEqual(line.interpolate(0), (-71.160281, 42.258729))
+        self.assertEqual(line.interpolate(1), (-71.161144, 42.25932))
+
+class QueryEngineTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.blocks = BlockFileLoader(BLOCKS_FILE)
+        cls.intersections = IntersectionFileLoader(INTERSECTIONS_FILE)
+
+    def test_pushed_down_predicates_match_row_at_a_time(self):
+        predicate = textfiles.AND(textfiles.OR(textfiles.KEYEQ('street', 'TOBIN'), textfiles.KEYEQ('suffix', 'WAY')),
+                                  textfiles.NOT(textfiles.KEYEQ('left_city', 'NOWHERE')))
+        rows = list(textfiles.where(self.blocks.scan(), predicate))
+        self.assert_(rows)
+        self.assertEqual([r['id'] for r in rows], [r['id'] for r in self.blocks.scan() if predicate(r)])
+        self.assertEqual(textfiles.count(textfiles.matches(self.blocks.scan(), street='TOBIN', suffix='RD')),
+                         len([r for r in self.blocks.scan() if r['street'] == 'TOBIN' and r['suffix'] == 'RD']))
+
+    def test_hash_join_matches_nested_loop(self):
+        blocks = list(textfiles.matches(self.blocks.scan(), street='TOBIN'))
+        intersections = list(textfiles.where(self.intersections.scan(), textfiles.OR(
+            textfiles.KEYEQ('street_a', 'TOBIN'), textfiles.KEYEQ('street_a', 'KERNA'))))
+        expected = [textfiles.concat(b, i, 'b_', 'i_') for b in blocks for i in intersections if b['street'] == i['street_a']]
+        joined = list(textfiles.inner_join(textfiles.matches(self.blocks.scan(), street='TOBIN'), intersections, 'street', 'b_', 'i_', key2='street_a'))
+        self.assert_(joined)
+        self.assertEqual(joined, expected)
+
+    def test_distinct_and_group_by(self):
+        suffixes = [d['suffix'] for d in textfiles.distinct(textfiles.select(self.blocks.scan(), 'suffix'))]
+        self.assertEqual(sorted(suffixes), sorted(set(self.blocks.scan().column('suffix'))))
+        groups = textfiles.group_by(textfiles.matches(self.blocks.scan(), street='TOBIN'), 'suffix')
+        self.assertEqual(sorted(groups.keys()), ['CT', 'RD'])
+        self.assertEqual([r['suffix'] for r in groups['CT']], ['CT'] * textfiles.count(groups['CT']))
+
+    def test_plain_selectors(self):
+        rows = [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}, {'a': 1, 'b': 'x'}]
+        self.assertEqual(list(textfiles.matches(rows, a=1)), [rows[0], rows[2]])
+        self.assertEqual(list(textfiles.distinct(rows)), rows[:2])
+        self.assertEqual(list(textfiles.inner_join(rows, [{'a': 1, 'c': 3}], 'a', '', 'r_')),
+                         [{'a': 1, 'b': 'x', 'r_a': 1, 'r_c': 3}] * 2)
+
+class ColumnarLoaderTestCase(unittest.TestCase):
+    class Loader(textfiles.PipeFileLoader):
+        column_names = ['id', 'name', 'num', 'geom']
+        int_columns = ('id', 'num')
+        geometry_columns = ('geom',)
+
+    LINES = ['1|Tobin Rd|24|SRID=4326;LINESTRING(-71.161144 42.25932,-71.1605 42.2598)',
+             '2|Kerna Rd||SRID=4326;POINT(-71.1 42.3)',
+             '3|Tobin Rd|-5|']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(self.tmpdir, 'rows.txt')
+        open(filename, 'w').write('\n'.join(self.LINES) + '\n')
+        self.loader = self.Loader(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_ints(self):
+        self.assertEqual([row['id'] for row in self.loader.scan()], [1, 2, 3])
+        # An empty value is stored as NULL_INT, and reads back as None.
+        self.assertEqual([row['num'] for row in self.loader.scan()], [24, None, -5])
+        self.assertEqual(list(self.loader.data[self.loader.columns['num']]), [24, textfiles.NULL_INT, -5])
+
+    def test_text_is_interned(self):
+        self.assert_(self.loader.row(0)['name'] is self.loader.row(2)['name'])
+
+    def test_geometry(self):
+        # The EWKT reads back as it was written.
+        self.assertEqual([row['geom'] for row in self.loader.scan()], [line.split('|')[3] for line in self.LINES])
+        self.assertEqual(self.loader.row(0).coordinates('geom'), [(-71.161144, 42.25932), (-71.1605, 42.2598)])
+        self.assertEqual(self.loader.row(1).coordinates('geom'), [(-71.1, 42.3)])
+        self.assertEqual(self.loader.row(2).coordinates('geom'), [])
+
+    def test_row_view(self):
+        row = self.loader.row(1)
+        self.assertEqual(row.keys(), ['id', 'name', 'num', 'geom'])
+        self.assertEqual(list(row), row.keys())
+        self.assertEqual(len(row), 4)
+        self.assertEqual(row.items(), [('id', 2), ('name', 'Kerna Rd'), ('num', None), ('geom', 'SRID=4326;POINT(-71.1 42.3)')])
+        self.assertEqual(row.values(), [value for key, value in row.items()])
+        self.assertEqual(row.get('name'), 'Kerna Rd')
+        self.assertEqual(row.get('num', 0), None)
+        self.assertEqual(row.get('missing'), None)
+        self.assertEqual(row.get('missing', 'default'), 'default')
+        self.assertRaises(KeyError, lambda: row['missing'])
+        self.assert_('name' in row and 'missing' not in row)
+        self.assertEqual(dict(row), dict(row.items()))
+        self.assert_(row == dict(row.items()))
+        self.assert_(row != self.loader.row(0))
+
+class ChunkedLoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def rows(self, loader):
+        return [dict(row.items()) for row in loader.scan()]
+
+    def test_matches_readline_loader(self):
+        for loader_class, filename in ((BlockFileLoader, BLOCKS_FILE), (IntersectionFileLoader, INTERSECTIONS_FILE)):
+            self.assertEqual(self.rows(loader_class(filename)), self.rows(benchmark.readline_load(loader_class, filename)))
+
+    def test_processes(self):
+        self.assertEqual(self.rows(IntersectionFileLoader(INTERSECTIONS_FILE, processes=2)),
+                         self.rows(IntersectionFileLoader(INTERSECTIONS_FILE)))
+
+    def test_chunks_end_at_lines(self):
+        lines = ['%d|%s' % (i, 'x' * (i % 7)) for i in range(1000)]
+        filename = os.path.join(self.tmpdir, 'lines.txt')
+        open(filename, 'w').write('\n'.join(lines))
+        chunks = list(textfiles.read_chunks(filename, chunk_size=100))
+        self.assert_(len(chunks) > 10)
+        self.assertEqual(''.join(chunks).split('\n'), lines)
+
+    def test_padding_stripped(self):
+        filename = os.path.join(self.tmpdir, 'padded.txt')
+        open(filename, 'w').write('1| a |b\r\n\n 2|c|d \n')
+        self.assertEqual(self.rows(textfiles.PipeFileLoader(filename)),
+                         [{'0': '1', '1': 'a', '2': 'b'}, {'0': '2', '1': 'c', '2': 'd'}])
+
+    def test_stream(self):
+        loader = BlockFileLoader(BLOCKS_FILE)
+        rows = textfiles.matches(BlockFileLoader.stream(BLOCKS_FILE), street='TOBIN')
+        self.assert_(not isinstance(rows, list))
+        expected = list(textfiles.matches(loader.scan(), street='TOBIN'))
+        rows = list(rows)
+        self.assertEqual([dict(row.items()) for row in rows], [dict(row.items()) for row in expected])
+        self.assertEqual(rows[0].coordinates('geom'), expected[0].coordinates('geom'))
+        searcher = MemoryBlockSearcher(BlockFileLoader.stream(BLOCKS_FILE))
+        self.assertEqual(searcher.search('TOBIN', 24)[0].location, (-71.161144, 42.25932))
+
+class ReverseGeocodeTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.geocoder = LocalGeocoder.from_files(BLOCKS_FILE, INTERSECTIONS_FILE)
+        cls.index = spatial.SpatialIndex.from_searchers(cls.geocoder.block_searcher, cls.geocoder.intersection_searcher)
+        cls.reverse = spatial.ReverseGeocoder(cls.index)
+
+    def points(self, n=200):
+        # Points near blocks, as from a GPS, and points anywhere around the city.
+        rng = random.Random(0)
+        for i in xrange(n):
+            if i % 2:
+                yield rng.uniform(-71.2, -70.95), rng.uniform(42.2, 42.42)
+            else:
+                lon, lat = rng.choice(self.index.blocks).interpolate(rng.random())
+                yield lon + rng.uniform(-0.0005, 0.0005), lat + rng.uniform(-0.0005, 0.0005)
+
+    def test_matches_brute_force(self):
+        project = self.index.projection.project
+        segments = []
+        for block in self.index.blocks:
+            points = [project(*c) for c in block.linestring().coords]
+            segments.extend(points[n] + points[n + 1] for n in xrange(len(points) - 1))
+        for lon, lat in self.points(20):
+            x, y = project(lon, lat)
+            expected = min(closest_on_segment(x, y, *segment)[0] for segment in segments)
+            block, distance = self.index.nearest_block(lon, lat)[:2]
+            self.assertAlmostEqual(distance, math.sqrt(expected), 6)
+            expected = min((px - x) ** 2 + (py - y) ** 2 for px, py in
+                           (project(*i.coordinates()) for i in self.index.intersections))
+            self.assertAlmostEqual(self.index.nearest_intersection(lon, lat)[1], math.sqrt(expected), 6)
+
+    def test_house_numbers(self):
+        # Just off either side of 10 Tobin Rd, which is on the left (even) side.
+        lon, lat = self.geocoder.geocode('10 Tobin Rd').point
+        block, intersection = self.geocoder.reverse_geocode(lon - 0.00005, lat)
+        self.assertEqual((block.id, block.number, block.side), (1, 10, 'left'))
+        block, intersection = self.geocoder.reverse_geocode(lon + 0.00005, lat)
+        self.assertEqual((block.id, block.number % 2, block.side), (1, 1, 'right'))
+
+    def test_intersection(self):
+        block, intersection = self.reverse.reverse_geocode(-71.161144, 42.25932)
+        self.assertEqual((intersection.id, intersection.distance), (1, 0.0))
+        self.assertEqual(block.distance, 0.0)
+
+    def test_max_distance(self):
+        self.assertEqual(self.reverse.reverse_geocode(-70.0, 42.25932, max_distance=1000), (None, None))
+        block, intersection = self.reverse.reverse_geocode(-70.0, 42.25932)
+        self.assert_(block.distance > 80000)
+
+class SpatialSearcherTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.searcher = spatial.SpatialSearcher.from_files(BLOCKS_FILE, INTERSECTIONS_FILE)
+        cls.index = cls.searcher.index
+
+    def segments(self, block):
+        points = [self.index.projection.project(*c) for c in block.linestring().coords]
+        return [points[n] + points[n + 1] for n in xrange(len(points) - 1)]
+
+    def found(self, results):
+        results = list(results)
+        blocks = sorted(r.id for r in results if isinstance(r, BlockResult))
+        intersections = sorted(r.id for r in results if isinstance(r, IntersectionResult))
+        return blocks, intersections
+
+    def test_radius_matches_brute_force(self):
+        for lon, lat, meters in [(-71.161144, 42.25932, 250), (-71.06, 42.35, 600), (-71.12, 42.3, 50)]:
+            x, y = self.index.projection.project(lon, lat)
+            blocks = sorted(b.id for b in self.index.blocks
+                            if min(closest_on_segment(x, y, *segment)[0] for segment in self.segments(b)) <= meters ** 2)
+            intersections = sorted(i.id for i in self.index.intersections
+                                   if self.index.distance(i.coordinates(), (lon, lat)) <= meters)
+            results = list(self.searcher.within_radius(lon, lat, meters))
+            self.assertEqual(self.found(results), (blocks, intersections))
+            self.assert_(all(r.distance <= meters + 1e-6 for r in results))
+
+    def test_bbox_matches_brute_force(self):
+        box = (-71.17, 42.25, -71.15, 42.27)
+        min_x, min_y = self.index.projection.project(*box[:2])
+        max_x, max_y = self.index.projection.project(*box[2:])
+        blocks = sorted(b.id for b in self.index.blocks
+                        if any(segment_intersects_box(*(segment + (min_x, min_y, max_x, max_y))) for segment in self.segments(b)))
+        intersections = sorted(i.id for i in self.index.intersections
+                               if box[0] <= i.coordinates()[0] <= box[2] and box[1] <= i.coordinates()[1] <= box[3])
+        self.assert_(blocks and intersections)
+        self.assertEqual(self.found(self.searcher.within_bbox(*box)), (blocks, intersections))
+        self.assertEqual(self.found(self.searcher.within_bbox(*box, blocks=False)), ([], intersections))
+
+    def test_lazy(self):
+        results = self.searcher.within_bbox(-180, -90, 180, 90)
+        self.assert_(isinstance(results.next(), BlockResult))
+
+class AutocompleteTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.index = autocomplete.AutocompleteIndex.from_files(BLOCKS_FILE, INTERSECTIONS_FILE)
+
+    def texts(self, text, k=10):
+        return [c.text for c in self.index.complete(text, k)]
+
+    def test_prefix(self):
+        texts = self.texts('tobin')
+        self.assertEqual(texts[:2], ['Tobin Ct.', 'Tobin Rd.'])
+        self.assert_('Tobin Rd. & Kerna Rd.' in self.texts('tobin', 100))
+        self.assert_(all(t.upper().startswith('TOBIN') or ' & TOBIN' in t.upper() for t in texts))
+        self.assertEqual(self.texts('  TOBIN rd.'), self.texts('tobin rd'))
+        self.assertEqual(self.texts('zzzz'), [])
+        self.assertEqual(len(self.texts('w', 5)), 5)
+
+    def test_ranking_matches_brute_force(self):
+        for prefix in ['W', 'WASH', 'WASHINGTON ST', 'TOBIN', 'CENTRE ST &']:
+            lo = bisect.bisect_left(self.index.keys, prefix)
+            hi = bisect.bisect_left(self.index.keys, prefix + '\xff')
+            exact = autocomplete.ranked(e for key, e in zip(self.index.keys, self.index.entries)[lo:hi] if key == prefix)
+            expected = exact + [e for e in autocomplete.ranked(self.index.entries[lo:hi]) if e not in exact]
+            self.assertEqual([e.text for e in expected[:10]], self.texts(prefix))
+
+    def test_intersection(self):
+        for text in ['tobin rd & k', 'Tobin Rd and Kerna', 'kerna rd & tob']:
+            (completion,) = self.index.complete(text)
+            self.assertEqual(completion.text, 'Tobin Rd. & Kerna Rd.')
+            self.assertEqual(completion.kind, autocomplete.INTERSECTION)
+            self.assertEqual(completion.location, (-71.161144, 42.25932))
+
+    def test_house_number(self):
+        (completion,) = self.index.complete('24 tobin rd')
+        self.assertEqual(completion.text, '24 Tobin Rd.')
+        self.assertEqual([b.id for b in completion.blocks], [1])
+        self.assertEqual(completion.location, (-71.161144, 42.25932))
+        # Every block suggested has the number on its range.
+        for completion in self.index.complete('150 w'):
+            self.assert_(completion.blocks)
+            for b in completion.blocks:
+                self.assert_(contains_number(150, b.from_num, b.to_num, b.left_from_num, b.left_to_num,
+                                             b.right_from_num, b.right_to_num)[0])
+        self.assertEqual(self.index.complete('99999 tobin'), [])
+
+    def test_house_number_matches_brute_force(self):
+        for number, prefix in [(24, 'T'), (150, 'W'), (9999, 'A'), (99999, 'W'), (1, 'CENTRE ST')]:
+            expected = []
+            for entry in self.index.matches(prefix):
+                if entry.kind == autocomplete.STREET and autocomplete.blocks_containing(entry.blocks, number):
+                    expected.append('%d %s' % (number, entry.text))
+            self.assertEqual(expected[:10], self.texts('%d %s' % (number, prefix)))
+
+    def test_unicode(self):
+        self.assertEqual(self.texts(u'tobin'), self.texts('tobin'))
+        self.assertEqual(self.texts(u'24 Tobin Rd'), ['24 Tobin Rd.'])
+        self.assertEqual(self.texts(u'tob\xeen'), [])
+
+class DeltaTestCase(unittest.TestCase):
+    BLOCK = 'INSERT|900001|1-9 Zebulon Way||ZEBULON|zebulon-way|Zebulon Way|WAY||2|8|1|9|1|9|02132|02132|BOSTON|BOSTON|MA|MA||SRID=4326;LINESTRING(-71.1 42.3,-71.1 42.301)'
+    INTERSECTION = 'INSERT|900001|Zebulon Way & Tobin Rd.|zebulon-way-and-tobin-rd||ZEBULON|WAY|||TOBIN|RD||02132|BOSTON|MA|SRID=4326;POINT(-71.1 42.3)'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.geocoder = LocalGeocoder.from_files(BLOCKS_FILE, INTERSECTIONS_FILE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, lines):
+        filename = os.path.join(self.tmpdir, name)
+        open(filename, 'w').write('\n'.join(lines) + '\n')
+        return filename
+
+    def test_read_deltas(self):
+        deltas = list(textfiles.read_deltas(self.write('blocks.delta', [self.BLOCK, 'delete|2']), BlockFileLoader))
+        self.assertEqual([(op, row['id']) for op, row in deltas], [('INSERT', '900001'), ('DELETE', '2')])
+        self.assertEqual(deltas[0][1]['street'], 'ZEBULON')
+        bad = self.write('bad.delta', ['UPDATE|1|too few'])
+        self.assertRaises(textfiles.DeltaError, list, textfiles.read_deltas(bad, BlockFileLoader))
+
+    def test_blocks(self):
+        searcher = self.geocoder.block_searcher
+        before = searcher.streets
+        self.assert_(1 not in [b.id for b in searcher.search('TOBIN', 30)])
+        tobin = [line for line in gzip.open(BLOCKS_FILE) if line.startswith('1|')][0].strip()
+        self.geocoder.apply_deltas(self.write('blocks.delta', [
+            self.BLOCK,
+            'UPDATE|' + tobin.replace('|2|24|1|23|1|24|', '|2|30|1|29|1|30|'),
+            'DELETE|2',
+        ]))
+        self.assertEqual(self.geocoder.geocode('5 Zebulon Way').address, u'5 1-9 Zebulon Way')
+        self.assert_(1 in [b.id for b in searcher.search('TOBIN', 30)])
+        self.assertEqual([b.id for b in searcher.streets['WASHINGTON'].blocks if b.id == 2], [])
+        # The new street is known to the spelling corrector, and readers
+        # holding on to the old streets still see them as they were.
+        self.assertEqual(self.geocoder.geocode('5 Zebulom Way').address, u'5 1-9 Zebulon Way')
+        self.assert_('ZEBULON' not in before)
+        self.assertEqual(len([b for b in before['WASHINGTON'].blocks if b.id == 2]), 1)
+
+    def test_all_or_nothing(self):
+        searcher = self.geocoder.block_searcher
+        before = searcher.streets
+        filename = self.write('blocks.delta', [self.BLOCK, 'DELETE|999999999'])
+        self.assertRaises(textfiles.DeltaError, searcher.apply_file, filename)
+        self.assert_(searcher.streets is before)
+        self.assertRaises(DoesNotExist, self.geocoder.geocode, '5 Zebulon Way')
+
+    def test_bad_intersections_file(self):
+        # The blocks file is fine, but nothing is applied from either.
+        blocks = self.geocoder.block_searcher.streets
+        spelling = self.geocoder.spelling
+        self.assertRaises(textfiles.DeltaError, self.geocoder.apply_deltas,
+                          self.write('blocks.delta', [self.BLOCK]),
+                          self.write('intersections.delta', [self.INTERSECTION, 'DELETE|999999999']))
+        self.assert_(self.geocoder.block_searcher.streets is blocks)
+        self.assert_(self.geocoder.spelling is spelling)
+        self.assertRaises(DoesNotExist, self.geocoder.geocode, '5 Zebulon Way')
+        self.assertRaises(DoesNotExist, self.geocoder.geocode, 'Zebulon Way & Tobin Rd')
+        # And the geocoder can still take a good pair of files.
+        self.geocoder.apply_deltas(self.write('blocks.delta', [self.BLOCK]),
+                                   self.write('intersections.delta', [self.INTERSECTION]))
+        self.assertEqual(self.geocoder.geocode('Zebulon Way & Tobin Rd').intersection_id, 900001)
+
+    def test_intersections(self):
+        self.geocoder.apply_deltas(self.write('blocks.delta', [self.BLOCK]),
+                                   self.write('intersections.delta', [self.INTERSECTION, 'DELETE|1']))
+        self.assertEqual(self.geocoder.geocode('Zebulon Way & Tobin Rd').intersection_id, 900001)
+        self.assertRaises(DoesNotExist, self.geocoder.geocode, 'Tobin Rd & Kerna Rd')
+        searcher = self.geocoder.intersection_searcher
+        self.assertEqual(len(searcher.intersections), len(MemoryIntersectionSearcher.from_file(INTERSECTIONS_FILE).intersections))
+        self.assertEqual(searcher.search(street_a='ZEBULON')[0].id, 900001)
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'intersections.txt.gz')
+        shutil.copy2(INTERSECTIONS_FILE, self.source)
+        self.snapshot = snapshot.compile_snapshot(self.source, IntersectionFileLoader)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_same_rows_as_text(self):
+        loader = snapshot.load(self.source, IntersectionFileLoader)
+        self.assert_(isinstance(loader, snapshot.SnapshotLoader))
+        text = IntersectionFileLoader(self.source)
+        self.assertEqual([r.items() for r in loader.scan()], [r.items() for r in text.scan()])
+        self.assertEqual(loader.coordinates('location', 0), text.coordinates('location', 0))
+        loader.close()
+
+    def test_postings(self):
+        loader = snapshot.SnapshotLoader(self.snapshot)
+        rows = loader.rows_with('street_a', 'TOBIN')
+        self.assert_(rows)
+        self.assert_(all(loader.row(i)['street_a'] == 'TOBIN' for i in rows))
+        self.assertEqual(loader.rows_with('street_a', 'NO SUCH STREET'), [])
+        # where() answers an equality test on an indexed column from the postings.
+        self.assertEqual(textfiles.matches(loader.scan(), street_a='TOBIN').row_ids(), rows)
+        loader.close()
+
+    def test_stale_snapshot_falls_back_to_text(self):
+        outf = open(self.source, 'ab')
+        outf.write('\0')
+        outf.close()
+        self.failIf(snapshot.is_fresh(self.snapshot, self.source))
+        self.assert_(isinstance(snapshot.load(self.source, IntersectionFileLoader), IntersectionFileLoader))
+
+    def test_touched_source_is_still_fresh(self):
+        os.utime(self.source, (0, 0))
+        self.assert_(snapshot.is_fresh(self.snapshot, self.source))
+
+    def test_corruption(self):
+        data = bytearray(open(self.snapshot, 'rb').read())
+        data[snapshot.HEADER.size + 100] ^= 0xff
+        open(self.snapshot, 'wb').write(data)
+        self.assertRaises(snapshot.SnapshotError, snapshot.SnapshotLoader, self.snapshot, True)
+        self.assert_(isinstance(snapshot.load(self.source, IntersectionFileLoader), IntersectionFileLoader))
+
+    def test_truncated_snapshot_falls_back_to_text(self):
+        data = open(self.snapshot, 'rb').read()
+        open(self.snapshot, 'wb').write(data[:len(data) // 2])
+        self.assert_(snapshot.is_fresh(self.snapshot, self.source))
+        self.assertRaises(snapshot.SnapshotError, snapshot.SnapshotLoader, self.snapshot)
+        self.assert_(isinstance(snapshot.load(self.source, IntersectionFileLoader), IntersectionFileLoader))
+
+    def test_searcher(self):
+        searcher = MemoryIntersectionSearcher.from_file(self.source)
+        # Nothing is read from the snapshot until it's searched.
+        self.assert_(isinstance(searcher.streets, SnapshotIndex))
+        self.assertEqual(searcher.streets.built, {})
+        (result,) = searcher.search(street_a='Tobin', suffix_a='Rd', street_b='Kerna', suffix_b='Rd')
+        self.assertEqual(result.location, (-71.161144, 42.25932))
+
+    def test_intersection_searcher_matches_text(self):
+        searcher = MemoryIntersectionSearcher.from_file(self.source)
+        text = MemoryIntersectionSearcher(IntersectionFileLoader(self.source).scan())
+        found = lambda results: [(r.id, r.pretty_name, r.location, r.zip) for r in results]
+        for street_a, street_b in [('TOBIN', None), (None, 'KERNA'), ('TOBIN', 'KERNA'), ('KERNA', 'TOBIN'),
+                                   ('WASHINGTON', 'BEACON'), ('CENTRE', 'CENTRE'), ('NO SUCH', None), (None, None)]:
+            self.assertEqual(found(searcher.search(street_a=street_a, street_b=street_b)),
+                             found(text.search(street_a=street_a, street_b=street_b)))
+        self.assertEqual(len(searcher.intersections), len(text.intersections))
+        self.assertEqual(sorted(searcher.streets), sorted(text.streets))
+
+    def test_block_searcher_matches_text(self):
+        source = os.path.join(self.tmpdir, 'blocks.txt.gz')
+        shutil.copy2(BLOCKS_FILE, source)
+        snapshot.compile_snapshot(source, BlockFileLoader)
+        searcher = MemoryBlockSearcher.from_file(source)
+        text = MemoryBlockSearcher(BlockFileLoader(source).scan())
+        self.assert_(isinstance(searcher.streets, SnapshotIndex))
+        self.assertEqual(searcher.street_names(), text.street_names())
+        found = lambda results: [(r.id, r.pretty_name, r.location) for r in results]
+        for street, number in [('TOBIN', 24), ('TOBIN', None), ('WASHINGTON', 150), ('CENTRE', 1), ('NO SUCH', 1)]:
+            self.assertEqual(found(searcher.search(street, number)), found(text.search(street, number)))
+
+    def test_deltas(self):
+        searcher = MemoryIntersectionSearcher.from_file(self.source)
+        filename = os.path.join(self.tmpdir, 'intersections.delta')
+        open(filename, 'w').write(DeltaTestCase.INTERSECTION + '\nDELETE|1\n')
+        searcher.apply_file(filename)
+        self.assertEqual([r.id for r in searcher.search(street_a='ZEBULON', street_b='TOBIN')], [900001])
+        self.assertEqual(searcher.search(street_a='TOBIN', street_b='KERNA'), [])
+        self.assertEqual(len(searcher.intersections), len(IntersectionFileLoader(self.source)))
+
+if __name__ == "__main__":
+    unittest.main()
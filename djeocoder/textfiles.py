@@ -1,33 +1,265 @@
 import re
 import string
 import gzip
+import multiprocessing
+import operator
+from array import array
 
 def line_generator(inf):
-	line = inf.readline()
-	while line != None and len(line) > 0:
-		yield line
-		line = inf.readline()
+    line = inf.readline()
+    while line != None and len(line) > 0:
+        yield line
+        line = inf.readline()
+
+# Stands for an empty value in an integer column.
+NULL_INT = -2 ** 31
+
+# How many bytes of (decompressed) text to read at a time.
+CHUNK_SIZE = 1 << 20
+
+# Whitespace next to a delimiter or at either end of a line. Chunks without
+# any don't need their fields stripped one by one.
+PADDING = (' |', '| ', ' \n', '\n ', '\t', '\r', '\f', '\v')
+
+def needs_stripping(text):
+    for padding in PADDING:
+        if padding in text:
+            return True
+    return text[:1] == ' ' or text[-1:] == ' '
+
+def open_text(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'r')
+    return open(filename, 'r')
+
+def read_chunks(filename, chunk_size=CHUNK_SIZE):
+    """
+    Yields the text of a file (decompressed, if it's gzipped) in pieces of
+    about chunk_size bytes, each ending at the end of a line.
+    """
+    inf = open_text(filename)
+    try:
+        rest = ''
+        while True:
+            data = inf.read(chunk_size)
+            if not data:
+                break
+            end = data.rfind('\n')
+            if end < 0:
+                rest += data
+                continue
+            yield rest + data[:end + 1]
+            rest = data[end + 1:]
+        if rest:
+            yield rest
+    finally:
+        inf.close()
+
+def split_records(text):
+    """
+    Splits text into records, each a list of its stripped fields, leaving
+    out blank lines.
+
+    >>> split_records('1|a|b\\n\\n2| c|d \\r\\n')
+    [['1', 'a', 'b'], ['2', 'c', 'd']]
+    """
+    if needs_stripping(text):
+        return [[x.strip() for x in line.split('|')] for line in text.split('\n') if line.strip()]
+    return [line.split('|') for line in text.split('\n') if line]
+
+class RowView(object):
+    """
+    A read-only, dict-like view of one row of a PipeFileLoader. Values are
+    only looked up in the loader's columns when they're asked for. (Or of
+    one record of a RecordStream, where index is the record's fields.)
+    """
+    __slots__ = ('loader', 'index')
+    def __init__(self, loader, index):
+        self.loader = loader
+        self.index = index
+    def __getitem__(self, name):
+        return self.loader.getters[name](self.index)
+    def get(self, name, default=None):
+        if name in self.loader.getters:
+            return self[name]
+        return default
+    def __contains__(self, name):
+        return name in self.loader.getters
+    def __iter__(self):
+        return iter(self.loader.column_names)
+    def __len__(self):
+        return len(self.loader.column_names)
+    def keys(self):
+        return list(self.loader.column_names)
+    def values(self):
+        return [self[k] for k in self.loader.column_names]
+    def items(self):
+        return [(k, self[k]) for k in self.loader.column_names]
+    def coordinates(self, name):
+        return self.loader.coordinates(name, self.index)
+    def __eq__(self, other):
+        return dict(self.items()) == other
+    def __ne__(self, other):
+        return not self == other
+    def __repr__(self):
+        return repr(dict(self.items()))
 
 class PipeFileLoader(object):
-    def __init__(self, filename):
-		if filename.endswith('.gz'):
-			inf = gzip.open(filename, 'r')
-		else:
-			inf = open(filename, 'r')
-        self.rows = []
-        self.column_names = []
+    """
+    Loads a pipe-delimited file (optionally gzipped) into columns, rather
+    than a list per row:
+
+      * text columns are lists of interned strings, so repeated values like
+        cities and suffixes are only stored once;
+      * int_columns are array('i')s, with NULL_INT for empty values (which
+        read back as None);
+      * geometry_columns are a flat array('d') of coordinates for the whole
+        column, with array('l') offsets marking where each row's start, and
+        read back as EWKT strings.
+
+    Rows are read through RowViews, created as they're needed.
+
+    The file is read CHUNK_SIZE bytes at a time, and each chunk is split
+    into records and then converted a column at a time. With processes,
+    the chunks are converted by that many worker processes.
+
+    To look at the rows without holding the whole file, stream() reads
+    them lazily instead.
+    """
+    column_names = []
+    int_columns = ()
+    geometry_columns = ()
+
+    def __init__(self, filename, processes=None):
+        self.column_names = list(self.column_names)
         self.columns = {}
-		for line in line_generator(inf):
-            self.rows.append([x.strip() for x in line.split('|')])
-        inf.close()
+        self.data = []
+        self.size = 0
+        chunks = read_chunks(filename)
+        if processes and processes > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                for parsed in pool.imap(parse_chunk, ((self.__class__, text) for text in chunks)):
+                    self.extend(parsed, True)
+            finally:
+                pool.terminate()
+        else:
+            for text in chunks:
+                self.extend(self.parse_chunk(text))
+        self.make_getters()
+
+    @classmethod
+    def parse_chunk(cls, text):
+        """
+        Returns (number of records, columns) for the records in text, where
+        each column is a list of interned strings, an array('i') or a
+        geometry column's (prefixes, coordinates, offsets), as held by the
+        loader.
+        """
+        records = split_records(text)
+        if not records:
+            return 0, []
+        column_names = cls.column_names or [str(i) for i in range(len(records[0]))]
+        n = len(column_names)
+        for fields in records:
+            if len(fields) < n:
+                raise ValueError('Expected %d fields, got %d: %r' % (n, len(fields), '|'.join(fields)))
+        columns = []
+        for name, values in zip(column_names, zip(*records)):
+            if name in cls.int_columns:
+                columns.append(array('i', [int(v) if v else NULL_INT for v in values]))
+            elif name in cls.geometry_columns:
+                columns.append(geometry_column(values))
+            else:
+                columns.append(map(intern, values))
+        return len(records), columns
+
+    def extend(self, parsed, reintern=False):
+        """
+        Adds the columns returned by parse_chunk(). Strings that came from
+        another process are interned again with reintern.
+        """
+        count, columns = parsed
+        if not count:
+            return
+        if not self.data:
+            self.make_storage(len(columns))
+        for i, values in enumerate(columns):
+            name = self.column_names[i]
+            if name in self.geometry_columns:
+                extend_geometry(self.data[i], values)
+            elif reintern and name not in self.int_columns:
+                self.data[i].extend(map(intern, values))
+            else:
+                self.data[i].extend(values)
+        self.size += count
+
+    @classmethod
+    def stream(cls, filename, chunk_size=CHUNK_SIZE):
+        """
+        Returns an iterable of the file's rows, read a chunk at a time and
+        never all held at once, which can be filtered with where() and the
+        other operators like a scan().
+        """
+        return RecordStream(cls, filename, chunk_size)
+    def make_storage(self, n):
+        if not self.column_names:
+            self.column_names = [str(i) for i in range(n)]
+        for i in range(len(self.column_names)):
+            self.columns[self.column_names[i]] = i
+            name = self.column_names[i]
+            if name in self.int_columns:
+                self.data.append(array('i'))
+            elif name in self.geometry_columns:
+                # (prefixes, coordinates, offsets)
+                self.data.append(([], array('d'), array('l', [0])))
+            else:
+                self.data.append([])
+    def append(self, fields):
+        if not self.data:
+            self.make_storage(len(fields))
+        for i in range(len(self.column_names)):
+            name = self.column_names[i]
+            value = fields[i]
+            if name in self.int_columns:
+                if value == '':
+                    self.data[i].append(NULL_INT)
+                else:
+                    self.data[i].append(int(value))
+            elif name in self.geometry_columns:
+                append_geometry(self.data[i], value)
+            else:
+                self.data[i].append(intern(value))
+        self.size += 1
+    def make_getters(self):
+        self.getters = {}
+        for i in range(len(self.column_names)):
+            name = self.column_names[i]
+            if name in self.int_columns:
+                self.getters[name] = int_getter(self.data[i])
+            elif name in self.geometry_columns:
+                self.getters[name] = geometry_getter(self.data[i])
+            else:
+                self.getters[name] = self.data[i].__getitem__
+    def __len__(self):
+        return self.size
+    def row(self, index):
+        return RowView(self, index)
+    def coordinates(self, name, index):
+        """
+        Returns the (x, y) pairs of a geometry column in one row.
+        """
+        prefixes, coords, offsets = self.data[self.columns[name]]
+        return [(coords[j], coords[j + 1]) for j in xrange(offsets[index], offsets[index + 1], 2)]
     def row_as_dict(self, row):
+        if isinstance(row, RowView):
+            return dict(row.items())
         d = {}
         for i in range(len(self.column_names)):
             d[self.column_names[i]] = row[i]
         return d
     def scan(self):
-        for x in self.rows:
-            yield self.row_as_dict(x)
+        return Scan(self)
     def dict_as_tuple(self, dict):
         lst = []
         for k in self.column_names:
@@ -40,13 +272,147 @@ class PipeFileLoader(object):
         for x in selector:
             yield self.dict_as_tuple(x)
 
+def int_getter(values):
+    def get(index):
+        value = values[index]
+        if value == NULL_INT:
+            return None
+        return value
+    return get
+
+def append_geometry(storage, wkt_str):
+    prefixes, coords, offsets = storage
+    if not wkt_str:
+        prefixes.append('')
+    else:
+        start = wkt_str.index('(')
+        prefixes.append(intern(wkt_str[:start]))
+        for pair in wkt_str[start + 1:wkt_str.rindex(')')].split(','):
+            x, y = pair.split()
+            coords.append(float(x))
+            coords.append(float(y))
+    offsets.append(len(coords))
+
+def geometry_column(values):
+    """
+    Returns (prefixes, coordinates, offsets) for a list of EWKT strings,
+    as append_geometry() would build them one by one, but converting all of
+    the coordinates in one go.
+
+    >>> geometry_column(['SRID=4326;POINT(1 2)', '', 'LINESTRING(3 4,5.5 6)'])
+    (['SRID=4326;POINT', '', 'LINESTRING'], array('d', [1.0, 2.0, 3.0, 4.0, 5.5, 6.0]), array('l', [0, 2, 2, 6]))
+    """
+    prefixes = []
+    bodies = []
+    offsets = array('l', [0])
+    end = 0
+    for wkt_str in values:
+        if wkt_str:
+            start = wkt_str.index('(')
+            prefixes.append(intern(wkt_str[:start]))
+            body = wkt_str[start + 1:wkt_str.rindex(')')]
+            bodies.append(body)
+            end += 2 * (body.count(',') + 1)
+        else:
+            prefixes.append('')
+        offsets.append(end)
+    coords = array('d', map(float, ','.join(bodies).replace(',', ' ').split()))
+    if len(coords) != end:
+        raise ValueError('Geometries with other than two coordinates per point')
+    return prefixes, coords, offsets
+
+def extend_geometry(storage, other):
+    prefixes, coords, offsets = storage
+    other_prefixes, other_coords, other_offsets = other
+    base = len(coords)
+    prefixes.extend(other_prefixes)
+    coords.extend(other_coords)
+    offsets.extend(array('l', [base + offset for offset in other_offsets[1:]]))
+
+def wkt_coordinates(wkt_str):
+    """
+    Returns the (x, y) pairs of an EWKT geometry.
+
+    >>> wkt_coordinates('SRID=4326;LINESTRING(-71.1 42.3,-71.2 42.4)')
+    [(-71.1, 42.3), (-71.2, 42.4)]
+    """
+    if not wkt_str:
+        return []
+    coords = []
+    for pair in wkt_str[wkt_str.index('(') + 1:wkt_str.rindex(')')].split(','):
+        x, y = pair.split()
+        coords.append((float(x), float(y)))
+    return coords
+
+def parse_chunk(args):
+    # For PipeFileLoader's worker processes.
+    loader_class, text = args
+    return loader_class.parse_chunk(text)
+
+class RecordStream(object):
+    """
+    The rows of a file, as RowViews over each record's list of fields, read
+    a chunk at a time. Int and geometry fields are only converted when
+    they're asked for, so filtering on a text column never parses them.
+    """
+    def __init__(self, loader_class, filename, chunk_size=CHUNK_SIZE):
+        self.loader_class = loader_class
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.column_names = list(loader_class.column_names)
+        self.make_getters()
+
+    def make_getters(self):
+        self.columns = {}
+        self.getters = {}
+        for i, name in enumerate(self.column_names):
+            self.columns[name] = i
+            if name in self.loader_class.int_columns:
+                self.getters[name] = lazy_int_getter(i)
+            else:
+                # Geometries read back as the EWKT they were written as.
+                self.getters[name] = operator.itemgetter(i)
+
+    def coordinates(self, name, fields):
+        return wkt_coordinates(fields[self.columns[name]])
+
+    def __iter__(self):
+        for text in read_chunks(self.filename, self.chunk_size):
+            records = split_records(text)
+            if records and not self.column_names:
+                self.column_names = [str(i) for i in range(len(records[0]))]
+                self.make_getters()
+            n = len(self.column_names)
+            for fields in records:
+                if len(fields) < n:
+                    raise ValueError('Expected %d fields, got %d: %r' % (n, len(fields), '|'.join(fields)))
+                yield RowView(self, fields)
+
+def lazy_int_getter(i):
+    def get(fields):
+        value = fields[i]
+        if value:
+            return int(value)
+        return None
+    return get
+
+def geometry_getter(storage):
+    prefixes, coords, offsets = storage
+    def get(index):
+        prefix = prefixes[index]
+        if not prefix:
+            return ''
+        pairs = ['%r %r' % (coords[j], coords[j + 1]) for j in xrange(offsets[index], offsets[index + 1], 2)]
+        return '%s(%s)' % (prefix, ','.join(pairs))
+    return get
+
 def list_selector(lst):
     for x in lst:
         yield x
 
 def value_or_none(d, key):
     try: return d[key]
-    except KeyError: None
+    except KeyError: return None
 
 def concat(d1, d2, p1='', p2=''):
     dplus = {}
@@ -58,43 +424,173 @@ def concat(d1, d2, p1='', p2=''):
         dplus[knew] = d2[k]
     return dplus
 
-def inner_join(selector1, selector2, key, prefix1='', prefix2=''):
-    list2 = list(selector2)
-    for x1 in selector1:
-        v1 = value_or_none(x1, key)
-        for x2 in list2:
-            v2 = value_or_none(x2, key)
-            if v1==v2:
-                yield concat(x1, x2, prefix1, prefix2)
+##################
+# COLUMNAR SCANS #
+##################
 
-def dict_matches_predicates(dict, *predlist):
-    for p in predlist:
-        if not p(dict):
-            return False
-    return True
+# How many rows a Scan works on at a time.
+BATCH_SIZE = 1024
 
-def dict_as_tuple(d):
-    return tuple(sorted(d.items()))
+class Scan(object):
+    """
+    A selector over a loader's rows that works on lists of row ids, a batch
+    at a time, instead of on one dict at a time. Predicates handed to where()
+    are pushed down into it: KEYEQ and friends are checked against the
+    loader's columns before any RowView is made, and an equality test on an
+    indexed column (a SnapshotLoader's postings) skips straight to the rows
+    that have the value. Iterating over a Scan gives RowViews, so anything
+    that takes a plain selector takes a Scan.
+    """
+    def __init__(self, loader, rows=None, predicates=()):
+        self.loader = loader
+        self.rows = rows
+        self.predicates = tuple(predicates)
 
-def where(selector, *predlist):
-    for x in selector:
-        if dict_matches_predicate(x, *predlist):
-            yield x
+    def where(self, *predicates):
+        return Scan(self.loader, self.rows, self.predicates + predicates)
+
+    def batches(self, size=BATCH_SIZE):
+        """
+        Yields the ids of the rows that satisfy the predicates, in lists of
+        at most size.
+        """
+        rows, predicates = self.rows, self.predicates
+        if rows is None:
+            rows, predicates = self.use_index(predicates)
+        if rows is None:
+            n = len(self.loader)
+            chunks = (range(start, min(start + size, n)) for start in xrange(0, n, size))
+        else:
+            chunks = (rows[start:start + size] for start in xrange(0, len(rows), size))
+        for batch in chunks:
+            for p in predicates:
+                batch = filter_rows(p, self.loader, batch)
+                if not batch:
+                    break
+            if batch:
+                yield batch
+
+    def use_index(self, predicates):
+        # Looks for an equality test that the loader's postings can answer.
+        postings = getattr(self.loader, 'postings', {})
+        for p in predicates:
+            if isinstance(p, KEYEQ) and p.key in postings:
+                rest = tuple(q for q in predicates if q is not p)
+                return self.loader.rows_with(p.key, p.value), rest
+        return None, predicates
+
+    def row_ids(self):
+        ids = []
+        for batch in self.batches():
+            ids.extend(batch)
+        return ids
+
+    def column(self, name):
+        """
+        Returns the values of one column for the selected rows.
+        """
+        get = self.loader.getters.get(name, none_getter)
+        values = []
+        for batch in self.batches():
+            values.extend(map(get, batch))
+        return values
+
+    def keyed(self, name):
+        """
+        Yields (value of column name, RowView) for the selected rows.
+        """
+        loader = self.loader
+        get = loader.getters.get(name, none_getter)
+        for batch in self.batches():
+            for i, value in zip(batch, map(get, batch)):
+                yield value, RowView(loader, i)
+
+    def __iter__(self):
+        loader = self.loader
+        for batch in self.batches():
+            for i in batch:
+                yield RowView(loader, i)
+
+    def __len__(self):
+        return sum(len(batch) for batch in self.batches())
+
+def none_getter(index):
+    return None
+
+def filter_rows(p, loader, batch):
+    if isinstance(p, Predicate):
+        return p.filter_rows(loader, batch)
+    return [i for i in batch if p(RowView(loader, i))]
+
+def keyed(selector, key):
+    if isinstance(selector, Scan):
+        return selector.keyed(key)
+    return ((value_or_none(x, key), x) for x in selector)
+
+##############
+# PREDICATES #
+##############
+
+class Predicate(object):
+    """
+    A test on one dict (or RowView) at a time, which a Scan can also run
+    over a batch of row ids with filter_rows().
+    """
+    def __call__(self, d):
+        raise NotImplementedError
+    def filter_rows(self, loader, batch):
+        return [i for i in batch if self(RowView(loader, i))]
 
-def KEYEQ(k, v):
-    return lambda dict: k in dict.keys() and dict[k] == v
+class KEYEQ(Predicate):
+    def __init__(self, k, v):
+        self.key = k
+        self.value = v
+    def __call__(self, d):
+        return self.key in d and d[self.key] == self.value
+    def filter_rows(self, loader, batch):
+        if self.key not in loader.getters:
+            return []
+        get, v = loader.getters[self.key], self.value
+        return [i for i in batch if get(i) == v]
 
-def KEYNEQ(k, v):
-    return lambda dict: (not (k in dict.keys())) or dict[k] != v
+class KEYNEQ(KEYEQ):
+    def __call__(self, d):
+        return not KEYEQ.__call__(self, d)
+    def filter_rows(self, loader, batch):
+        if self.key not in loader.getters:
+            return batch
+        get, v = loader.getters[self.key], self.value
+        return [i for i in batch if get(i) != v]
 
-def AND(*predlist):
-    return lambda d : apply_predlist_and(d, predlist)
+class AND(Predicate):
+    def __init__(self, *predlist):
+        self.predlist = predlist
+    def __call__(self, d):
+        return apply_predlist_and(d, self.predlist)
+    def filter_rows(self, loader, batch):
+        for p in self.predlist:
+            batch = filter_rows(p, loader, batch)
+        return batch
 
-def OR(*predlist):
-    return lambda d : apply_predlist_or(d, predlist)
+class OR(Predicate):
+    def __init__(self, *predlist):
+        self.predlist = predlist
+    def __call__(self, d):
+        return apply_predlist_or(d, self.predlist)
+    def filter_rows(self, loader, batch):
+        matched = set()
+        for p in self.predlist:
+            matched.update(filter_rows(p, loader, [i for i in batch if i not in matched]))
+        return [i for i in batch if i in matched]
 
-def NOT(p):
-    return lambda d : not p(d)
+class NOT(Predicate):
+    def __init__(self, p):
+        self.p = p
+    def __call__(self, d):
+        return not self.p(d)
+    def filter_rows(self, loader, batch):
+        matched = set(filter_rows(self.p, loader, batch))
+        return [i for i in batch if i not in matched]
 
 def apply_predlist_and(d, predlist):
     for p in predlist:
@@ -108,9 +604,40 @@ def apply_predlist_or(d, predlist):
             return True
     return False
 
+def dict_matches_predicates(dict, *predlist):
+    return apply_predlist_and(dict, predlist)
+
+def dict_as_tuple(d):
+    return tuple(sorted(d.items()))
+
+#############
+# OPERATORS #
+#############
+
+def where(selector, *predlist):
+    if isinstance(selector, Scan):
+        return selector.where(*predlist)
+    return (x for x in selector if dict_matches_predicates(x, *predlist))
+
 def matches(selector, **kwargs):
-    preds = [KEYEQ(k, kwargs[k]) for k in kwargs.keys()]
-    return where(selector, preds)
+    return where(selector, *[KEYEQ(k, v) for k, v in kwargs.items()])
+
+def inner_join(selector1, selector2, key, prefix1='', prefix2='', key2=None):
+    """
+    Joins two selectors on selector1's key equalling selector2's key2
+    (which defaults to key), as a hash join: selector2 is read once into a
+    table keyed on its join column, and selector1 is streamed past it.
+    Rows where both join values are missing match each other, as before.
+    """
+    if key2 is None:
+        key2 = key
+    table = {}
+    for value, x2 in keyed(selector2, key2):
+        try: table[value].append(x2)
+        except KeyError: table[value] = [x2]
+    for value, x1 in keyed(selector1, key):
+        for x2 in table.get(value, ()):
+            yield concat(x1, x2, prefix1, prefix2)
 
 def select(selector, *ks):
     for x in selector:
@@ -121,19 +648,31 @@ def select(selector, *ks):
         yield d
 
 def count(selector):
+    if isinstance(selector, Scan):
+        return len(selector)
     c = 0
     for x in selector: c += 1
     return c
 
 def group_by(selector, key):
+    """
+    Returns a dict from each value of key to a selector over the rows that
+    have it. Groups of a Scan are Scans over the group's row ids.
+    """
     groups = {}
-    for x in selector:
-        value = value_or_none(x, key)
+    if isinstance(selector, Scan):
+        get = selector.loader.getters.get(key, none_getter)
+        for batch in selector.batches():
+            for i, value in zip(batch, map(get, batch)):
+                try: groups[value].append(i)
+                except KeyError: groups[value] = [i]
+        return dict((value, Scan(selector.loader, rows)) for value, rows in groups.items())
+    for value, x in keyed(selector, key):
         try: groups[value].append(x)
         except KeyError: groups[value] = [x]
     selectors = {}
-    for key in groups.keys():
-        selectors[key] = list_selector(groups[key])
+    for value in groups.keys():
+        selectors[value] = list_selector(groups[value])
     return selectors
 
 def limit(selector, n):
@@ -151,29 +690,68 @@ def aggregate(aggregator, key, selector):
         yield aggregator(sels[key])
 
 def distinct(selector):
-    seen = {}
+    seen = set()
     for x in selector:
         t = dict_as_tuple(x)
-        if not (t in seen.keys()):
-            seen[t] = x
+        if t not in seen:
+            seen.add(t)
             yield x
 
 def first(selector):
-    yield selector.next()
+    yield iter(selector).next()
 
 class IntersectionFileLoader(PipeFileLoader):
-    def __init__(self, filename):
-        PipeFileLoader.__init__(self, filename)
-        self.column_names = ['id', 'pretty_name', 'slug', 'predir_a', 'street_a', 'suffix_a', 'postdir_a', 'predir_b', 'street_b', 'suffix_b', 'postdir_b', 'zip', 'city', 'state', 'location' ]
-        for i in range(len(self.column_names)):
-            self.columns[self.column_names[i]] = i
+    column_names = ['id', 'pretty_name', 'slug', 'predir_a', 'street_a', 'suffix_a', 'postdir_a', 'predir_b', 'street_b', 'suffix_b', 'postdir_b', 'zip', 'city', 'state', 'location' ]
+    int_columns = ('id',)
+    geometry_columns = ('location',)
 
 class BlockFileLoader(PipeFileLoader):
-    def __init__(self, filename):
-        PipeFileLoader.__init__(self, filename)
-        self.column_names = ['id', 'pretty_name', 'predir', 'street', 'street_slug', 'street_pretty_name', 'suffix', 'postdir', 'left_from_num', 'left_to_num', 'right_from_num', 'right_to_num', 'from_num', 'to_num', 'left_zip', 'right_zip', 'left_city', 'right_city', 'left_state', 'right_state', 'parent_id', 'geom']
-        for i in range(len(self.column_names)):
-            self.columns[self.column_names[i]] = i
-    def select(self):
-        query = 'select id, pretty_name, from_num, to_num, left_from_num, left_to_num, right_from_num, right_to_num, ST_AsEWKT(geom) from blocks where street=%s' 
+    column_names = ['id', 'pretty_name', 'predir', 'street', 'street_slug', 'street_pretty_name', 'suffix', 'postdir', 'left_from_num', 'left_to_num', 'right_from_num', 'right_to_num', 'from_num', 'to_num', 'left_zip', 'right_zip', 'left_city', 'right_city', 'left_state', 'right_state', 'parent_id', 'geom']
+    int_columns = ('id', 'left_from_num', 'left_to_num', 'right_from_num', 'right_to_num', 'from_num', 'to_num', 'parent_id')
+    geometry_columns = ('geom',)
+
+##########
+# DELTAS #
+##########
+
+INSERT, UPDATE, DELETE = 'INSERT', 'UPDATE', 'DELETE'
+
+class DeltaError(Exception):
+    pass
+
+def read_deltas(filename, loader_class):
+    """
+    Reads a delta file (optionally gzipped): lines of a dump in
+    loader_class's columns, each preceded by an INSERT, UPDATE or DELETE
+    field, e.g.
+
+        UPDATE|1|1-30 Tobin Rd.||TOBIN|...|SRID=4326;LINESTRING(...)
+        DELETE|2
+
+    and yields (op, row) for each, where row is a dict of column name to
+    string (just the id, for a DELETE).
+    """
+    if filename.endswith('.gz'):
+        inf = gzip.open(filename, 'r')
+    else:
+        inf = open(filename, 'r')
+    columns = loader_class.column_names
+    try:
+        for number, line in enumerate(line_generator(inf)):
+            if not line.strip():
+                continue
+            fields = [x.strip() for x in line.split('|')]
+            op = fields[0].upper()
+            if op == DELETE and len(fields) > 1 and fields[1]:
+                yield op, {'id': fields[1]}
+            elif op in (INSERT, UPDATE) and len(fields) == len(columns) + 1:
+                yield op, dict(zip(columns, fields[1:]))
+            else:
+                raise DeltaError('%s, line %d: expected INSERT or UPDATE and %d fields, or DELETE and an id'
+                                 % (filename, number + 1, len(columns)))
+    finally:
+        inf.close()
 
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()